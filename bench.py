@@ -0,0 +1,966 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the PHH VPN local relay
+Runs entirely on localhost against stand-in proxy and origin servers, so no
+real proxy node is needed.
+
+Usage: python bench.py shaping
+       python bench.py backpressure
+       python bench.py chain
+       python bench.py udp
+       python bench.py load [--proxy HOST:PORT --type TYPE]
+       python bench.py sockets [--proxy HOST:PORT --type TYPE]
+       python bench.py memory [--cycles N] [--system]
+"""
+
+import argparse
+import asyncio
+import functools
+import gc
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+import tracemalloc
+from array import array
+from collections import Counter
+
+import upstream
+from memory import rss_bytes
+from relay import LocalRelay
+from shaping import Shaper
+from socket_tuning import SocketTuning, syn_data_acked
+from udp_relay import UdpAssociations
+
+
+class StandInServer:
+    """Runs an asyncio server on localhost in a background thread"""
+
+    def __init__(self, handler, host='127.0.0.1', fastopen=False):
+        self.handler = handler
+        self.host = host
+        self.fastopen = fastopen
+        self.port = None
+        self._loop = asyncio.new_event_loop()
+        self._thread = None
+        # Python < 3.12 keeps no reference to stream handler tasks, so the garbage
+        # collector could destroy one while it waits
+        self._handlers = set()
+
+    def start(self):
+        ready = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self._loop)
+            server = self._loop.run_until_complete(
+                asyncio.start_server(self._handle, self.host, 0, backlog=1024))
+            self.port = server.sockets[0].getsockname()[1]
+            if self.fastopen and hasattr(socket, 'TCP_FASTOPEN'):
+                # Accepted only if the kernel allows server-side Fast Open (net.ipv4.tcp_fastopen & 2)
+                server.sockets[0].setsockopt(socket.IPPROTO_TCP, socket.TCP_FASTOPEN, 64)
+            ready.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self
+
+    async def _handle(self, reader, writer):
+        task = asyncio.current_task()
+        self._handlers.add(task)
+        try:
+            await self.handler(reader, writer)
+        finally:
+            self._handlers.discard(task)
+
+    def stop(self):
+        async def cancel_handlers():
+            tasks = asyncio.all_tasks() - {asyncio.current_task()}
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        # Connections still open (e.g. after a load test) would be destroyed while pending
+        asyncio.run_coroutine_threadsafe(cancel_handlers(), self._loop).result(timeout=5)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=5)
+
+
+async def _copy(reader, writer):
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+        if writer.can_write_eof():
+            writer.write_eof()
+    except (ConnectionError, OSError):
+        pass
+
+
+class StandInUdpRelay(asyncio.DatagramProtocol):
+    """UDP half of the stand-in SOCKS5 proxy (IPv4 destinations only)"""
+
+    def __init__(self):
+        self.transport = None
+        self.client = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if self.client is None:
+            self.client = addr
+        if addr == self.client:
+            # RSV RSV FRAG ATYP=1 ADDR(4) PORT(2) DATA
+            if len(data) < 10 or data[3] != 1:
+                return
+            target = (socket.inet_ntoa(data[4:8]), struct.unpack('>H', data[8:10])[0])
+            self.transport.sendto(data[10:], target)
+        else:
+            self.transport.sendto(b'\x00\x00\x00' + upstream.socks5_address(*addr) + data, self.client)
+
+
+async def stand_in_proxy(reader, writer, rtt=0):
+    """Minimal direct-connecting SOCKS5 / HTTP CONNECT proxy (rtt simulates a distant node)"""
+    try:
+        if rtt:
+            # TCP handshake round trip
+            await asyncio.sleep(rtt)
+        first = await reader.readexactly(1)
+        if first == b'\x05':
+            nmethods = (await reader.readexactly(1))[0]
+            await reader.readexactly(nmethods)
+            writer.write(b'\x05\x00')
+            command = (await reader.readexactly(3))[1]
+            host, port = await upstream.read_socks5_address(reader)
+            if command == 3:
+                transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+                    StandInUdpRelay, local_addr=('127.0.0.1', 0))
+                writer.write(b'\x05\x00\x00' + upstream.socks5_address(*transport.get_extra_info('sockname')))
+                await reader.read()
+                transport.close()
+                return
+            ok = b'\x05\x00\x00\x01\x00\x00\x00\x00\x00\x00'
+        else:
+            head = first + await upstream.read_http_head(reader)
+            target = head.split(b' ')[1].decode('latin-1')
+            host, _, port = target.rpartition(':')
+            host, port = host.strip('[]'), int(port)
+            ok = b'HTTP/1.1 200 Connection established\r\n\r\n'
+        origin_reader, origin_writer = await asyncio.open_connection(host, port)
+        if rtt:
+            # Request/reply round trip
+            await asyncio.sleep(rtt)
+        writer.write(ok)
+        await asyncio.gather(_copy(reader, origin_writer), _copy(origin_reader, writer))
+        origin_writer.close()
+    except (ConnectionError, OSError, asyncio.IncompleteReadError, asyncio.CancelledError):
+        # Cancelled by StandInServer.stop(); the stream callback must not see a cancelled task
+        pass
+    finally:
+        writer.close()
+
+
+async def stand_in_origin(reader, writer):
+    """Origin server: reads an 8-byte length and streams that many bytes back"""
+    try:
+        size = struct.unpack('>Q', await reader.readexactly(8))[0]
+        block = b'\x00' * 65536
+        while size > 0:
+            chunk = block if size >= len(block) else block[:size]
+            writer.write(chunk)
+            size -= len(chunk)
+            await writer.drain()
+        if writer.can_write_eof():
+            writer.write_eof()
+        await reader.read()
+    except (ConnectionError, OSError, asyncio.IncompleteReadError, asyncio.CancelledError):
+        # Cancelled by StandInServer.stop(); the stream callback must not see a cancelled task
+        pass
+    finally:
+        writer.close()
+
+
+async def stand_in_echo(reader, writer):
+    """Origin server: echoes everything back"""
+    try:
+        await _copy(reader, writer)
+    except asyncio.CancelledError:
+        pass
+    finally:
+        writer.close()
+
+
+def udp_echo():
+    """Datagram origin echoing everything back from a background thread; returns its port"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+
+    def run():
+        while True:
+            data, addr = sock.recvfrom(65535)
+            sock.sendto(data, addr)
+
+    threading.Thread(target=run, daemon=True).start()
+    return sock.getsockname()[1]
+
+
+def socks5_client(proxy_port, host, port, timeout=30):
+    """Blocking SOCKS5 CONNECT through a local proxy port"""
+    sock = socket.create_connection(('127.0.0.1', proxy_port), timeout=timeout)
+    sock.sendall(b'\x05\x01\x00')
+    if sock.recv(2) != b'\x05\x00':
+        raise ConnectionError("SOCKS5 greeting rejected")
+    sock.sendall(b'\x05\x01\x00' + upstream.socks5_address(host, port))
+    reply = b''
+    while len(reply) < 10:
+        data = sock.recv(10 - len(reply))
+        if not data:
+            raise ConnectionError("SOCKS5 connect failed")
+        reply += data
+    if reply[1] != 0:
+        raise ConnectionError(f"SOCKS5 connect failed (code {reply[1]})")
+    return sock
+
+
+def udp_associate(proxy_port, timeout=30):
+    """Blocking SOCKS5 UDP ASSOCIATE; returns (control socket, relay address)"""
+    sock = socket.create_connection(('127.0.0.1', proxy_port), timeout=timeout)
+    sock.sendall(b'\x05\x01\x00')
+    if sock.recv(2) != b'\x05\x00':
+        raise ConnectionError("SOCKS5 greeting rejected")
+    sock.sendall(b'\x05\x03\x00' + upstream.socks5_address('0.0.0.0', 0))
+    reply = sock.recv(10)
+    if len(reply) < 10 or reply[1] != 0 or reply[3] != 1:
+        raise ConnectionError(f"SOCKS5 UDP ASSOCIATE failed ({reply!r})")
+    return sock, (socket.inet_ntoa(reply[4:8]), struct.unpack('>H', reply[8:10])[0])
+
+
+def download(proxy_port, origin_port, size, recv_size=65536):
+    """Download size bytes from the stand-in origin; returns (seconds, bytes)"""
+    started = time.perf_counter()
+    sock = socks5_client(proxy_port, '127.0.0.1', origin_port)
+    sock.sendall(struct.pack('>Q', size))
+    received = 0
+    while received < size:
+        data = sock.recv(recv_size)
+        if not data:
+            break
+        received += len(data)
+    sock.close()
+    return time.perf_counter() - started, received
+
+
+def bench_shaping(args):
+    """Overhead of the shaper on bulk throughput, rate accuracy and memory bound"""
+    proxy = StandInServer(stand_in_proxy).start()
+    origin = StandInServer(stand_in_origin).start()
+    size = args.size * 1024 * 1024
+    results = {}
+
+    for label, shaper in (("no shaper", None),
+                          ("shaper, limits not reached", Shaper(10 ** 12, 10 ** 12, 1000))):
+        relay = LocalRelay('127.0.0.1', proxy.port, "SOCKS5", listen_port=0, shaper=shaper)
+        relay.start()
+        best = None
+        for _ in range(args.repeat):
+            elapsed, received = download(relay.listen_port, origin.port, size)
+            best = elapsed if best is None else min(best, elapsed)
+        relay.stop()
+        results[label] = size / best
+        print(f"{label:30s} {size / best / 1048576:8.1f} MB/s")
+    overhead = (1 - results["shaper, limits not reached"] / results["no shaper"]) * 100
+    print(f"{'shaper overhead':30s} {overhead:8.1f} %")
+
+    limit = args.limit * 1024
+    relay = LocalRelay('127.0.0.1', proxy.port, "SOCKS5", listen_port=0,
+                       shaper=Shaper(global_rate=limit))
+    relay.start()
+    transfer = limit * 3
+    elapsed, received = download(relay.listen_port, origin.port, transfer)
+    relay.stop()
+    # The first burst is free, so measure against the bytes beyond the bucket size
+    achieved = (received - limit) / elapsed
+    print(f"{'limited to ' + str(args.limit) + ' KB/s':30s} {achieved / 1024:8.1f} KB/s achieved")
+
+    tracemalloc.start()
+    shaper = Shaper(host_rate=10 ** 9)
+    before = tracemalloc.get_traced_memory()[0]
+    for i in range(100000):
+        shaper.reserve(f"host{i}.example", 1)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f"{'100k destinations':30s} {len(shaper.host_buckets):8d} buckets, "
+          f"{(after - before) / 1024:.0f} KB retained")
+
+    proxy.stop()
+    origin.stop()
+
+
+def slow_download(proxy_port, origin_port, size, rate):
+    """Download size bytes reading at no more than rate bytes/s"""
+    sock = socks5_client(proxy_port, '127.0.0.1', origin_port)
+    sock.sendall(struct.pack('>Q', size))
+    started = time.perf_counter()
+    received = 0
+    while received < size:
+        data = sock.recv(16384)
+        if not data:
+            break
+        received += len(data)
+        ahead = received / rate - (time.perf_counter() - started)
+        if ahead > 0:
+            time.sleep(ahead)
+    sock.close()
+    return received
+
+
+def bench_backpressure(args):
+    """Slow client behind a fast upstream: relay memory must not grow with transfer size"""
+    proxy = StandInServer(stand_in_proxy).start()
+    origin = StandInServer(stand_in_origin).start()
+    relay = LocalRelay('127.0.0.1', proxy.port, "SOCKS5", listen_port=0)
+    relay.start()
+    rate = args.rate * 1024 * 1024
+    tracemalloc.start()
+    peaks = []
+
+    for size_mb in args.sizes:
+        peak_buffered = [0]
+        done = threading.Event()
+
+        def monitor():
+            while not done.wait(0.05):
+                peak_buffered[0] = max(peak_buffered[0], relay.call_in_loop(relay.meter.sample_buffers))
+
+        watcher = threading.Thread(target=monitor, daemon=True)
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        watcher.start()
+        received = slow_download(relay.listen_port, origin.port, size_mb * 1024 * 1024, rate)
+        done.set()
+        watcher.join()
+        peak = tracemalloc.get_traced_memory()[1] - baseline
+        peaks.append(peak)
+        print(f"{size_mb:6d} MB transfer: received {received / 1048576:.0f} MB, "
+              f"peak heap growth {peak / 1024:.0f} KB, "
+              f"peak relay buffered {peak_buffered[0] / 1024:.0f} KB")
+
+    tracemalloc.stop()
+    relay.stop()
+    proxy.stop()
+    origin.stop()
+
+    # Flat means the largest transfer needs no more than the smallest plus some slack
+    limit = peaks[0] * 1.5 + 1024 * 1024
+    flat = max(peaks) <= limit
+    print("memory use flat across transfer sizes" if flat else
+          f"memory grew with transfer size (limit {limit / 1024:.0f} KB)")
+    return 0 if flat else 1
+
+
+def bench_chain(args):
+    """Tunnel setup latency through a two-hop chain, with and without warm partial chains"""
+    rtt = args.rtt / 1000.0
+    jump = StandInServer(functools.partial(stand_in_proxy, rtt=rtt)).start()
+    egress = StandInServer(functools.partial(stand_in_proxy, rtt=rtt)).start()
+    origin = StandInServer(stand_in_origin).start()
+    via = [('127.0.0.1', jump.port, "SOCKS5")]
+    results = {}
+
+    for label, warm in (("cold chain per connection", 0), (f"{args.warm} warm partial chains", args.warm)):
+        relay = LocalRelay('127.0.0.1', egress.port, "HTTP/HTTPS", listen_port=0,
+                           via=via, warm_chains=warm)
+        relay.start()
+        # Give the pool time to fill, and space connections like real browsing
+        time.sleep(rtt * 4 + 0.1)
+        setups = []
+        for _ in range(args.connections):
+            elapsed, received = download(relay.listen_port, origin.port, 1)
+            setups.append(elapsed)
+            time.sleep(rtt * 4 + 0.05)
+        relay.stop()
+        setups.sort()
+        results[label] = setups[len(setups) // 2]
+        print(f"{label:30s} median {results[label] * 1000:7.1f} ms  "
+              f"(pool hits {relay.warm.hits}, misses {relay.warm.misses})")
+
+    jump.stop()
+    egress.stop()
+    origin.stop()
+    cold, warm = results.values()
+    print(f"{'setup latency saved':30s} {(1 - warm / cold) * 100:8.1f} %")
+
+
+def udp_round_trips(proxy_port, echo_port, count, size):
+    """Ping-pong datagrams through an association; returns (sorted round trip times, lost)"""
+    control, relay_addr = udp_associate(proxy_port)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.connect(relay_addr)
+    sock.settimeout(1)
+    datagram = b'\x00\x00\x00' + upstream.socks5_address('127.0.0.1', echo_port) + b'\x00' * size
+    times = []
+    lost = 0
+    for _ in range(count):
+        started = time.perf_counter()
+        sock.send(datagram)
+        try:
+            sock.recv(65535)
+        except socket.timeout:
+            lost += 1
+            continue
+        times.append(time.perf_counter() - started)
+    sock.close()
+    control.close()
+    return sorted(times), lost
+
+
+def bench_udp(args):
+    """Datagram round trips through the relay's UDP ASSOCIATE versus the upstream directly"""
+    proxy = StandInServer(stand_in_proxy).start()
+    echo_port = udp_echo()
+    relay = LocalRelay('127.0.0.1', proxy.port, "SOCKS5", listen_port=0)
+    relay.udp = UdpAssociations(args.max_associations)
+    relay.start()
+    results = {}
+
+    for label, port in (("upstream directly", proxy.port), ("through local relay", relay.listen_port)):
+        # Warm up caches and CPU clocks before timing
+        udp_round_trips(port, echo_port, args.count // 10, args.size)
+        started = time.perf_counter()
+        times, lost = udp_round_trips(port, echo_port, args.count, args.size)
+        elapsed = time.perf_counter() - started
+        results[label] = times[len(times) // 2]
+        print(f"{label:30s} median {results[label] * 1e6:7.0f} us, "
+              f"{args.count / elapsed:8.0f} datagrams/s, {lost} lost")
+    print(f"{'added per round trip':30s} {(results['through local relay'] - results['upstream directly']) * 1e6:7.0f} us")
+
+    # Hold more associations open than the table allows
+    controls = [udp_associate(relay.listen_port)[0] for _ in range(args.max_associations * 2)]
+    time.sleep(0.2)
+    print(f"{'associations table':30s} {len(relay.udp.active)} live, {relay.udp.evicted} evicted "
+          f"(limit {args.max_associations})")
+    for control in controls:
+        control.close()
+    time.sleep(0.2)
+    print(f"{'after clients disconnect':30s} {len(relay.udp.active)} live")
+    relay.stop()
+    proxy.stop()
+
+
+def percentile(values, fraction):
+    """Value at fraction (0..1) of an already sorted list"""
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def raise_open_file_limit():
+    """Allow as many sockets as the hard limit permits"""
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        wanted = 65536 if hard == resource.RLIM_INFINITY else hard
+        if soft < wanted:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+        return wanted
+    except (ImportError, ValueError, OSError):
+        return None
+
+
+class LoadStep:
+    """Results of one load step"""
+
+    def __init__(self, rate, long_lived):
+        self.rate = rate
+        self.long_lived = long_lived
+        self.attempted = 0
+        self.latencies = []
+        self.pings = []
+        self.errors = Counter()
+        self.elapsed = None
+
+    @property
+    def error_rate(self):
+        return sum(self.errors.values()) / self.attempted if self.attempted else 0.0
+
+    @property
+    def achieved(self):
+        return len(self.latencies) / self.elapsed if self.elapsed else 0.0
+
+
+async def short_connection(target, origin, size, timeout, step):
+    """Open a tunnel, download size bytes from the stand-in origin and close"""
+    started = time.perf_counter()
+    try:
+        reader, writer = await asyncio.wait_for(upstream.open_tunnel(*target, *origin), timeout)
+        try:
+            writer.write(struct.pack('>Q', size))
+            await asyncio.wait_for(reader.readexactly(size), timeout)
+        finally:
+            writer.close()
+    except Exception as e:
+        step.errors[type(e).__name__] += 1
+        return
+    step.latencies.append(time.perf_counter() - started)
+
+
+async def long_connection(target, echo, interval, timeout, steps, stop):
+    """Hold a tunnel to the echo origin open, timing a small ping every interval"""
+    ping = b'\x00' * 64
+    try:
+        reader, writer = await asyncio.wait_for(upstream.open_tunnel(*target, *echo), timeout)
+    except Exception as e:
+        steps[-1].errors[f"long-lived {type(e).__name__}"] += 1
+        return
+    try:
+        while not stop.is_set():
+            started = time.perf_counter()
+            writer.write(ping)
+            await asyncio.wait_for(reader.readexactly(len(ping)), timeout)
+            # Pings count towards the step running when they complete
+            steps[-1].pings.append(time.perf_counter() - started)
+            try:
+                await asyncio.wait_for(stop.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+    except Exception as e:
+        steps[-1].errors[f"long-lived {type(e).__name__}"] += 1
+    finally:
+        writer.close()
+
+
+async def generate_load(args, target, origin, echo):
+    """Ramp open-loop connection rates and long-lived connection counts step by step"""
+    steps = []
+    tasks = set()
+    stop = asyncio.Event()
+
+    def spawn(coro):
+        task = asyncio.ensure_future(coro)
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    for rate in args.rates:
+        step = LoadStep(rate, (len(steps) + 1) * args.long)
+        steps.append(step)
+        for _ in range(args.long):
+            spawn(long_connection(target, echo, args.ping_interval, args.timeout, steps, stop))
+        # Open loop: connections start on schedule whether or not earlier ones finished
+        started = time.perf_counter()
+        while True:
+            elapsed = time.perf_counter() - started
+            if elapsed >= args.duration:
+                break
+            due = int(elapsed * rate)
+            while step.attempted < due:
+                step.attempted += 1
+                if len(tasks) >= args.max_outstanding:
+                    step.errors['client limit'] += 1
+                else:
+                    spawn(short_connection(target, origin, args.size, args.timeout, step))
+            await asyncio.sleep(min(1.0 / rate, 0.01))
+        step.elapsed = args.duration
+        print(f"step {len(steps)}: {rate} connections/s, {step.long_lived} long-lived, "
+              f"{len(tasks)} in flight", file=sys.stderr)
+    stop.set()
+    if tasks:
+        await asyncio.wait(tasks, timeout=args.timeout * 2)
+    for task in list(tasks):
+        task.cancel()
+    return steps
+
+
+def find_saturation(steps, max_error_rate, latency_factor, max_p99):
+    """First step that breaks an error, throughput or latency limit, with the reasons"""
+    baseline = percentile(sorted(steps[0].latencies), 0.99)
+    for step in steps:
+        reasons = []
+        if step.error_rate > max_error_rate:
+            reasons.append(f"error rate {step.error_rate:.1%}")
+        if step.achieved < step.rate * 0.9:
+            reasons.append(f"only {step.achieved:.0f} of {step.rate} connections/s completed")
+        p99 = percentile(sorted(step.latencies), 0.99)
+        if p99 > baseline * latency_factor:
+            reasons.append(f"p99 {p99 * 1000:.0f} ms is over {latency_factor:g}x the first step")
+        elif p99 > max_p99:
+            reasons.append(f"p99 {p99 * 1000:.0f} ms is over {max_p99 * 1000:.0f} ms")
+        if reasons:
+            return step, reasons
+    return None, []
+
+
+def bench_load(args):
+    """Capacity and connection churn: ramp load through a proxy until it saturates"""
+    limit = raise_open_file_limit()
+    origin = StandInServer(stand_in_origin, args.origin_host).start()
+    echo = StandInServer(stand_in_echo, args.origin_host).start()
+    address = args.origin_address or args.origin_host
+    servers = [origin, echo]
+    relay = None
+    if args.proxy:
+        host, _, port = args.proxy.rpartition(':')
+        target = (host.strip('[]'), int(port), args.type)
+        label = f"{args.proxy} ({args.type})"
+    else:
+        proxy = StandInServer(stand_in_proxy).start()
+        servers.append(proxy)
+        if args.direct:
+            target = ('127.0.0.1', proxy.port, args.type)
+            label = f"stand-in proxy ({args.type})"
+        else:
+            relay = LocalRelay('127.0.0.1', proxy.port, "SOCKS5", listen_port=0, shaper=Shaper.from_env())
+            relay.start()
+            target = ('127.0.0.1', relay.listen_port, args.type)
+            label = f"local relay ({args.type} clients) -> stand-in proxy"
+    print(f"Load target: {label}; {args.duration:g} s per step, {args.size} byte downloads, "
+          f"open file limit {limit or 'unknown'}")
+
+    try:
+        steps = asyncio.run(generate_load(args, target, (address, origin.port), (address, echo.port)))
+    finally:
+        if relay:
+            relay.stop()
+        for server in servers:
+            server.stop()
+
+    print(f"{'rate/s':>7} {'long':>5} {'done/s':>7} {'errors':>7} {'err %':>6} "
+          f"{'p50 ms':>7} {'p90 ms':>7} {'p99 ms':>7} {'max ms':>7} {'ping p99':>9}")
+    for step in steps:
+        latencies = sorted(step.latencies)
+        pings = sorted(step.pings)
+        print(f"{step.rate:7d} {step.long_lived:5d} {step.achieved:7.0f} {sum(step.errors.values()):7d} "
+              f"{step.error_rate * 100:6.1f} "
+              + " ".join(f"{percentile(latencies, q) * 1000:7.1f}" for q in (0.5, 0.9, 0.99, 1.0))
+              + f" {percentile(pings, 0.99) * 1000:9.1f}")
+        if step.errors:
+            print("        errors: " + ", ".join(f"{name} x{count}" for name, count in step.errors.most_common()))
+
+    step, reasons = find_saturation(steps, args.max_error_rate, args.latency_factor, args.max_p99 / 1000.0)
+    if step is None:
+        print(f"No saturation up to {steps[-1].rate} connections/s with {steps[-1].long_lived} "
+              "long-lived connections; raise --rates to find the limit")
+        return 0
+    index = steps.index(step)
+    sustained = f"; last good step {steps[index - 1].rate} connections/s with " \
+                f"{steps[index - 1].long_lived} long-lived" if index else ""
+    print(f"Saturation at {step.rate} connections/s with {step.long_lived} long-lived: "
+          f"{'; '.join(reasons)}{sustained}")
+    return 0
+
+
+async def tuned_tunnels(target, origin, tuning, count, size, repeat, timeout):
+    """Setup times of count sequential tunnels, SYN data acceptances and the median bulk download rate"""
+    async def open_tunnel():
+        reader, writer = await asyncio.wait_for(upstream.open_tunnel(*target, *origin, tuning=tuning), timeout)
+        return reader, writer
+
+    # Warm-up: address family preference and, with Fast Open, the cookie
+    reader, writer = await open_tunnel()
+    writer.close()
+    setups = []
+    syn_data = 0
+    for _ in range(count):
+        started = time.perf_counter()
+        reader, writer = await open_tunnel()
+        # Until the first origin byte arrives, so deferred Fast Open connects are fully counted
+        writer.write(struct.pack('>Q', 1))
+        await reader.readexactly(1)
+        setups.append(time.perf_counter() - started)
+        if syn_data_acked(writer.get_extra_info('socket')):
+            syn_data += 1
+        writer.close()
+
+    rates = []
+    for _ in range(repeat):
+        reader, writer = await open_tunnel()
+        started = time.perf_counter()
+        writer.write(struct.pack('>Q', size))
+        received = 0
+        while received < size:
+            data = await reader.read(1 << 20)
+            if not data:
+                break
+            received += len(data)
+        rates.append(received / (time.perf_counter() - started))
+        writer.close()
+    rates.sort()
+    return sorted(setups), syn_data, rates[len(rates) // 2]
+
+
+def bench_sockets(args):
+    """Upstream socket tuning: tunnel setup latency and bulk throughput against kernel defaults"""
+    origin = StandInServer(stand_in_origin, args.origin_host).start()
+    address = args.origin_address or args.origin_host
+    servers = [origin]
+    if args.proxy:
+        host, _, port = args.proxy.rpartition(':')
+        target = (host.strip('[]'), int(port), args.type)
+        label = f"{args.proxy} ({args.type})"
+    else:
+        proxy = StandInServer(stand_in_proxy, fastopen=True).start()
+        servers.append(proxy)
+        target = ('127.0.0.1', proxy.port, args.type)
+        label = f"stand-in proxy ({args.type})"
+    tuned = SocketTuning.from_env()
+    if args.sndbuf is not None:
+        tuned.sndbuf = args.sndbuf * 1024
+    if args.rcvbuf is not None:
+        tuned.rcvbuf = args.rcvbuf * 1024
+    configurations = [("kernel defaults", None), ("tuned", tuned.copy(fastopen=False))]
+    if tuned.fastopen_supported:
+        configurations.append(("tuned + fast open", tuned.copy(fastopen=True)))
+    print(f"Upstream: {label}; {args.connections} sequential tunnels and {args.repeat} x {args.size} MB "
+          f"downloads per configuration")
+    print(f"Tuned: {tuned.copy(fastopen=False)}")
+
+    results = []
+    try:
+        for name, tuning in configurations:
+            setups, syn_data, rate = asyncio.run(tuned_tunnels(
+                target, (address, origin.port), tuning, args.connections, args.size * 1024 * 1024,
+                args.repeat, args.timeout))
+            results.append((name, setups, syn_data, rate))
+    finally:
+        for server in servers:
+            server.stop()
+
+    print(f"{'configuration':20s} {'p50 ms':>7} {'p90 ms':>7} {'SYN data':>9} {'MB/s':>8}")
+    for name, setups, syn_data, rate in results:
+        print(f"{name:20s} {percentile(setups, 0.5) * 1000:7.2f} {percentile(setups, 0.9) * 1000:7.2f} "
+              f"{syn_data:>4d}/{len(setups):<4d} {rate / (1024 * 1024):8.1f}")
+    base = percentile(results[0][1], 0.5)
+    for name, setups, syn_data, rate in results[1:]:
+        print(f"{name:20s} median setup {(percentile(setups, 0.5) - base) * 1000:+.2f} ms, "
+              f"throughput {(rate / results[0][3] - 1) * 100:+.1f} % vs kernel defaults")
+    if tuned.fastopen_supported and not results[-1][2]:
+        print("No connect carried data in its SYN: Fast Open needs net.ipv4.tcp_fastopen with bit 1 "
+              "on this host and bit 2 on the proxy")
+    return 0
+
+
+def open_descriptors():
+    """Open file descriptors of this process, or None where they cannot be listed"""
+    for path in ('/proc/self/fd', '/dev/fd'):
+        try:
+            return len(os.listdir(path))
+        except OSError:
+            continue
+    return None
+
+
+def quiesce(servers, timeout=2):
+    """Wait for the stand-in servers to finish their connections, then collect garbage"""
+    deadline = time.monotonic() + timeout
+    while any(server._handlers for server in servers) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    gc.collect()
+
+
+def slope(values):
+    """Least-squares change per step of a series"""
+    count = len(values)
+    if count < 2:
+        return 0.0
+    mean_x = (count - 1) / 2
+    mean_y = sum(values) / count
+    covariance = sum((x - mean_x) * (y - mean_y) for x, y in enumerate(values))
+    return covariance / sum((x - mean_x) ** 2 for x in range(count))
+
+
+def relay_cycle(proxy, jump, origin, echo_port, connections):
+    """One relay lifetime: downloads, a UDP association, a switch to a chained upstream, stop"""
+    relay = LocalRelay('127.0.0.1', proxy.port, "SOCKS5", listen_port=0, log=lambda message: None,
+                       shaper=Shaper(max_connections=64))
+    relay.start()
+    try:
+        for _ in range(connections):
+            download(relay.listen_port, origin.port, 4096)
+        udp_round_trips(relay.listen_port, echo_port, 4, 64)
+        # Like a profile switch: warm partial chains are built for the new upstream
+        relay.set_upstream('127.0.0.1', proxy.port, "SOCKS5", [('127.0.0.1', jump.port, "SOCKS5")])
+        for _ in range(connections):
+            download(relay.listen_port, origin.port, 4096)
+    finally:
+        relay.stop()
+
+
+def bench_memory(args):
+    """Soak: memory, threads and descriptors must reach a steady state over many cycles"""
+    proxy = StandInServer(stand_in_proxy).start()
+    jump = StandInServer(stand_in_proxy).start()
+    origin = StandInServer(stand_in_origin).start()
+    echo_port = udp_echo()
+    controller = profile = None
+    if args.system:
+        # Imported here: a real connect/disconnect needs the GUI module's platform code
+        from concurrent.futures import ThreadPoolExecutor
+        from daemon import DaemonController
+        from profiles import Profile
+        controller = DaemonController(lambda message: None, ThreadPoolExecutor(max_workers=1))
+        profile = Profile("soak", '127.0.0.1', proxy.port, "SOCKS5")
+    print(f"{args.cycles} cycles of relay start, {args.connections * 2} tunnels, UDP, upstream switch, stop"
+          + (" and a system proxy connect/disconnect" if args.system else ""))
+
+    servers = (proxy, jump, origin)
+    tracemalloc.start()
+    # Allocated up front, so the bookkeeping itself does not show up as heap growth
+    samples = args.cycles - args.warmup + 1
+    traced, rss, baseline = array('q', [0] * samples), array('q', [0] * samples), None
+    try:
+        for cycle in range(1, args.cycles + 1):
+            relay_cycle(proxy, jump, origin, echo_port, args.connections)
+            if controller:
+                if not controller.apply_profile(profile, use_relay=True) or not controller.release_profile():
+                    print(f"cycle {cycle}: system proxy connect/disconnect failed", file=sys.stderr)
+                    return 1
+            quiesce(servers)
+            if cycle == args.warmup:
+                # Caches, pools and lazy imports have filled by now
+                baseline = (tracemalloc.take_snapshot(), threading.active_count(), open_descriptors())
+            if cycle >= args.warmup:
+                traced[cycle - args.warmup] = tracemalloc.get_traced_memory()[0]
+                rss[cycle - args.warmup] = rss_bytes() or 0
+            if cycle % max(1, args.cycles // 10) == 0:
+                print(f"cycle {cycle:5d}: traced {tracemalloc.get_traced_memory()[0] / 1024:8.0f} KB, "
+                      f"RSS {(rss_bytes() or 0) / 1048576:6.1f} MB, {threading.active_count()} threads, "
+                      f"{open_descriptors()} descriptors", file=sys.stderr)
+        snapshot = tracemalloc.take_snapshot()
+        threads, descriptors = threading.active_count(), open_descriptors()
+    finally:
+        tracemalloc.stop()
+        for server in servers:
+            server.stop()
+
+    measured = samples - 1
+    growth, per_cycle = traced[-1] - traced[0], slope(traced)
+    print(f"{'traced heap':20s} {traced[0] / 1024:8.0f} -> {traced[-1] / 1024:8.0f} KB "
+          f"({per_cycle:+.0f} bytes per cycle)")
+    print(f"{'RSS':20s} {rss[0] / 1048576:8.1f} -> {rss[-1] / 1048576:8.1f} MB "
+          f"({slope(rss) / 1024:+.1f} KB per cycle, includes allocator slack)")
+    print(f"{'threads':20s} {baseline[1]:8d} -> {threads:8d}")
+    print(f"{'descriptors':20s} {baseline[2]!s:>8} -> {descriptors!s:>8}")
+    print("largest growth since warm-up:")
+    # The snapshots and the series above are the bench's own allocations, not the relay's
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+    growing = []
+    for stat in snapshot.filter_traces(ignore).compare_to(baseline[0].filter_traces(ignore), 'lineno')[:5]:
+        frame = stat.traceback[0]
+        where = f"{os.path.basename(frame.filename)}:{frame.lineno}"
+        print(f"  {stat.size_diff / 1024:+8.1f} KB  {stat.count_diff:+6d} blocks  {where}")
+        # Free lists and caches settle within a few blocks; a leak adds at least one per cycle
+        if stat.count_diff >= measured:
+            growing.append(f"{where} {stat.count_diff:+d} blocks")
+
+    problems = []
+    if per_cycle > args.max_slope:
+        problems.append(f"traced heap grows {per_cycle:.0f} bytes per cycle (limit {args.max_slope})")
+    if growing:
+        problems.append(f"live blocks grow every cycle at {', '.join(growing)}")
+    if args.max_growth is not None and growth > args.max_growth * 1024:
+        problems.append(f"traced heap grew {growth / 1024:.0f} KB (limit {args.max_growth} KB)")
+    if threads > baseline[1]:
+        problems.append(f"{threads - baseline[1]} threads left behind")
+    if baseline[2] is not None and descriptors > baseline[2]:
+        problems.append(f"{descriptors - baseline[2]} descriptors left open")
+    print("steady state" if not problems else "not steady: " + "; ".join(problems))
+    return 1 if problems else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PHH VPN local relay benchmarks")
+    sub = parser.add_subparsers(dest='bench', required=True)
+
+    shaping = sub.add_parser('shaping', help="token-bucket shaping overhead and accuracy")
+    shaping.add_argument('--size', type=int, default=256, help="MB per bulk transfer")
+    shaping.add_argument('--repeat', type=int, default=3, help="runs per configuration")
+    shaping.add_argument('--limit', type=int, default=2048, help="rate limit to verify (KB/s)")
+    shaping.set_defaults(func=bench_shaping)
+
+    backpressure = sub.add_parser('backpressure', help="slow client / fast upstream memory stress")
+    backpressure.add_argument('--sizes', type=int, nargs='+', default=[32, 256],
+                              help="transfer sizes in MB, smallest first")
+    backpressure.add_argument('--rate', type=int, default=64, help="client read rate in MB/s")
+    backpressure.set_defaults(func=bench_backpressure)
+
+    chain = sub.add_parser('chain', help="multi-hop tunnel setup latency with warm partial chains")
+    chain.add_argument('--rtt', type=float, default=20, help="simulated round trip per hop in ms")
+    chain.add_argument('--connections', type=int, default=20, help="tunnels to open per configuration")
+    chain.add_argument('--warm', type=int, default=2, help="warm partial chains to keep")
+    chain.set_defaults(func=bench_chain)
+
+    udp = sub.add_parser('udp', help="UDP ASSOCIATE datagram latency and association table bound")
+    udp.add_argument('--count', type=int, default=5000, help="datagrams per configuration")
+    udp.add_argument('--size', type=int, default=64, help="payload bytes (DNS-sized by default)")
+    udp.add_argument('--max-associations', type=int, default=16, help="association table size")
+    udp.set_defaults(func=bench_udp)
+
+    load = sub.add_parser('load', help="ramp connection churn and long-lived connections to find saturation")
+    load.add_argument('--proxy', metavar='HOST:PORT',
+                      help="proxy to load (default: the local relay in front of a stand-in proxy)")
+    load.add_argument('--type', default="SOCKS5", choices=["HTTP/HTTPS", "SOCKS4", "SOCKS5"],
+                      help="protocol spoken to the proxy (the stand-in proxy itself lacks SOCKS4)")
+    load.add_argument('--direct', action='store_true', help="load the stand-in proxy without the local relay")
+    load.add_argument('--rates', type=int, nargs='+', default=[25, 50, 100, 200, 400, 800],
+                      help="new short-lived connections per second, one step each")
+    load.add_argument('--long', type=int, default=50, help="long-lived connections added per step")
+    load.add_argument('--duration', type=float, default=5, help="seconds per step")
+    load.add_argument('--size', type=int, default=16384, help="bytes downloaded per short-lived connection")
+    load.add_argument('--ping-interval', type=float, default=1, help="seconds between long-lived pings")
+    load.add_argument('--timeout', type=float, default=10, help="seconds before a connection counts as failed")
+    load.add_argument('--max-outstanding', type=int, default=4096, help="cap on connections in flight")
+    load.add_argument('--max-error-rate', type=float, default=0.01, help="error rate that marks saturation")
+    load.add_argument('--latency-factor', type=float, default=5,
+                      help="p99 growth over the first step that marks saturation")
+    load.add_argument('--max-p99', type=float, default=1000, metavar='MS',
+                      help="p99 connection time that marks saturation")
+    load.add_argument('--origin-host', default='127.0.0.1',
+                      help="address the stand-in origins listen on (0.0.0.0 for a remote proxy)")
+    load.add_argument('--origin-address', help="address the proxy should connect to (default --origin-host)")
+    load.set_defaults(func=bench_load)
+
+    sockets = sub.add_parser('sockets', help="upstream socket tuning vs kernel defaults: setup latency, throughput")
+    sockets.add_argument('--proxy', metavar='HOST:PORT',
+                         help="proxy to connect through (default: a stand-in proxy; use a real one for real RTTs)")
+    sockets.add_argument('--type', default="SOCKS5", choices=["HTTP/HTTPS", "SOCKS4", "SOCKS5"],
+                         help="protocol spoken to the proxy")
+    sockets.add_argument('--connections', type=int, default=50, help="tunnels opened per configuration")
+    sockets.add_argument('--size', type=int, default=64, help="MB per bulk download")
+    sockets.add_argument('--repeat', type=int, default=3, help="bulk downloads per configuration (median kept)")
+    sockets.add_argument('--sndbuf', type=int, help="SO_SNDBUF in KB for the tuned runs (default UPSTREAM_SNDBUF)")
+    sockets.add_argument('--rcvbuf', type=int, help="SO_RCVBUF in KB for the tuned runs (default UPSTREAM_RCVBUF)")
+    sockets.add_argument('--timeout', type=float, default=10, help="seconds allowed per tunnel")
+    sockets.add_argument('--origin-host', default='127.0.0.1',
+                         help="address the stand-in origin listens on (0.0.0.0 for a remote proxy)")
+    sockets.add_argument('--origin-address', help="address the proxy should connect to (default --origin-host)")
+    sockets.set_defaults(func=bench_sockets)
+
+    memory = sub.add_parser('memory', help="soak: steady-state memory over relay and connect/disconnect cycles")
+    memory.add_argument('--cycles', type=int, default=200, help="relay lifetimes to run")
+    memory.add_argument('--connections', type=int, default=10, help="tunnels per upstream per cycle")
+    memory.add_argument('--warmup', type=int, default=50,
+                        help="cycles before the baseline is taken (asyncio's free lists fill for about 40)")
+    memory.add_argument('--max-slope', type=int, default=64, metavar='BYTES',
+                        help="traced heap trend per cycle after warm-up that counts as a leak")
+    memory.add_argument('--max-growth', type=int, metavar='KB',
+                        help="also fail when the traced heap grows by more than this in total")
+    memory.add_argument('--system', action='store_true',
+                        help="also connect and disconnect the system proxy every cycle (changes your settings)")
+    memory.set_defaults(func=bench_memory)
+
+    args = parser.parse_args()
+    if args.func is bench_memory and args.warmup < 1:
+        parser.error("memory: --warmup must be at least 1 (the baseline is taken after it)")
+    if args.func is bench_memory and args.cycles <= args.warmup:
+        parser.error("memory: --cycles must be greater than --warmup")
+    return args.func(args) or 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Control protocol for the PHH VPN daemon
+Front-ends talk to the per-user daemon over a Unix domain socket, one JSON
+object per line. Every request gets exactly one response; after 'subscribe'
+the connection also carries event objects pushed by the daemon.
+"""
+
+import json
+import os
+import socket
+
+from profiles import config_dir
+
+# Seconds a request may take (connect runs the platform proxy tools)
+REQUEST_TIMEOUT = 120
+
+
+class DaemonError(Exception):
+    """The daemon rejected a request"""
+
+
+def socket_path():
+    """Per-user control socket: PHH_VPN_SOCKET, else the runtime dir, else the config dir"""
+    if os.getenv('PHH_VPN_SOCKET'):
+        return os.getenv('PHH_VPN_SOCKET')
+    return os.path.join(os.getenv('XDG_RUNTIME_DIR') or config_dir(), "phh-vpn.sock")
+
+
+def encode(message):
+    return json.dumps(message, separators=(',', ':')).encode('utf-8') + b'\n'
+
+
+class ControlClient:
+    """Blocking connection to the daemon"""
+
+    def __init__(self, path=None, timeout=REQUEST_TIMEOUT):
+        if not hasattr(socket, 'AF_UNIX'):
+            raise OSError("The daemon needs Unix domain sockets, which this platform lacks")
+        self.path = path or socket_path()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        try:
+            self.sock.connect(self.path)
+        except OSError:
+            self.sock.close()
+            raise
+        self.file = self.sock.makefile('rb')
+        self._next_id = 0
+        self.pending_events = []
+
+    def _read(self):
+        line = self.file.readline()
+        if not line:
+            raise ConnectionError("Daemon closed the connection")
+        return json.loads(line)
+
+    def request(self, command, **params):
+        """Send one request and return its result, raising DaemonError on failure"""
+        self._next_id += 1
+        self.sock.sendall(encode(dict(params, id=self._next_id, command=command)))
+        while True:
+            message = self._read()
+            if 'event' in message:
+                # Events may arrive before the response on a subscribed connection
+                self.pending_events.append(message)
+                continue
+            if message.get('id') != self._next_id:
+                continue
+            if not message.get('ok'):
+                raise DaemonError(message.get('error', "request failed"))
+            return message.get('result')
+
+    def subscribe(self):
+        """Yield events pushed by the daemon until it goes away"""
+        self.request('subscribe')
+        self.sock.settimeout(None)
+        while True:
+            while self.pending_events:
+                yield self.pending_events.pop(0)
+            message = self._read()
+            if 'event' in message:
+                yield message
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def request(command, path=None, **params):
+    """One-shot request to the daemon"""
+    with ControlClient(path) as client:
+        return client.request(command, **params)
+
+
+def daemon_running(path=None):
+    """True if a daemon answers on the control socket"""
+    try:
+        with ControlClient(path, timeout=2) as client:
+            client.request('ping')
+        return True
+    except (OSError, ValueError, DaemonError):
+        return False
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""
+Resident daemon for the PHH VPN Client
+Owns the connection state (system proxy settings, local relay, network
+watcher) for the user session and serves the control protocol from
+control.py, so the GUI, the CLI and scripts drive one connection instead of
+each applying proxy settings of their own.
+"""
+
+import asyncio
+import json
+import os
+import signal
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from control import REQUEST_TIMEOUT, daemon_running, encode, socket_path
+from profiles import Profile, ProfileStore
+from relay import LocalRelay, RELAY_HOST, RELAY_PORT
+from shaping import Shaper
+from vpn_app import VPNApp, launch_profile
+
+# Seconds between relay traffic samples (the GUI refresh rate)
+SAMPLE_INTERVAL = 1.0
+
+# Bytes of unread events after which a subscriber is dropped
+MAX_EVENT_BACKLOG = 1024 * 1024
+
+# Longest request line accepted
+MAX_REQUEST = 64 * 1024
+
+
+class DaemonController(VPNApp):
+    """Connection state of VPNApp without a window; runs on the daemon's worker thread"""
+
+    def __init__(self, log, worker):
+        self.root = None
+        self.init_state()
+        self.daemon = None
+        self.relay_port = os.getenv('RELAY_PORT', str(RELAY_PORT))
+        self._log = log
+        self.worker = worker
+
+    def log(self, message):
+        self._log(message)
+
+    def log_threadsafe(self, message):
+        # The daemon log is thread-safe; queueing behind the running command would reorder it
+        self._log(message)
+
+    def call_soon(self, func, *args):
+        self.worker.submit(func, *args)
+
+    def start_relay(self, ip, port, proxy_type, via=()):
+        self.relay = LocalRelay(ip, port, proxy_type, RELAY_HOST, self.relay_port,
+                                log=self.log_threadsafe, shaper=Shaper.from_env(), via=via,
+                                tuning=self.tuning, auth=self.auth)
+        self.relay.start()
+        return RELAY_HOST, str(self.relay.listen_port)
+
+    def stop_relay(self):
+        if self.relay:
+            self.relay.stop()
+            self.relay = None
+
+
+def resolve_profile(profile):
+    """Profile from a request: a saved profile name, a profile dict, or None for the default"""
+    if profile is None:
+        return launch_profile()
+    if isinstance(profile, str):
+        return ProfileStore().get(profile)
+    if isinstance(profile, dict):
+        data = dict(profile)
+        return Profile.from_dict(data.pop('name', None) or "manual", data)
+    raise ValueError("profile must be a name or an object")
+
+
+class ProxyDaemon:
+    """Control socket server around a DaemonController"""
+
+    def __init__(self, path=None, log=None):
+        self.path = path or socket_path()
+        self._print = log or (lambda line: print(line, file=sys.stderr, flush=True))
+        # One worker thread: connection changes never interleave, whoever asks
+        self.worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix="phh-daemon")
+        self.controller = DaemonController(self.log, self.worker)
+        self.subscribers = set()
+        self.loop = None
+        self.server = None
+        self.stopping = None
+        self.commands = {
+            'ping': self.ping,
+            'status': self.status,
+            'stats': self.stats,
+            'memory': self.memory,
+            'connect': self.connect,
+            'disconnect': self.disconnect,
+            'switch': self.switch,
+            'subscribe': self.subscribe,
+            'shutdown': self.shutdown,
+        }
+
+    def log(self, message):
+        """Print a log line and forward it to subscribers; callable from any thread"""
+        self._print(f"[{time.strftime('%H:%M:%S')}] {message}")
+        if self.loop and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.publish, {'event': 'log', 'message': message})
+
+    def publish(self, event):
+        data = encode(event)
+        for writer in list(self.subscribers):
+            if writer.is_closing() or writer.transport.get_write_buffer_size() > MAX_EVENT_BACKLOG:
+                # A subscriber that stopped reading must not make the daemon buffer forever
+                self.subscribers.discard(writer)
+                writer.close()
+                continue
+            writer.write(data)
+
+    def run(self):
+        """Serve until shutdown is requested or a termination signal arrives"""
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        if not hasattr(asyncio, 'start_unix_server'):
+            raise RuntimeError("The daemon needs Unix domain sockets, which this platform lacks")
+        if daemon_running(self.path):
+            raise RuntimeError(f"A daemon is already running on {self.path}")
+        if os.path.exists(self.path):
+            # Left behind by a daemon that did not shut down cleanly
+            os.unlink(self.path)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), mode=0o700, exist_ok=True)
+
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        # Only the owning user may drive the connection
+        umask = os.umask(0o177)
+        try:
+            self.server = await asyncio.start_unix_server(self.handle_client, self.path,
+                                                          limit=MAX_REQUEST)
+        finally:
+            os.umask(umask)
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            self.loop.add_signal_handler(signum, self.stopping.set)
+        sampler = asyncio.create_task(self.sample_traffic())
+        memory_sampler = asyncio.create_task(self.sample_memory())
+        self.log(f"Daemon listening on {self.path} (pid {os.getpid()})")
+        try:
+            await self.stopping.wait()
+        finally:
+            sampler.cancel()
+            memory_sampler.cancel()
+            self.controller.memory.stop()
+            self.server.close()
+            await self.server.wait_closed()
+            await self.loop.run_in_executor(self.worker, self.release)
+            self.worker.shutdown()
+            for writer in list(self.subscribers):
+                writer.close()
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+            self.log("Daemon stopped")
+
+    def release(self):
+        """Undo the proxy settings on the way out so nothing points at a stopped relay"""
+        if self.controller.is_connected:
+            self.controller.release_profile()
+        self.controller.stop_relay()
+
+    async def sample_traffic(self):
+        while True:
+            await asyncio.sleep(SAMPLE_INTERVAL)
+            relay = self.controller.relay
+            if relay and relay.running:
+                relay.meter.sample()
+
+    async def sample_memory(self):
+        memory = self.controller.memory
+        # Off the event loop: a tracemalloc snapshot of a large heap takes a while
+        await self.loop.run_in_executor(None, memory.start)
+        while True:
+            warning = await self.loop.run_in_executor(None, memory.sample)
+            if warning:
+                self.log(f"Warning: {warning}")
+            await asyncio.sleep(memory.interval)
+
+    async def handle_client(self, reader, writer):
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    writer.write(encode({'ok': False, 'error': "request too long"}))
+                    break
+                if not line:
+                    break
+                writer.write(encode(await self.dispatch(line, writer)))
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            # Cancelled when the daemon stops with the connection still open
+            pass
+        finally:
+            self.subscribers.discard(writer)
+            writer.close()
+
+    async def dispatch(self, line, writer):
+        """Run one request line and build its response"""
+        request_id = None
+        try:
+            message = json.loads(line)
+            if not isinstance(message, dict):
+                raise ValueError("request must be a JSON object")
+            request_id = message.pop('id', None)
+            command = self.commands.get(message.pop('command', None))
+            if command is None:
+                raise ValueError("unknown command")
+            if command == self.subscribe:
+                result = self.subscribe(writer)
+            elif asyncio.iscoroutinefunction(command):
+                result = await command(**message)
+            else:
+                result = await asyncio.wait_for(
+                    self.loop.run_in_executor(self.worker, lambda: command(**message)), REQUEST_TIMEOUT)
+        except KeyError as e:
+            return {'id': request_id, 'ok': False, 'error': str(e.args[0])}
+        except Exception as e:
+            return {'id': request_id, 'ok': False, 'error': str(e) or type(e).__name__}
+        return {'id': request_id, 'ok': True, 'result': result}
+
+    # Commands below run on the worker thread unless they are coroutines
+
+    async def ping(self):
+        return {'pid': os.getpid()}
+
+    def status(self):
+        return self.controller.status()
+
+    def stats(self):
+        relay = self.controller.relay
+        if not relay or not relay.running:
+            return {'relay': None, 'memory': self.memory()}
+        return {
+            'relay': relay.meter.snapshot(),
+            'warm_chains': {'hits': relay.warm.hits, 'misses': relay.warm.misses},
+            'udp': {'active': len(relay.udp.active), 'evicted': relay.udp.evicted},
+            'memory': self.memory(),
+        }
+
+    def memory(self):
+        return self.controller.memory.snapshot()
+
+    def use_credentials(self, profile, credentials):
+        """Keep a login sent with a request for this daemon's lifetime"""
+        if credentials is None:
+            return
+        if not isinstance(credentials, dict) or not credentials.get('username'):
+            raise ValueError("credentials must be an object with a username")
+        self.controller.credentials.set(profile.proxy_ip, profile.proxy_port,
+                                        str(credentials['username']), str(credentials.get('password', '')))
+
+    def connect(self, profile=None, relay=None, credentials=None):
+        controller = self.controller
+        if controller.is_connected:
+            raise ValueError("Already connected to proxy")
+        profile = resolve_profile(profile)
+        self.use_credentials(profile, credentials)
+        if relay is None:
+            relay = os.getenv('USE_RELAY', '0') == '1'
+        if not controller.apply_profile(profile, bool(relay)):
+            raise RuntimeError("Failed to configure proxy; see the daemon log")
+        controller.log(f"Connected to profile {profile}")
+        return self.state_changed()
+
+    def disconnect(self):
+        controller = self.controller
+        if not controller.is_connected:
+            raise ValueError("Not connected to proxy")
+        if not controller.release_profile():
+            raise RuntimeError("Failed to remove the proxy configuration; see the daemon log")
+        controller.log("Disconnected from proxy")
+        return self.state_changed()
+
+    def switch(self, profile, credentials=None):
+        if not self.controller.is_connected:
+            raise ValueError("Not connected to proxy")
+        profile = resolve_profile(profile)
+        self.use_credentials(profile, credentials)
+        self.controller.switch_system_proxy(profile)
+        return self.state_changed()
+
+    def state_changed(self):
+        """Tell subscribers about the new state and return it"""
+        status = self.controller.status()
+        self.loop.call_soon_threadsafe(self.publish, {'event': 'state', 'status': status})
+        return status
+
+    def subscribe(self, writer):
+        self.subscribers.add(writer)
+        return {'subscribed': True}
+
+    async def shutdown(self):
+        self.loop.call_soon(self.stopping.set)
+        return {'stopping': True}
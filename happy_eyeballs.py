@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+Happy Eyeballs (RFC 8305) dual-stack connects for the PHH VPN Client
+Resolves a host to all of its A/AAAA records, interleaves the address
+families and races staggered connection attempts, keeping the first one
+that succeeds. The winning family is remembered per host:port so the next
+connect tries it first. Both an asyncio and a blocking (selectors) variant
+are provided.
+"""
+
+import asyncio
+import errno
+import os
+import selectors
+import socket
+import time
+from collections import OrderedDict
+
+# Delay before starting the next attempt while earlier ones are pending (RFC 8305 section 5)
+CONNECTION_ATTEMPT_DELAY = 0.25
+
+# Upper bound on remembered host:port -> address family entries
+MAX_REMEMBERED = 256
+
+# Seconds allowed for the blocking variant
+DEFAULT_TIMEOUT = 5
+
+_preferred_families = OrderedDict()
+
+
+def preferred_family(host, port):
+    """Address family that last won for host:port, or None"""
+    return _preferred_families.get((host, int(port)))
+
+
+def remember_family(host, port, family):
+    key = (host, int(port))
+    _preferred_families[key] = family
+    _preferred_families.move_to_end(key)
+    if len(_preferred_families) > MAX_REMEMBERED:
+        _preferred_families.popitem(last=False)
+
+
+def order_addresses(infos, preferred=None):
+    """Interleave getaddrinfo results by family, starting with the preferred one"""
+    by_family = OrderedDict()
+    seen = set()
+    for info in infos:
+        if info[4] in seen:
+            continue
+        seen.add(info[4])
+        by_family.setdefault(info[0], []).append(info)
+    if preferred in by_family:
+        by_family.move_to_end(preferred, last=False)
+    queues = list(by_family.values())
+    ordered = []
+    while queues:
+        for queue in list(queues):
+            ordered.append(queue.pop(0))
+            if not queue:
+                queues.remove(queue)
+    return ordered
+
+
+def attempt_tunings(addresses, tuning, preferred=None):
+    """Socket tuning for each ordered address: Fast Open only where there is no race to lose"""
+    if not tuning or not tuning.fastopen:
+        return [tuning] * len(addresses)
+    # A Fast Open connect() returns before the handshake, so it would win the race even
+    # against a dead address; keep it for a lone address or the family that won last time
+    plain = tuning.copy(fastopen=False)
+    trusted = len(addresses) == 1 or (addresses and addresses[0][0] == preferred)
+    return [tuning if i == 0 and trusted else plain for i in range(len(addresses))]
+
+
+def _combined_error(errors, host, port):
+    if not errors:
+        return OSError(f"No addresses found for {host}:{port}")
+    if len({str(e) for e in errors}) == 1:
+        return errors[0]
+    return OSError(f"All connection attempts to {host}:{port} failed: "
+                   + "; ".join(str(e) for e in errors))
+
+
+async def _attempt(loop, info, tuning=None):
+    family, sock_type, proto, _, address = info
+    sock = socket.socket(family, sock_type, proto)
+    try:
+        if tuning:
+            tuning.apply(sock)
+        sock.setblocking(False)
+        await loop.sock_connect(sock, address)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+async def connect(host, port, delay=CONNECTION_ATTEMPT_DELAY, tuning=None):
+    """Race staggered connects to every address of host; returns a connected non-blocking socket"""
+    loop = asyncio.get_running_loop()
+    infos = await loop.getaddrinfo(host, int(port), type=socket.SOCK_STREAM)
+    preferred = preferred_family(host, port)
+    addresses = order_addresses(infos, preferred)
+    tunings = attempt_tunings(addresses, tuning, preferred)
+    pending = []
+    errors = []
+    winner = None
+    try:
+        while addresses or pending:
+            if addresses:
+                pending.append(loop.create_task(_attempt(loop, addresses.pop(0), tunings.pop(0))))
+            done, _ = await asyncio.wait(pending, timeout=delay if addresses else None,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            # A finished attempt (success or failure) ends the wait for the next start early
+            for task in done:
+                pending.remove(task)
+                if task.exception() is not None:
+                    errors.append(task.exception())
+                elif winner is None:
+                    winner = task.result()
+                else:
+                    task.result().close()
+            if winner:
+                remember_family(host, port, winner.family)
+                return winner
+        raise _combined_error(errors, host, port)
+    finally:
+        for task in pending:
+            task.cancel()
+        for result in await asyncio.gather(*pending, return_exceptions=True):
+            if isinstance(result, socket.socket):
+                result.close()
+
+
+def connect_sync(host, port, timeout=DEFAULT_TIMEOUT, delay=CONNECTION_ATTEMPT_DELAY, tuning=None):
+    """Blocking Happy Eyeballs connect; returns a connected socket with the given timeout"""
+    deadline = time.monotonic() + timeout
+    infos = socket.getaddrinfo(host, int(port), type=socket.SOCK_STREAM)
+    preferred = preferred_family(host, port)
+    addresses = order_addresses(infos, preferred)
+    tunings = attempt_tunings(addresses, tuning, preferred)
+    selector = selectors.DefaultSelector()
+    errors = []
+    next_start = 0.0
+    try:
+        while addresses or selector.get_map():
+            now = time.monotonic()
+            if now >= deadline:
+                raise socket.timeout(f"Connection to {host}:{port} timed out")
+            if addresses and (now >= next_start or not selector.get_map()):
+                family, sock_type, proto, _, address = addresses.pop(0)
+                attempt_tuning = tunings.pop(0)
+                sock = socket.socket(family, sock_type, proto)
+                if attempt_tuning:
+                    attempt_tuning.apply(sock)
+                sock.setblocking(False)
+                error = sock.connect_ex(address)
+                if error == 0:
+                    sock.settimeout(timeout)
+                    remember_family(host, port, family)
+                    return sock
+                if error in (errno.EINPROGRESS, errno.EWOULDBLOCK, getattr(errno, 'WSAEWOULDBLOCK', -1)):
+                    selector.register(sock, selectors.EVENT_WRITE, address)
+                    next_start = now + delay
+                else:
+                    errors.append(OSError(error, f"{address[0]}: {os.strerror(error)}"))
+                    sock.close()
+                continue
+            wait = deadline - now
+            if addresses:
+                wait = min(wait, next_start - now)
+            for key, _ in selector.select(max(wait, 0)):
+                sock = key.fileobj
+                selector.unregister(sock)
+                error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if error == 0:
+                    sock.settimeout(timeout)
+                    remember_family(host, port, sock.family)
+                    return sock
+                errors.append(OSError(error, f"{key.data[0]}: {os.strerror(error)}"))
+                sock.close()
+                # A failed attempt starts the next one immediately
+                next_start = 0.0
+        raise _combined_error(errors, host, port)
+    finally:
+        for key in list(selector.get_map().values()):
+            key.fileobj.close()
+        selector.close()
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""
+Shared proxy health (probe result) cache for the PHH VPN Client
+Results are keyed by (upstream, protocol, target), served while fresh,
+served stale while a background refresh runs, and probed at most once at a
+time per key. The cache is persisted in the per-user config directory so
+the GUI, the CLI and later runs all see the last-known health.
+"""
+
+import asyncio
+import json
+import os
+import threading
+import time
+import urllib.parse
+from concurrent.futures import Future
+
+import happy_eyeballs
+import upstream
+from profiles import config_dir, write_json_atomic
+
+# Seconds a result is fresh (returned without probing)
+DEFAULT_TTL = 60
+
+# Seconds a result may still be returned while it is refreshed in the background
+DEFAULT_STALE_TTL = 600
+
+# Seconds a failed result is fresh; failures are never served stale, so a proxy
+# that comes back is noticed on the next lookup after this
+DEFAULT_FAILURE_TTL = 5
+
+# Upper bound on cached results (oldest are dropped)
+MAX_ENTRIES = 1024
+
+# Page fetched through HTTP proxies to prove they forward requests
+HTTP_TEST_URL = 'http://httpbin.org/ip'
+
+# Destination tunnelled to through a chain of jump hops (port 443, which every proxy lets CONNECT reach)
+CHAIN_TEST_TARGET = ('httpbin.org', 443)
+
+
+class ProbeResult:
+    """Outcome of one probe"""
+    __slots__ = ('ok', 'latency_ms', 'detail', 'checked')
+
+    def __init__(self, ok, latency_ms=None, detail='', checked=None):
+        self.ok = ok
+        self.latency_ms = latency_ms
+        self.detail = detail
+        # Wall clock time, so results stay meaningful across runs
+        self.checked = time.time() if checked is None else checked
+
+    def age(self, now=None):
+        return (time.time() if now is None else now) - self.checked
+
+    def to_dict(self):
+        return {'ok': self.ok, 'latency_ms': self.latency_ms,
+                'detail': self.detail, 'checked': self.checked}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(bool(data['ok']), data.get('latency_ms'), data.get('detail', ''), float(data['checked']))
+
+    def __str__(self):
+        if not self.ok:
+            return f"FAILED ({self.detail})" if self.detail else "FAILED"
+        latency = f", {self.latency_ms:.0f} ms" if self.latency_ms is not None else ""
+        return f"OK{latency}"
+
+
+def probe_key(upstream, protocol, target=''):
+    """Cache key for a probe of upstream ('host:port') speaking protocol towards target"""
+    return f"{upstream}|{protocol}|{target}"
+
+
+def chain_name(hops):
+    """'host:port' of each hop of a chain, in order, for probe keys and logs"""
+    return ",".join(f"{ip}:{port}" for ip, port, _ in hops)
+
+
+def format_age(seconds):
+    """Human readable age of a result"""
+    if seconds < 60:
+        return f"{seconds:.0f} s ago"
+    if seconds < 3600:
+        return f"{seconds / 60:.0f} min ago"
+    if seconds < 86400:
+        return f"{seconds / 3600:.0f} h ago"
+    return f"{seconds / 86400:.0f} days ago"
+
+
+def tcp_probe(ip, port, timeout=5, tuning=None):
+    """Can a TCP connection to the proxy be opened?"""
+    if tuning and tuning.fastopen:
+        # A Fast Open connect returns before the handshake, which is what is being probed
+        tuning = tuning.copy(fastopen=False)
+    started = time.monotonic()
+    try:
+        sock = happy_eyeballs.connect_sync(ip, port, timeout=timeout, tuning=tuning)
+    except OSError as e:
+        return ProbeResult(False, detail=str(e))
+    address = sock.getpeername()[0]
+    sock.close()
+    return ProbeResult(True, (time.monotonic() - started) * 1000.0, address)
+
+
+def http_probe(proxy_ip, proxy_port, url=HTTP_TEST_URL, timeout=10, hop_auth=None, tuning=None):
+    """Does the proxy forward a plain HTTP request? hop_auth answers a 407 once"""
+    host = urllib.parse.urlsplit(url).netloc
+    head = f"GET {url} HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n".encode('latin-1')
+
+    async def fetch():
+        # Connected the way the relay connects: Happy Eyeballs with the profile's socket options
+        for attempt in range(2):
+            reader, writer = await upstream.open_connection(proxy_ip, proxy_port, timeout, tuning)
+            try:
+                if hop_auth:
+                    response = await upstream.send_request(reader, writer, head, hop_auth, final=attempt > 0)
+                else:
+                    writer.write(head)
+                    await writer.drain()
+                    response = await upstream.read_http_head(reader)
+                status_line, status, _ = upstream.parse_response_head(response)
+                if status == 407:
+                    raise ConnectionError(f"Proxy rejected the credentials: {status_line}" if hop_auth
+                                          else "Proxy requires authentication; no credentials are set for it")
+                if not 200 <= status < 300:
+                    raise ConnectionError(f"Proxy answered {status_line}")
+                return await reader.read(512)
+            except upstream.AuthRetry:
+                continue
+            finally:
+                writer.close()
+
+    started = time.monotonic()
+    try:
+        data = asyncio.run(asyncio.wait_for(fetch(), timeout))
+    except (OSError, ConnectionError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as e:
+        return ProbeResult(False, detail=str(e) or type(e).__name__)
+    return ProbeResult(True, (time.monotonic() - started) * 1000.0,
+                       data.decode('utf-8', 'replace').strip()[:100])
+
+
+def chain_probe(hops, target=CHAIN_TEST_TARGET, timeout=10, tuning=None, auth=None):
+    """Does a tunnel to target open through every hop of the chain?"""
+    async def run():
+        reader, writer = await upstream.open_chain(hops, target[0], target[1], timeout, tuning, auth)
+        writer.close()
+
+    started = time.monotonic()
+    try:
+        asyncio.run(run())
+    except (OSError, ConnectionError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as e:
+        return ProbeResult(False, detail=str(e) or type(e).__name__)
+    return ProbeResult(True, (time.monotonic() - started) * 1000.0, f"{target[0]}:{target[1]}")
+
+
+class ProbeCache:
+    """Probe results with TTL, stale-while-revalidate and in-flight deduplication"""
+
+    def __init__(self, path=None, ttl=DEFAULT_TTL, stale_ttl=DEFAULT_STALE_TTL,
+                 max_entries=MAX_ENTRIES, autoload=True, failure_ttl=DEFAULT_FAILURE_TTL):
+        self.path = path or os.path.join(config_dir(), "probe-cache.json")
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.failure_ttl = failure_ttl
+        self.max_entries = max_entries
+        self.entries = {}
+        self._inflight = {}
+        self._lock = threading.Lock()
+        if autoload:
+            self.load()
+
+    def load(self):
+        """Read persisted results; a missing or damaged file just means an empty cache"""
+        self.entries = self._read()
+
+    def _read(self):
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        entries = {}
+        for key, value in data.items():
+            try:
+                entries[key] = ProbeResult.from_dict(value)
+            except (KeyError, TypeError, ValueError):
+                continue
+        return entries
+
+    def save(self):
+        """Persist results, keeping newer ones written meanwhile by other processes"""
+        with self._lock:
+            merged = self._read()
+            for key, result in self.entries.items():
+                if key not in merged or merged[key].checked < result.checked:
+                    merged[key] = result
+            self.entries = merged
+            self._trim()
+            data = {key: result.to_dict() for key, result in self.entries.items()}
+        write_json_atomic(self.path, data)
+
+    def _trim(self):
+        if len(self.entries) > self.max_entries:
+            keep = sorted(self.entries.items(), key=lambda item: item[1].checked)[-self.max_entries:]
+            self.entries = dict(keep)
+
+    def get(self, key):
+        """Last known result for key (any age), or None"""
+        return self.entries.get(key)
+
+    def put(self, key, result, persist=True):
+        with self._lock:
+            self.entries[key] = result
+            self._trim()
+        if persist:
+            try:
+                self.save()
+            except OSError:
+                pass
+
+    def lookup(self, key, probe, max_age=None, on_refresh=None):
+        """Fresh result from the cache, stale result plus background refresh, or a new probe"""
+        result = self.entries.get(key)
+        fresh_for = self.ttl if max_age is None else max_age
+        if result is not None and not result.ok:
+            fresh_for = min(fresh_for, self.failure_ttl)
+        if result is not None:
+            age = result.age()
+            if age <= fresh_for:
+                return result
+            if age <= self.stale_ttl and max_age is None and result.ok:
+                self._start(key, probe, background=True, on_done=on_refresh)
+                return result
+        return self._start(key, probe).result()
+
+    def _start(self, key, probe, background=False, on_done=None):
+        """Run probe for key unless one is already running; returns its future"""
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                return future
+            future = self._inflight[key] = Future()
+        if background:
+            threading.Thread(target=self._run, args=(key, probe, future, on_done), daemon=True).start()
+        else:
+            self._run(key, probe, future, on_done)
+        return future
+
+    def _run(self, key, probe, future, on_done):
+        try:
+            result = probe()
+        except Exception as e:
+            with self._lock:
+                self._inflight.pop(key, None)
+            future.set_exception(e)
+            return
+        self.put(key, result)
+        with self._lock:
+            self._inflight.pop(key, None)
+        future.set_result(result)
+        if on_done:
+            on_done(key, result)
+
+    def record_scan(self, results, target):
+        """Store scanner results: TCP reachability plus one entry per probed protocol"""
+        target = f"{target[0]}:{target[1]}"
+        now = time.time()
+        for scan in results:
+            upstream = f"{scan.host}:{scan.port}"
+            self.put(probe_key(upstream, 'tcp'),
+                     ProbeResult(scan.reachable, scan.connect_ms, scan.error or '', now), persist=False)
+            for proxy_type, latency in scan.protocols.items():
+                self.put(probe_key(upstream, proxy_type, target),
+                         ProbeResult(True, latency, '', now), persist=False)
+        self.save()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Memory instrumentation for the PHH VPN Client
+A client left running for weeks samples its resident set size every minute,
+keeps a bounded history to report the growth trend, and warns once when it
+passes its memory budget. With tracing on, each sample also lists the
+allocation sites (tracemalloc) that grew most since tracing started, which
+points at a leak without attaching a debugger.
+"""
+
+import os
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from collections import deque
+
+from traffic import format_bytes
+
+# Seconds between samples in long-running mode
+SAMPLE_INTERVAL = 60
+
+# Samples kept for the growth trend (a day at the default interval)
+HISTORY_SIZE = 1440
+
+# Allocation sites reported per sample
+TOP_ALLOCATIONS = 10
+
+# After a warning, RSS must drop below this share of the budget to warn again
+BUDGET_REARM = 0.9
+
+# Samples needed before a growth trend is reported (ten minutes at the default interval)
+MIN_TREND_SAMPLES = 10
+
+# Allocations made by the instrumentation itself are not interesting
+_TRACE_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+if sys.platform == 'win32':
+    import ctypes
+    from ctypes import wintypes
+
+    class _ProcessMemoryCounters(ctypes.Structure):
+        _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                    ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                    ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                    ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                    ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+
+
+def rss_bytes():
+    """Current resident set size of this process, or None where it cannot be read"""
+    if sys.platform.startswith('linux'):
+        try:
+            with open('/proc/self/statm', 'rb') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, IndexError):
+            return None
+    if sys.platform == 'win32':
+        counters = _ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        kernel32, psapi = ctypes.windll.kernel32, ctypes.windll.psapi
+        kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+        psapi.GetProcessMemoryInfo.argtypes = [wintypes.HANDLE, ctypes.POINTER(_ProcessMemoryCounters),
+                                               wintypes.DWORD]
+        if not psapi.GetProcessMemoryInfo(kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+            return None
+        return counters.WorkingSetSize
+    # macOS and other BSDs: the standard library only exposes the peak, so ask ps (KB)
+    try:
+        output = subprocess.run(['ps', '-o', 'rss=', '-p', str(os.getpid())], capture_output=True,
+                                text=True, timeout=5).stdout
+        return int(output.strip()) * 1024
+    except (OSError, ValueError, subprocess.TimeoutExpired):
+        return None
+
+
+class MemoryMonitor:
+    """RSS samples with a growth trend and budget, plus tracemalloc top allocation sites"""
+
+    def __init__(self, budget=0, trace=False, top=TOP_ALLOCATIONS, interval=SAMPLE_INTERVAL,
+                 history_size=HISTORY_SIZE, frames=1):
+        # Bytes; 0 means no budget
+        self.budget = int(budget)
+        self.interval = interval
+        self.trace = trace
+        self.top = top
+        self.frames = frames
+        self.samples = deque(maxlen=history_size)
+        self.peak_rss = 0
+        self.warnings = 0
+        self.over_budget = False
+        self.top_allocations = []
+        self.started = time.monotonic()
+        self._baseline = None
+        self._owns_tracing = False
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        """Build from MEMORY_BUDGET (MB, 0 = none), MEMORY_TRACE, MEMORY_TOP and MEMORY_INTERVAL (s)"""
+        return cls(budget=int(os.getenv('MEMORY_BUDGET', '0') or 0) * 1024 * 1024,
+                   trace=os.getenv('MEMORY_TRACE', '0') == '1',
+                   top=int(os.getenv('MEMORY_TOP', str(TOP_ALLOCATIONS)) or TOP_ALLOCATIONS),
+                   interval=max(1.0, float(os.getenv('MEMORY_INTERVAL', '0') or SAMPLE_INTERVAL)))
+
+    def start(self):
+        """Start tracing allocations if asked; the first snapshot is the baseline for growth"""
+        if not self.trace:
+            return
+        if not tracemalloc.is_tracing():
+            # Tracing costs CPU and roughly doubles small-object memory, so it is opt-in
+            tracemalloc.start(self.frames)
+            self._owns_tracing = True
+        self._baseline = tracemalloc.take_snapshot().filter_traces(_TRACE_FILTERS)
+
+    def stop(self):
+        if self._owns_tracing:
+            tracemalloc.stop()
+            self._owns_tracing = False
+        self._baseline = None
+
+    def sample(self):
+        """Record one sample; returns a warning when RSS first goes over the budget, else None"""
+        rss = rss_bytes()
+        top = self._top_allocations() if self._baseline is not None else []
+        with self._lock:
+            if rss is not None:
+                self.samples.append((time.monotonic(), rss))
+                self.peak_rss = max(self.peak_rss, rss)
+            if top:
+                self.top_allocations = top
+            if not self.budget or rss is None:
+                return None
+            if rss < self.budget * BUDGET_REARM:
+                self.over_budget = False
+            if rss <= self.budget or self.over_budget:
+                return None
+            self.over_budget = True
+            self.warnings += 1
+        warning = f"Memory use {format_bytes(rss)} is over the {format_bytes(self.budget)} budget"
+        site = max(top, key=lambda entry: entry['growth'], default=None)
+        if site and site['growth'] > 0:
+            warning += f"; largest growth {format_bytes(site['growth'])} at {site['where']}"
+        return warning
+
+    def _top_allocations(self):
+        snapshot = tracemalloc.take_snapshot().filter_traces(_TRACE_FILTERS)
+        # Sorted by absolute growth: a leak shows up first however small each object is
+        stats = snapshot.compare_to(self._baseline, 'lineno')
+        top = []
+        for stat in stats[:self.top]:
+            frame = stat.traceback[0]
+            top.append({'where': f"{os.path.basename(frame.filename)}:{frame.lineno}",
+                        'size': stat.size, 'growth': stat.size_diff, 'count': stat.count})
+        return top
+
+    def growth_rate(self):
+        """RSS growth in bytes per hour over the kept samples (least squares), or None"""
+        with self._lock:
+            samples = list(self.samples)
+        if len(samples) < MIN_TREND_SAMPLES or samples[-1][0] - samples[0][0] <= 0:
+            return None
+        t0 = samples[0][0]
+        mean_t = sum(t - t0 for t, _ in samples) / len(samples)
+        mean_rss = sum(rss for _, rss in samples) / len(samples)
+        variance = sum((t - t0 - mean_t) ** 2 for t, _ in samples)
+        if not variance:
+            return None
+        covariance = sum((t - t0 - mean_t) * (rss - mean_rss) for t, rss in samples)
+        return covariance / variance * 3600.0
+
+    def snapshot(self):
+        """Plain dict view for status/metrics output"""
+        with self._lock:
+            rss = self.samples[-1][1] if self.samples else None
+            result = {
+                'rss': rss,
+                'peak_rss': self.peak_rss or None,
+                'budget': self.budget or None,
+                'over_budget': self.over_budget,
+                'warnings': self.warnings,
+                'samples': len(self.samples),
+                'uptime': time.monotonic() - self.started,
+                'top_allocations': list(self.top_allocations),
+            }
+        result['growth_per_hour'] = self.growth_rate()
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            result['traced'] = {'current': current, 'peak': peak}
+        return result
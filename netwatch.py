@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+"""
+Network change watcher for the PHH VPN Client
+Blocks on OS change notifications (rtnetlink and NetworkManager signals via
+`nmcli monitor` on Linux, `route -n monitor` on macOS, NotifyAddrChange on
+Windows) instead of polling, and reports each burst of changes once it has
+settled. An idle watcher costs no CPU and no timer wakeups.
+"""
+
+import os
+import platform
+import select
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+# Quiet period that ends a burst of change events (Wi-Fi roam, dock, resume)
+DEBOUNCE_SECONDS = 2.0
+
+# Seconds after the app's own settings writes during which their echo events are dropped
+SELF_CHANGE_GRACE = 2.0
+
+# rtnetlink multicast groups and message types (linux/rtnetlink.h)
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+RTMGRP_IPV6_IFADDR = 0x100
+RTNETLINK_GROUPS = RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV4_ROUTE | RTMGRP_IPV6_IFADDR
+
+RTM_KINDS = {
+    16: 'link', 17: 'link',        # RTM_NEWLINK / RTM_DELLINK
+    20: 'address', 21: 'address',  # RTM_NEWADDR / RTM_DELADDR
+    24: 'route', 25: 'route',      # RTM_NEWROUTE / RTM_DELROUTE
+}
+
+# struct nlmsghdr: length, type, flags, sequence, port id
+NLMSG_HEADER = struct.Struct('=IHHII')
+
+# `route -n monitor` message names on macOS
+ROUTE_MONITOR_KINDS = {
+    'RTM_IFINFO': 'link',
+    'RTM_NEWADDR': 'address', 'RTM_DELADDR': 'address',
+    'RTM_ADD': 'route', 'RTM_DELETE': 'route', 'RTM_CHANGE': 'route',
+}
+
+# Win32 status and wait codes used with the overlapped NotifyAddrChange
+ERROR_IO_PENDING = 997
+WAIT_OBJECT_0 = 0
+INFINITE = 0xFFFFFFFF
+
+if sys.platform == 'win32':
+    import ctypes
+    from ctypes import wintypes
+
+    class _Overlapped(ctypes.Structure):
+        _fields_ = [('Internal', ctypes.c_void_p), ('InternalHigh', ctypes.c_void_p),
+                    ('Offset', wintypes.DWORD), ('OffsetHigh', wintypes.DWORD), ('hEvent', wintypes.HANDLE)]
+
+
+def parse_rtnetlink(data):
+    """Change kinds ('link', 'address', 'route') found in one netlink datagram"""
+    kinds = set()
+    offset = 0
+    while offset + NLMSG_HEADER.size <= len(data):
+        length, msg_type = NLMSG_HEADER.unpack_from(data, offset)[:2]
+        if length < NLMSG_HEADER.size:
+            break
+        kind = RTM_KINDS.get(msg_type)
+        if kind:
+            kinds.add(kind)
+        # Messages are padded to 4-byte boundaries
+        offset += (length + 3) & ~3
+    return kinds
+
+
+class ChangeDebouncer:
+    """Collects change kinds and hands them to a callback once events stop arriving"""
+
+    def __init__(self, callback, delay=DEBOUNCE_SECONDS):
+        self.callback = callback
+        self.delay = delay
+        self._cond = threading.Condition()
+        self._pending = set()
+        self._deadline = None
+        self._stopped = False
+        # kind -> monotonic time until which events of that kind are dropped
+        self._ignored = {}
+
+    def ignore(self, kind, seconds):
+        """Drop events of kind for the next seconds (changes the app is making itself)"""
+        with self._cond:
+            until = time.monotonic() + seconds
+            self._ignored[kind] = max(self._ignored.get(kind, 0.0), until)
+
+    def notify(self, kind):
+        """Record a change; every new event pushes the deadline back"""
+        with self._cond:
+            if time.monotonic() < self._ignored.get(kind, 0.0):
+                return
+            self._pending.add(kind)
+            self._deadline = time.monotonic() + self.delay
+            self._cond.notify()
+
+    @property
+    def stopped(self):
+        return self._stopped
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    if self._deadline is None:
+                        # Nothing pending: sleep until an event arrives
+                        self._cond.wait()
+                        continue
+                    remaining = self._deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                if self._stopped:
+                    return
+                changes, self._pending = self._pending, set()
+                self._deadline = None
+            self.callback(changes)
+
+
+class NetworkWatcher:
+    """Event-driven watcher for link, address, route and connection changes"""
+
+    def __init__(self, callback, delay=DEBOUNCE_SECONDS, log=None):
+        self.os_type = platform.system()
+        self.debouncer = ChangeDebouncer(callback, delay)
+        self._log = log or (lambda message: None)
+        self._threads = []
+        self._processes = []
+        # Write end of the rtnetlink wakeup pipe (closed by stop()) or the Windows stop
+        # event (closed by its watcher thread); taken under the lock so neither side
+        # ever uses one the other has closed
+        self._wakeup = None
+        self._lock = threading.Lock()
+        self.sources = []
+
+    def start(self):
+        """Start every notification source available here; returns their names"""
+        if self.os_type == "Linux":
+            if self._start_rtnetlink():
+                self.sources.append("rtnetlink")
+            if shutil.which('nmcli') and self._start_command(['nmcli', 'monitor'], self._nmcli_kind):
+                self.sources.append("NetworkManager")
+        elif self.os_type == "Darwin":
+            if self._start_command(['route', '-n', 'monitor'], self._route_monitor_kind):
+                self.sources.append("routing socket")
+        elif self.os_type == "Windows":
+            if self._start_windows():
+                self.sources.append("NotifyAddrChange")
+        if self.sources:
+            self._spawn(self.debouncer.run)
+        return list(self.sources)
+
+    def ignore(self, kind, seconds=SELF_CHANGE_GRACE):
+        """Drop events of kind for a while, e.g. 'connection' while the app rewrites NetworkManager settings"""
+        self.debouncer.ignore(kind, seconds)
+
+    def stop(self):
+        self.debouncer.stop()
+        with self._lock:
+            wakeup, self._wakeup = self._wakeup, None
+            if wakeup is not None and self.os_type == "Windows":
+                ctypes.windll.kernel32.SetEvent(wakeup)
+            elif wakeup is not None:
+                try:
+                    os.write(wakeup, b'x')
+                except OSError:
+                    # The watcher already stopped and closed the read end
+                    pass
+                os.close(wakeup)
+        for process in self._processes:
+            try:
+                process.terminate()
+            except OSError:
+                pass
+        self._processes = []
+
+    def _spawn(self, target, *args):
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def _start_rtnetlink(self):
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+            sock.bind((0, RTNETLINK_GROUPS))
+        except (AttributeError, OSError) as e:
+            self._log(f"rtnetlink not available: {e}")
+            return False
+        wakeup, self._wakeup = os.pipe()
+        self._spawn(self._watch_rtnetlink, sock, wakeup)
+        return True
+
+    def _watch_rtnetlink(self, sock, wakeup):
+        try:
+            while True:
+                readable = select.select([sock, wakeup], [], [])[0]
+                if wakeup in readable:
+                    return
+                try:
+                    data = sock.recv(65536)
+                except OSError:
+                    # ENOBUFS after a burst: events were dropped, so assume everything changed
+                    self.debouncer.notify('link')
+                    continue
+                for kind in parse_rtnetlink(data):
+                    self.debouncer.notify(kind)
+        finally:
+            sock.close()
+            # stop() owns and closes the write end
+            os.close(wakeup)
+
+    def _start_command(self, command, classify):
+        try:
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                       text=True)
+        except OSError as e:
+            self._log(f"{command[0]} monitor not available: {e}")
+            return False
+        self._processes.append(process)
+        self._spawn(self._watch_command, process, classify)
+        return True
+
+    def _watch_command(self, process, classify):
+        for line in process.stdout:
+            kind = classify(line)
+            if kind:
+                self.debouncer.notify(kind)
+        process.stdout.close()
+        process.wait()
+
+    @staticmethod
+    def _nmcli_kind(line):
+        # Every line from `nmcli monitor` is a NetworkManager state/connection signal
+        return 'connection' if line.strip() else None
+
+    @staticmethod
+    def _route_monitor_kind(line):
+        return ROUTE_MONITOR_KINDS.get(line.split(':', 1)[0].strip())
+
+    def _start_windows(self):
+        kernel32 = ctypes.windll.kernel32
+        kernel32.CreateEventW.restype = wintypes.HANDLE
+        stop_event = kernel32.CreateEventW(None, True, False, None)
+        if not stop_event:
+            self._log("NotifyAddrChange not available: could not create an event")
+            return False
+        self._wakeup = stop_event
+        self._spawn(self._watch_windows, stop_event)
+        return True
+
+    def _watch_windows(self, stop_event):
+        kernel32, iphlpapi = ctypes.windll.kernel32, ctypes.windll.iphlpapi
+        kernel32.CreateEventW.restype = wintypes.HANDLE
+        kernel32.WaitForMultipleObjects.argtypes = [wintypes.DWORD, ctypes.POINTER(wintypes.HANDLE),
+                                                    wintypes.BOOL, wintypes.DWORD]
+        iphlpapi.NotifyAddrChange.argtypes = [ctypes.POINTER(wintypes.HANDLE), ctypes.POINTER(_Overlapped)]
+        iphlpapi.CancelIPChangeNotify.argtypes = [ctypes.POINTER(_Overlapped)]
+        changed = kernel32.CreateEventW(None, False, False, None)
+        handles = (wintypes.HANDLE * 2)(changed, stop_event)
+        try:
+            while True:
+                # Overlapped form: the wait also ends on stop(), so no thread is left blocked
+                overlapped = _Overlapped(hEvent=changed)
+                handle = wintypes.HANDLE()
+                if iphlpapi.NotifyAddrChange(ctypes.byref(handle), ctypes.byref(overlapped)) != ERROR_IO_PENDING:
+                    self._log("NotifyAddrChange failed; network change notifications stopped")
+                    return
+                if kernel32.WaitForMultipleObjects(2, handles, False, INFINITE) != WAIT_OBJECT_0:
+                    iphlpapi.CancelIPChangeNotify(ctypes.byref(overlapped))
+                    # The cancelled request still completes into overlapped; let it before returning
+                    kernel32.WaitForSingleObject(changed, 1000)
+                    return
+                self.debouncer.notify('address')
+        finally:
+            with self._lock:
+                if self._wakeup == stop_event:
+                    self._wakeup = None
+                kernel32.CloseHandle(stop_event)
+            kernel32.CloseHandle(changed)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Saved proxy profiles for the PHH VPN Client
+Profiles (upstream, proxy type, bypass rules) are stored as JSON in the
+per-user config directory and shared by the GUI and CLI.
+"""
+
+import json
+import os
+import platform
+
+PROXY_TYPES = ["HTTP/HTTPS", "SOCKS4", "SOCKS5"]
+
+# Hosts that never go through the proxy
+DEFAULT_BYPASS = ['localhost', '127.0.0.0/8', '::1']
+
+# URL schemes accepted for jump hops
+HOP_SCHEMES = {'http': "HTTP/HTTPS", 'socks4': "SOCKS4", 'socks4a': "SOCKS4",
+               'socks5': "SOCKS5", 'socks5h': "SOCKS5"}
+
+
+def config_dir():
+    """Per-user configuration directory for the PHH VPN Client"""
+    if platform.system() == "Windows":
+        base = os.getenv('APPDATA') or os.path.expanduser("~")
+        return os.path.join(base, "PHH VPN")
+    base = os.getenv('XDG_CONFIG_HOME') or os.path.join(os.path.expanduser("~"), ".config")
+    return os.path.join(base, "phh-vpn")
+
+
+def write_json_atomic(path, data):
+    """Write JSON so readers never see a half-written file"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def parse_hop(url):
+    """Parse 'socks5://host:port' (or http://, socks4://) into (host, port, proxy type)"""
+    scheme, sep, rest = url.strip().partition('://')
+    if not sep or scheme.lower() not in HOP_SCHEMES:
+        raise ValueError(f"Hop must look like socks5://host:port or http://host:port: {url}")
+    rest = rest.rstrip('/')
+    if rest.startswith('['):
+        host, _, port = rest[1:].partition(']:')
+    else:
+        host, _, port = rest.rpartition(':')
+    if not host or not port.isdigit() or not 0 < int(port) < 65536:
+        raise ValueError(f"Invalid hop address: {url}")
+    return host, int(port), HOP_SCHEMES[scheme.lower()]
+
+
+def parse_bypass(value):
+    """Split a comma/space separated bypass list"""
+    if isinstance(value, (list, tuple)):
+        return [h.strip() for h in value if h.strip()]
+    return [h.strip() for h in value.replace(',', ' ').split() if h.strip()]
+
+
+class Profile:
+    """Named proxy configuration"""
+    __slots__ = ('name', 'proxy_ip', 'proxy_port', 'proxy_type', 'bypass', 'via')
+
+    # Fields compared when switching between profiles
+    FIELDS = ('proxy_ip', 'proxy_port', 'proxy_type', 'bypass', 'via')
+
+    def __init__(self, name, proxy_ip, proxy_port, proxy_type="HTTP/HTTPS", bypass=None, via=None):
+        if not name:
+            raise ValueError("Profile name is required")
+        if not proxy_ip:
+            raise ValueError("Proxy IP is required")
+        try:
+            port_num = int(proxy_port)
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid port number: {proxy_port}")
+        if port_num < 1 or port_num > 65535:
+            raise ValueError("Port must be between 1 and 65535")
+        if proxy_type not in PROXY_TYPES:
+            raise ValueError(f"Unsupported proxy type: {proxy_type}")
+        self.name = name
+        self.proxy_ip = proxy_ip
+        self.proxy_port = str(port_num)
+        self.proxy_type = proxy_type
+        self.bypass = parse_bypass(bypass) if bypass is not None else list(DEFAULT_BYPASS)
+        # Jump hops (URLs) traversed, in order, before reaching this proxy
+        self.via = parse_bypass(via) if via else []
+        for url in self.via:
+            parse_hop(url)
+
+    def chain(self):
+        """All hops as (host, port, type) tuples, ending with this proxy"""
+        return tuple(parse_hop(url) for url in self.via) + ((self.proxy_ip, int(self.proxy_port), self.proxy_type),)
+
+    def diff(self, other):
+        """Names of the fields that differ from another profile"""
+        return {field for field in self.FIELDS if getattr(self, field) != getattr(other, field)}
+
+    def to_dict(self):
+        return {
+            'proxy_ip': self.proxy_ip,
+            'proxy_port': self.proxy_port,
+            'proxy_type': self.proxy_type,
+            'bypass': list(self.bypass),
+            'via': list(self.via),
+        }
+
+    @classmethod
+    def from_dict(cls, name, data):
+        return cls(name, data.get('proxy_ip'), data.get('proxy_port'),
+                   data.get('proxy_type', "HTTP/HTTPS"), data.get('bypass'), data.get('via'))
+
+    def __str__(self):
+        via = f" via {', '.join(self.via)}" if self.via else ""
+        return f"{self.name}: {self.proxy_ip}:{self.proxy_port} ({self.proxy_type}){via}"
+
+
+class ProfileStore:
+    """Profiles file plus the name of the active profile"""
+
+    def __init__(self, path=None, autoload=True):
+        self.path = path or os.path.join(config_dir(), "profiles.json")
+        self.profiles = {}
+        self.active = None
+        if autoload:
+            self.load()
+
+    def load(self):
+        """(Re)read the profiles file; a missing file means no profiles"""
+        self.profiles = {}
+        self.active = None
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r') as f:
+            data = json.load(f)
+        for name, entry in data.get('profiles', {}).items():
+            try:
+                self.profiles[name] = Profile.from_dict(name, entry)
+            except ValueError:
+                # Skip broken entries rather than refusing to start
+                continue
+        if data.get('active') in self.profiles:
+            self.active = data['active']
+
+    def save(self):
+        write_json_atomic(self.path, {
+            'active': self.active,
+            'profiles': {name: p.to_dict() for name, p in self.profiles.items()},
+        })
+
+    def names(self):
+        return sorted(self.profiles)
+
+    def get(self, name):
+        profile = self.profiles.get(name)
+        if profile is None:
+            raise KeyError(f"No such profile: {name}")
+        return profile
+
+    def put(self, profile):
+        self.profiles[profile.name] = profile
+        self.save()
+
+    def delete(self, name):
+        self.get(name)
+        del self.profiles[name]
+        if self.active == name:
+            self.active = None
+        self.save()
+
+    def set_active(self, name):
+        if name is not None:
+            self.get(name)
+        self.active = name
+        self.save()
+
+    def active_profile(self):
+        return self.profiles.get(self.active) if self.active else None
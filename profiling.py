@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""
+Built-in profiling for the PHH VPN Client
+Runs one operation under cProfile (a pstats file) or a low-overhead stack
+sampler (folded stacks for flamegraph.pl or speedscope). Every subprocess the
+operation starts is timed, and its wall time shows up in the output under the
+function that started it, so a slow connect on a user's machine can be
+attached to a ticket as a single file.
+"""
+
+import cProfile
+import os
+import pstats
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+
+from profiles import config_dir
+
+PROFILERS = ('cprofile', 'sample')
+
+# Seconds between stack samples
+SAMPLE_INTERVAL = 0.005
+
+# Longest command line kept in labels
+MAX_LABEL = 80
+
+_SUBPROCESS_FILE = subprocess.__file__
+_Popen = subprocess.Popen
+
+
+def command_label(args):
+    """Short printable form of a subprocess command line"""
+    if isinstance(args, (list, tuple)):
+        args = ' '.join(str(arg) for arg in args)
+    args = str(args)
+    return args if len(args) <= MAX_LABEL else args[:MAX_LABEL - 3] + '...'
+
+
+def default_output(operation, profiler):
+    """Timestamped file in the diagnostics directory of the config dir"""
+    extension = 'pstats' if profiler == 'cprofile' else 'folded'
+    name = f"{operation}-{time.strftime('%Y%m%d-%H%M%S')}.{extension}"
+    return os.path.join(config_dir(), "diagnostics", name)
+
+
+def _caller(frame):
+    """First frame outside subprocess and this module"""
+    while frame and frame.f_code.co_filename in (_SUBPROCESS_FILE, __file__):
+        frame = frame.f_back
+    return frame
+
+
+class SubprocessRun:
+    """Wall time of one subprocess and the function that started it"""
+    __slots__ = ('label', 'caller', 'started', 'elapsed')
+
+    def __init__(self, label, caller):
+        self.label = label
+        self.caller = caller
+        self.started = time.perf_counter()
+        self.elapsed = None
+
+
+class _TimedPopen(_Popen):
+    """Popen that records its wall time in the active profiler"""
+    recorder = None
+
+    def __init__(self, args, *rest, **kwargs):
+        frame = _caller(sys._getframe(1))
+        code = frame.f_code if frame else None
+        caller = (code.co_filename, code.co_firstlineno, code.co_name) if code else ('~', 0, '<unknown>')
+        self._profile_run = SubprocessRun(command_label(args), caller)
+        super().__init__(args, *rest, **kwargs)
+        if self.recorder is not None:
+            self.recorder.append(self._profile_run)
+
+    def wait(self, timeout=None):
+        result = super().wait(timeout)
+        if self._profile_run.elapsed is None:
+            self._profile_run.elapsed = time.perf_counter() - self._profile_run.started
+        return result
+
+
+class Sampler:
+    """Samples the stacks of all other threads at a fixed interval"""
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="phh-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        me = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                if ident not in names:
+                    names.update((thread.ident, thread.name) for thread in threading.enumerate())
+                self.stacks[self._fold(names.get(ident, f"thread-{ident}"), frame)] += 1
+            self.samples += 1
+
+    @staticmethod
+    def _fold(thread_name, frame):
+        frames = []
+        waiting_on = None
+        while frame is not None:
+            code = frame.f_code
+            if waiting_on is None and code.co_filename == _SUBPROCESS_FILE:
+                popen = frame.f_locals.get('self')
+                if isinstance(popen, _Popen):
+                    waiting_on = popen
+            frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        frames.append(thread_name)
+        frames.reverse()
+        if waiting_on is not None:
+            # Time spent blocked on a child process shows up as the command itself
+            frames.append(f"[subprocess] {command_label(waiting_on.args)}")
+        return ';'.join(frame.replace(';', ',') for frame in frames)
+
+
+class OperationProfiler:
+    """Profiles one operation and writes a pstats or folded-stacks file"""
+
+    def __init__(self, operation, profiler='cprofile', interval=SAMPLE_INTERVAL):
+        if profiler not in PROFILERS:
+            raise ValueError(f"Unknown profiler: {profiler}")
+        self.operation = operation
+        self.profiler = profiler
+        self.interval = interval
+        self.subprocesses = []
+        self.wall_time = None
+        self._profile = None
+        self._sampler = None
+        self._started = None
+
+    def start(self):
+        """Start profiling; cProfile only follows the calling thread"""
+        _TimedPopen.recorder = self.subprocesses
+        subprocess.Popen = _TimedPopen
+        if self.profiler == 'cprofile':
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            self._sampler = Sampler(self.interval)
+            self._sampler.start()
+        self._started = time.perf_counter()
+
+    def stop(self):
+        """Stop profiling; must run in the thread that called start()"""
+        self.wall_time = time.perf_counter() - self._started
+        if self._profile:
+            self._profile.disable()
+        if self._sampler:
+            self._sampler.stop()
+        subprocess.Popen = _Popen
+        _TimedPopen.recorder = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def finished_subprocesses(self):
+        return [run for run in self.subprocesses if run.elapsed is not None]
+
+    def write(self, path):
+        """Write the profile to path and return it"""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        if self._profile:
+            stats = pstats.Stats(self._profile)
+            self._annotate(stats)
+            stats.dump_stats(path)
+        else:
+            with open(path, 'w') as f:
+                for stack, count in sorted(self._sampler.stacks.items()):
+                    f.write(f"{stack} {count}\n")
+        return path
+
+    def _annotate(self, stats):
+        """Add each subprocess as a pseudo-function called by the function that started it"""
+        for run in self.finished_subprocesses():
+            key = ('subprocess', 0, run.label)
+            cc, nc, tt, ct, callers = stats.stats.get(key, (0, 0, 0.0, 0.0, {}))
+            calls = callers.get(run.caller, (0, 0, 0.0, 0.0))
+            callers[run.caller] = (calls[0] + 1, calls[1] + 1, calls[2] + run.elapsed, calls[3] + run.elapsed)
+            stats.stats[key] = (cc + 1, nc + 1, tt + run.elapsed, ct + run.elapsed, callers)
+
+    def summary(self, top=5):
+        """Short human readable report: wall time and the slowest subprocesses"""
+        runs = sorted(self.finished_subprocesses(), key=lambda run: run.elapsed, reverse=True)
+        lines = [f"Profiled {self.operation}: {self.wall_time:.2f} s wall, "
+                 f"{len(runs)} subprocesses taking {sum(run.elapsed for run in runs):.2f} s"]
+        for run in runs[:top]:
+            lines.append(f"  {run.elapsed:6.2f} s  {run.label}  (from {run.caller[2]})")
+        if self._sampler:
+            lines.append(f"  {self._sampler.samples} stack samples every {self.interval * 1000:.0f} ms")
+        return lines
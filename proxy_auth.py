@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+Proxy authentication for the PHH VPN Client
+Credentials are kept per proxy (host:port) in memory, in the OS keyring when
+the optional keyring package is installed, or taken from PROXY_USERNAME /
+PROXY_PASSWORD. After the first challenge from a proxy its scheme (Basic or
+Digest, with the Digest nonce) is cached, so later connections send
+Proxy-Authorization up front instead of paying a 407 round trip each.
+"""
+
+import base64
+import hashlib
+import os
+import re
+import threading
+
+# Optional: remember credentials in the OS keyring
+try:
+    import keyring
+    import keyring.errors
+except ImportError:
+    keyring = None
+
+KEYRING_SERVICE = "phh-vpn"
+
+DIGEST_HASHES = {'MD5': hashlib.md5, 'SHA-256': hashlib.sha256}
+
+_AUTH_PARAM = re.compile(r'([A-Za-z0-9_-]+)\s*=\s*("(?:[^"\\]|\\.)*"|[^,\s]*)\s*,?\s*')
+_SCHEME = re.compile(r'([A-Za-z0-9_-]+)(?:\s+|$)')
+
+
+def endpoint(host, port):
+    return f"[{host}]:{port}" if ':' in host else f"{host}:{port}"
+
+
+def parse_challenges(values):
+    """Proxy-Authenticate header values -> {scheme (lower case): {param: value}}"""
+    challenges = {}
+    for value in values:
+        pos = 0
+        while pos < len(value):
+            match = _SCHEME.match(value, pos)
+            if not match:
+                break
+            params = {}
+            pos = match.end()
+            # Parameters belong to this scheme until the next bare token
+            while pos < len(value):
+                param = _AUTH_PARAM.match(value, pos)
+                if not param:
+                    break
+                raw = param.group(2)
+                if raw.startswith('"'):
+                    raw = re.sub(r'\\(.)', r'\1', raw[1:-1])
+                params[param.group(1).lower()] = raw
+                pos = param.end()
+            challenges.setdefault(match.group(1).lower(), params)
+            while pos < len(value) and value[pos] in ', ':
+                pos += 1
+    return challenges
+
+
+class CredentialStore:
+    """Username/password per proxy: this session's entries, then the keyring, then the environment"""
+
+    def __init__(self, use_keyring=True):
+        self.use_keyring = use_keyring and keyring is not None
+        self._memory = {}
+        # Keyring/environment lookups, misses included: the relay asks on every connection
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def set(self, host, port, username, password, remember=False):
+        """Use credentials for a proxy; remember=True also saves them in the keyring"""
+        with self._lock:
+            self._memory[endpoint(host, port)] = (username, password)
+        if remember:
+            if not self.use_keyring:
+                raise RuntimeError("Remembering passwords needs the keyring package (pip install keyring)")
+            # A user-id cannot contain ':' in Basic auth, so it separates the two safely
+            keyring.set_password(KEYRING_SERVICE, endpoint(host, port), f"{username}:{password}")
+
+    def reload(self):
+        """Look in the keyring and environment again (they may have changed since)"""
+        with self._lock:
+            self._cache.clear()
+
+    def forget(self, host, port):
+        with self._lock:
+            self._memory.pop(endpoint(host, port), None)
+            self._cache.pop(endpoint(host, port), None)
+        if self.use_keyring:
+            try:
+                keyring.delete_password(KEYRING_SERVICE, endpoint(host, port))
+            except keyring.errors.PasswordDeleteError:
+                pass
+
+    def get(self, host, port):
+        """(username, password) for a proxy, or None"""
+        key = endpoint(host, port)
+        with self._lock:
+            if key in self._memory:
+                return self._memory[key]
+            if key in self._cache:
+                return self._cache[key]
+        credentials = None
+        if self.use_keyring:
+            try:
+                secret = keyring.get_password(KEYRING_SERVICE, key)
+            except keyring.errors.KeyringError:
+                secret = None
+            if secret:
+                username, _, password = secret.partition(':')
+                credentials = (username, password)
+        if credentials is None and os.getenv('PROXY_USERNAME'):
+            if endpoint(os.getenv('PROXY_IP', ''), os.getenv('PROXY_PORT', '')) == key:
+                credentials = (os.getenv('PROXY_USERNAME'), os.getenv('PROXY_PASSWORD', ''))
+        with self._lock:
+            self._cache[key] = credentials
+        return credentials
+
+
+class HopAuth:
+    """Authentication state for one proxy, shared by every connection to it"""
+
+    def __init__(self, username, password):
+        self.username = username
+        self.password = password
+        self.scheme = None
+        self.digest = None
+        self.nonce_count = 0
+        self._lock = threading.Lock()
+
+    def header(self, method, uri):
+        """Proxy-Authorization value to send up front, or None until the proxy has asked once"""
+        with self._lock:
+            if self.scheme == 'basic':
+                token = base64.b64encode(f"{self.username}:{self.password}".encode('utf-8')).decode('ascii')
+                return f"Basic {token}"
+            if self.scheme == 'digest':
+                self.nonce_count += 1
+                return self._digest(method, uri, self.nonce_count)
+        return None
+
+    def challenge(self, values):
+        """Learn the scheme from a 407; False if no supported scheme was offered"""
+        challenges = parse_challenges(values)
+        digest = challenges.get('digest')
+        with self._lock:
+            if digest and digest.get('nonce') and self._digest_hash(digest):
+                # Preferred: the password never crosses the wire
+                if not (self.digest and self.digest.get('nonce') == digest['nonce']):
+                    self.nonce_count = 0
+                self.scheme, self.digest = 'digest', digest
+                return True
+            if 'basic' in challenges:
+                self.scheme, self.digest = 'basic', None
+                return True
+            self.scheme = self.digest = None
+        return False
+
+    @staticmethod
+    def _digest_hash(params):
+        algorithm = params.get('algorithm', 'MD5').upper()
+        if algorithm.endswith('-SESS'):
+            algorithm = algorithm[:-5]
+        return DIGEST_HASHES.get(algorithm)
+
+    def _digest(self, method, uri, count):
+        """RFC 7616 response for the cached challenge"""
+        params = self.digest
+        digest_hash = self._digest_hash(params)
+        hash_hex = lambda data: digest_hash(data.encode('utf-8')).hexdigest()
+        realm, nonce = params.get('realm', ''), params['nonce']
+        algorithm = params.get('algorithm', 'MD5')
+        cnonce = os.urandom(8).hex()
+        nc = f"{count:08x}"
+        ha1 = hash_hex(f"{self.username}:{realm}:{self.password}")
+        if algorithm.upper().endswith('-SESS'):
+            ha1 = hash_hex(f"{ha1}:{nonce}:{cnonce}")
+        ha2 = hash_hex(f"{method}:{uri}")
+        qops = [q.strip() for q in params.get('qop', '').split(',') if q.strip()]
+        fields = [f'username="{self.username}"', f'realm="{realm}"', f'nonce="{nonce}"',
+                  f'uri="{uri}"', f'algorithm={algorithm}']
+        if 'auth' in qops:
+            response = hash_hex(f"{ha1}:{nonce}:{nc}:{cnonce}:auth:{ha2}")
+            fields += ['qop=auth', f'nc={nc}', f'cnonce="{cnonce}"']
+        else:
+            response = hash_hex(f"{ha1}:{nonce}:{ha2}")
+        fields.append(f'response="{response}"')
+        if 'opaque' in params:
+            fields.append(f'opaque="{params["opaque"]}"')
+        return "Digest " + ", ".join(fields)
+
+
+class ProxyAuth:
+    """HopAuth per proxy with credentials in a CredentialStore"""
+
+    def __init__(self, store=None):
+        self.store = store or CredentialStore()
+        self._hops = {}
+        self._lock = threading.Lock()
+
+    def for_hop(self, hop):
+        """HopAuth for an (ip, port, type) hop, or None for an open proxy"""
+        host, port = hop[0], hop[1]
+        credentials = self.store.get(host, port)
+        key = endpoint(host, port)
+        with self._lock:
+            state = self._hops.get(key)
+            if credentials is None:
+                self._hops.pop(key, None)
+                return None
+            if state is None or (state.username, state.password) != credentials:
+                # New or changed credentials start over with the next challenge
+                state = self._hops[key] = HopAuth(*credentials)
+            return state
+
+    def needs_auth(self, hop):
+        return self.store.get(hop[0], hop[1]) is not None
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+proxychains configuration for the PHH VPN Client
+Renders a managed section (chain mode, timeouts and proxy entries) from a set
+of upstreams and splices it into an existing proxychains.conf. Everything
+outside the PHH VPN markers is kept exactly as the user wrote it.
+"""
+
+from profiles import parse_bypass, parse_hop
+
+CHAIN_MODES = ('strict_chain', 'dynamic_chain', 'round_robin_chain', 'random_chain')
+
+# proxychains entry type for each proxy type
+PROXYCHAINS_TYPES = {"HTTP/HTTPS": 'http', "SOCKS4": 'socks4', "SOCKS5": 'socks5'}
+
+# proxychains defaults (ms), used when no latency has been measured
+DEFAULT_CONNECT_TIMEOUT = 8000
+DEFAULT_READ_TIMEOUT = 15000
+
+# Lower bounds (ms) so a single fast probe does not make timeouts brittle
+MIN_CONNECT_TIMEOUT = 1000
+MIN_READ_TIMEOUT = 4000
+
+OPTIONS_BEGIN = "# BEGIN PHH VPN options (managed, edits are overwritten)\n"
+OPTIONS_END = "# END PHH VPN options\n"
+PROXIES_BEGIN = "# BEGIN PHH VPN proxies (managed, edits are overwritten)\n"
+PROXIES_END = "# END PHH VPN proxies\n"
+
+# Marker written by older versions above their single proxy line
+LEGACY_MARKER = "# PHH VPN Proxy"
+
+# New files get the usual proxychains preamble
+DEFAULT_PREAMBLE = ["proxy_dns\n", "remote_dns_subnet 224\n"]
+
+
+def proxy_line(ip, port, proxy_type):
+    return f"{PROXYCHAINS_TYPES.get(proxy_type, 'http')} {ip} {port}\n"
+
+
+def parse_pool(value):
+    """Extra upstreams from a comma/space separated list of proxy URLs"""
+    return [parse_hop(url) for url in parse_bypass(value or '')]
+
+
+def tuned_timeouts(latencies_ms):
+    """(connect, read) timeouts in ms scaled from the slowest measured connect time"""
+    if not latencies_ms:
+        return DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT
+    slowest = max(latencies_ms)
+    connect = min(max(int(slowest * 5) + 500, MIN_CONNECT_TIMEOUT), DEFAULT_CONNECT_TIMEOUT)
+    # Handshake reads wait for the proxy to reach the destination, so allow more
+    read = min(max(connect * 2, int(slowest * 10) + 2000, MIN_READ_TIMEOUT), DEFAULT_READ_TIMEOUT)
+    return connect, read
+
+
+def strip_managed(lines):
+    """Lines without the PHH VPN sections (and the single entry older versions wrote)"""
+    kept = []
+    skip_block = False
+    skip_next = False
+    for line in lines:
+        if line in (OPTIONS_BEGIN, PROXIES_BEGIN):
+            skip_block = True
+        elif skip_block:
+            if line in (OPTIONS_END, PROXIES_END):
+                skip_block = False
+        elif line.strip() == LEGACY_MARKER:
+            skip_next = True
+        elif skip_next:
+            # Only the proxy line directly below the legacy marker was ours
+            skip_next = False
+            words = line.split()
+            if words and words[0] in PROXYCHAINS_TYPES.values():
+                continue
+            kept.append(line)
+        else:
+            kept.append(line)
+    return kept
+
+
+def chain_mode(mode, count):
+    """Requested chain mode, or round robin over several upstreams and strict for one"""
+    if mode is None:
+        return 'round_robin_chain' if count > 1 else 'strict_chain'
+    if mode not in CHAIN_MODES:
+        raise ValueError(f"Unknown proxychains chain mode: {mode}")
+    return mode
+
+
+def render(lines, upstreams, mode=None, chain_len=1, latencies_ms=()):
+    """New proxychains.conf lines with the managed section for upstreams ((ip, port, type), ...)"""
+    if not upstreams:
+        raise ValueError("At least one upstream is required")
+    mode = chain_mode(mode, len(upstreams))
+    connect, read = tuned_timeouts(latencies_ms)
+    options = [OPTIONS_BEGIN, f"{mode}\n"]
+    if mode in ('round_robin_chain', 'random_chain'):
+        options.append(f"chain_len = {max(1, min(int(chain_len), len(upstreams)))}\n")
+    options += [f"tcp_connect_time_out {connect}\n", f"tcp_read_time_out {read}\n", OPTIONS_END]
+    proxies = [PROXIES_BEGIN] + [proxy_line(*upstream) for upstream in upstreams] + [PROXIES_END]
+
+    lines = strip_managed(lines) if lines else list(DEFAULT_PREAMBLE)
+    if lines and not lines[-1].endswith('\n'):
+        lines[-1] += '\n'
+    header = next((i for i, line in enumerate(lines) if line.strip() == '[ProxyList]'), None)
+    if header is None:
+        lines.append("[ProxyList]\n")
+        header = len(lines) - 1
+    # Options go last before [ProxyList] so they win over the user's own settings
+    return lines[:header] + options + [lines[header]] + proxies + lines[header + 1:]
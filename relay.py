@@ -0,0 +1,622 @@
+#!/usr/bin/env python3
+"""
+Local relay for the PHH VPN Client
+Listens on localhost, accepts HTTP (CONNECT and plain requests), SOCKS4/4a and
+SOCKS5 clients on a single port and forwards them through the upstream proxy,
+optionally reached through a chain of jump hops. SOCKS5 UDP ASSOCIATE is
+relayed through a SOCKS5 upstream's UDP relay. All relayed traffic is
+accounted in a TrafficMeter.
+"""
+
+import asyncio
+import ipaddress
+import socket
+import struct
+import threading
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+import upstream
+from socket_tuning import set_keepalive
+from traffic import TrafficMeter
+from udp_relay import UdpAssociations
+
+# Default local listening address for the relay
+RELAY_HOST = '127.0.0.1'
+RELAY_PORT = 8119
+
+# Fixed receive buffer per direction of a relayed connection
+BUFFER_SIZE = 65536
+
+# Write-buffer water marks: reading from the other side pauses above HIGH_WATER
+# and resumes once the backlog drains below LOW_WATER
+HIGH_WATER = 256 * 1024
+LOW_WATER = 64 * 1024
+
+# Connections kept already tunnelled up to the last hop of a multi-hop chain
+WARM_CHAINS = 2
+
+# Seconds a warm partial chain may sit unused before it is discarded
+WARM_MAX_IDLE = 20
+
+# Keepalive timers (s) while a warm partial chain sits in the pool: a silently dead
+# first hop is noticed after 5 + 3 x 2 = 11 s, well before WARM_MAX_IDLE
+WARM_KEEPALIVE_IDLE = 5
+WARM_KEEPALIVE_INTERVAL = 2
+
+# Seconds between snapshots of the relayed connections' write buffers
+BUFFER_SAMPLE_INTERVAL = 1.0
+
+
+class Pipe(asyncio.BufferedProtocol):
+    """One side of a relayed connection: reads into a fixed buffer and writes to the peer side"""
+
+    def __init__(self, conn, count, shaper=None, buffer_size=BUFFER_SIZE):
+        self.conn = conn
+        self.count = count
+        self.shaper = shaper if shaper and shaper.enabled else None
+        self.buffer = memoryview(bytearray(buffer_size))
+        self.transport = None
+        self.peer = None
+        self.peer_full = False
+        self.throttled = False
+        self.eof = False
+        self.closed = asyncio.get_running_loop().create_future()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(HIGH_WATER, LOW_WATER)
+
+    def get_buffer(self, sizehint):
+        return self.buffer
+
+    def buffer_updated(self, nbytes):
+        self.forward(self.buffer[:nbytes])
+
+    def forward(self, data):
+        """Write data read from this side to the peer side"""
+        n = len(data)
+        if not n:
+            return
+        # The transport may keep a reference to what it could not send, so hand it a copy
+        self.peer.transport.write(bytes(data))
+        self.count(self.conn, n)
+        if self.shaper:
+            wait = self.shaper.reserve(self.conn.host, n)
+            if wait > 0:
+                self.throttled = True
+                self.update_reading()
+                asyncio.get_running_loop().call_later(wait, self._unthrottle)
+
+    def _unthrottle(self):
+        self.throttled = False
+        self.update_reading()
+
+    def update_reading(self):
+        """Pause reading while the peer is backed up or the shaper says wait"""
+        transport = self.transport
+        if transport.is_closing():
+            return
+        if self.peer_full or self.throttled:
+            if transport.is_reading():
+                transport.pause_reading()
+        elif not transport.is_reading():
+            transport.resume_reading()
+
+    def pause_writing(self):
+        # Our write buffer passed HIGH_WATER: stop reading from the side that fills it
+        self.conn.pauses += 1
+        self.peer.peer_full = True
+        self.peer.update_reading()
+
+    def resume_writing(self):
+        self.peer.peer_full = False
+        self.peer.update_reading()
+
+    def eof_received(self):
+        self.eof = True
+        peer_transport = self.peer.transport
+        if self.peer.eof:
+            self.transport.close()
+            peer_transport.close()
+            return False
+        if not peer_transport.is_closing() and peer_transport.can_write_eof():
+            peer_transport.write_eof()
+        # Keep the other direction open (half-close)
+        return True
+
+    def connection_lost(self, exc):
+        if exc is None:
+            # Flushes whatever is still buffered for the peer before closing
+            self.peer.transport.close()
+        else:
+            self.peer.transport.abort()
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+
+async def take_over(reader, writer, pipe):
+    """Move a connection from asyncio streams to a Pipe; returns bytes the stream read ahead"""
+    transport = writer.transport
+    # reader is an upstream.HandoffReader: EOF fed before the handover must reach the Pipe
+    eof = reader.eof_seen
+    transport.set_protocol(pipe)
+    pipe.connection_made(transport)
+    # Nothing reaches the reader once the Pipe owns the transport, so ending it lets read()
+    # return what the handshake read past its own messages without waiting
+    reader.feed_eof()
+    return await reader.read(), eof
+
+
+class WarmChains:
+    """Pool of streams already tunnelled through every hop but the last of a chain"""
+
+    def __init__(self, size=WARM_CHAINS, max_idle=WARM_MAX_IDLE, tuning=None, auth=None):
+        self.size = size
+        self.max_idle = max_idle
+        # Tunnel keepalive (15 s + 3 x 5 s by default) would take longer than max_idle to
+        # notice a dead proxy, so parked streams get WARM_KEEPALIVE_* timers until handed out
+        self.tuning = tuning
+        self.tunnel_keepalive = (tuning.keepalive_idle, tuning.keepalive_interval) if tuning else (0, 0)
+        self.auth = auth
+        self.chain = None
+        self.hits = 0
+        self.misses = 0
+        self._idle = deque()
+        self._tasks = set()
+
+    def prime(self, chain):
+        """Switch to chain (dropping streams built for another one) and fill the pool"""
+        if chain != self.chain:
+            self.clear()
+            self.chain = chain
+        missing = self.size - len(self._idle) - len(self._tasks)
+        for _ in range(missing):
+            task = asyncio.ensure_future(self._warm(chain))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def get(self, chain):
+        """Stream to the last hop of chain, taken from the pool when one is ready"""
+        if chain != self.chain:
+            self.clear()
+            self.chain = chain
+        now = time.monotonic()
+        while self._idle:
+            created, reader, writer, probe = self._idle.popleft()
+            if now - created <= self.max_idle and not probe.done() and not writer.is_closing():
+                probe.cancel()
+                await asyncio.wait([probe])
+                # The probe may have read data or EOF just before it was cancelled
+                if probe.cancelled():
+                    self._keepalive(writer, *self.tunnel_keepalive)
+                    self.hits += 1
+                    self.prime(chain)
+                    return reader, writer
+            probe.cancel()
+            writer.close()
+        self.misses += 1
+        self.prime(chain)
+        return await upstream.open_partial_chain(chain, tuning=self.tuning, auth=self.auth)
+
+    async def _warm(self, chain):
+        try:
+            reader, writer = await upstream.open_partial_chain(chain, tuning=self.tuning, auth=self.auth)
+        except Exception:
+            return
+        if chain != self.chain or len(self._idle) >= self.size:
+            writer.close()
+            return
+        # Proxies drop idle connections, and a hop that sends anything unasked has left the
+        # stream unusable: a pending one-byte read notices either as soon as it happens.
+        # A first hop that vanished without a word fails the read once keepalive gives up
+        self._keepalive(writer, WARM_KEEPALIVE_IDLE, WARM_KEEPALIVE_INTERVAL)
+        probe = asyncio.ensure_future(reader.read(1))
+        entry = (time.monotonic(), reader, writer, probe)
+        self._idle.append(entry)
+        probe.add_done_callback(lambda _: self._discard(entry))
+        # An idle relay may not call get() for hours; expired streams are closed on time
+        asyncio.get_running_loop().call_later(self.max_idle, self._expire, entry)
+
+    @staticmethod
+    def _keepalive(writer, idle, interval):
+        """Set keepalive timers on the stream's socket to the first hop (idle 0 turns it off)"""
+        sock = writer.get_extra_info('socket')
+        if sock is None:
+            return
+        try:
+            if idle:
+                set_keepalive(sock, idle, interval)
+            else:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 0)
+        except (OSError, AttributeError):
+            # The transport socket does not expose ioctl (older Windows); keep what apply() set
+            pass
+
+    def _expire(self, entry):
+        if entry in self._idle:
+            self._idle.remove(entry)
+            entry[3].cancel()
+            entry[2].close()
+
+    def _discard(self, entry):
+        probe = entry[3]
+        if probe.cancelled():
+            return
+        # Data, EOF or a reset: either way the stream cannot be handed out
+        probe.exception()
+        if entry in self._idle:
+            self._idle.remove(entry)
+        entry[2].close()
+
+    def clear(self):
+        while self._idle:
+            _, _, writer, probe = self._idle.popleft()
+            probe.cancel()
+            writer.close()
+
+    async def close(self):
+        for task in list(self._tasks):
+            task.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        probes = [entry[3] for entry in self._idle]
+        self.clear()
+        if probes:
+            await asyncio.wait(probes)
+
+
+class LocalRelay:
+    """Local proxy endpoint forwarding client connections through the upstream proxy"""
+
+    def __init__(self, proxy_ip, proxy_port, proxy_type, listen_host=RELAY_HOST,
+                 listen_port=RELAY_PORT, log=None, shaper=None, via=(), warm_chains=WARM_CHAINS,
+                 tuning=None, auth=None):
+        # Jump hops plus the upstream proxy, replaced as a whole so a connection
+        # never sees a half-updated chain
+        self.chain = tuple(via) + ((proxy_ip, int(proxy_port), proxy_type),)
+        self.tuning = tuning
+        # Credentials and cached challenges for authenticating proxies (proxy_auth.ProxyAuth)
+        self.auth = auth
+        self.warm = WarmChains(warm_chains, tuning=tuning, auth=auth)
+        self.udp = UdpAssociations()
+        self.listen_host = listen_host
+        self.listen_port = int(listen_port)
+        self.meter = TrafficMeter()
+        self.shaper = shaper
+        self._log = log or (lambda message: None)
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._tasks = set()
+
+    @property
+    def upstream_proxy(self):
+        return self.chain[-1]
+
+    @property
+    def proxy_ip(self):
+        return self.upstream_proxy[0]
+
+    @property
+    def proxy_port(self):
+        return self.upstream_proxy[1]
+
+    @property
+    def proxy_type(self):
+        return self.upstream_proxy[2]
+
+    def set_upstream(self, proxy_ip, proxy_port, proxy_type, via=()):
+        """Send new connections to a different upstream; open tunnels are left alone"""
+        self.chain = tuple(via) + ((proxy_ip, int(proxy_port), proxy_type),)
+        self._prime_warm_chains()
+        self._log(f"Local relay upstream switched to {self.describe_chain()}")
+
+    def describe_chain(self):
+        hops = [f"{ip}:{port} ({proxy_type})" for ip, port, proxy_type in self.chain]
+        return " -> ".join(hops)
+
+    def _prime_warm_chains(self):
+        if len(self.chain) > 1 and self.warm.size and self.running:
+            self._loop.call_soon_threadsafe(self.warm.prime, self.chain)
+
+    def call_in_loop(self, callback):
+        """Run callback in the relay's event loop thread and return its result"""
+        async def run():
+            return callback()
+        return asyncio.run_coroutine_threadsafe(run(), self._loop).result()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def address(self):
+        return self.listen_host, self.listen_port
+
+    def start(self):
+        """Start the relay event loop in a background thread"""
+        if self.running:
+            return
+        ready = threading.Event()
+        errors = []
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            try:
+                self._server = self._loop.run_until_complete(self._loop.create_server(
+                    lambda: upstream.stream_protocol(self._handle_client), self.listen_host, self.listen_port))
+                # Pick up the real port when started with port 0
+                self.listen_port = self._server.sockets[0].getsockname()[1]
+            except Exception as e:
+                errors.append(e)
+                ready.set()
+                self._loop.close()
+                return
+            ready.set()
+            self._loop.call_soon(self._sample_buffers)
+            try:
+                self._loop.run_forever()
+            finally:
+                self._loop.run_until_complete(self._shutdown())
+                self._loop.close()
+
+        self._thread = threading.Thread(target=run, name="phh-relay", daemon=True)
+        self._thread.start()
+        ready.wait()
+        if errors:
+            self._thread.join()
+            self._thread = None
+            raise errors[0]
+        self._log(f"Local relay listening on {self.listen_host}:{self.listen_port} "
+                  f"-> {self.describe_chain()}")
+        self._prime_warm_chains()
+
+    def stop(self):
+        """Stop the relay and close all relayed connections"""
+        if not self.running:
+            return
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=5)
+        self._thread = None
+        self._log("Local relay stopped")
+
+    def _sample_buffers(self):
+        # Transports belong to this loop; other threads read the meter's snapshot instead
+        self.meter.sample_buffers()
+        self._loop.call_later(BUFFER_SAMPLE_INTERVAL, self._sample_buffers)
+
+    async def _shutdown(self):
+        self._server.close()
+        await self._server.wait_closed()
+        await self.warm.close()
+        self.udp.close_all()
+        for task in list(self._tasks):
+            task.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _handle_client(self, reader, writer):
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            await self._serve(reader, writer)
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError, OSError):
+            pass
+        except asyncio.CancelledError:
+            # Relay is shutting down; the stream callback must not see a cancelled task
+            pass
+        finally:
+            self._tasks.discard(task)
+            writer.close()
+
+    async def _serve(self, reader, writer):
+        """Detect the client protocol and relay the connection"""
+        first = await reader.readexactly(1)
+        plain_head = None
+        if first == b'\x05':
+            host, port, command = await self._accept_socks5(reader, writer)
+            if command == 3:
+                await self._udp_associate(reader, writer)
+                return
+            reply = b'\x05\x00\x00\x01\x00\x00\x00\x00\x00\x00'
+            failure = b'\x05\x01\x00\x01\x00\x00\x00\x00\x00\x00'
+            initial = b''
+        elif first == b'\x04':
+            host, port = await self._accept_socks4(reader)
+            reply = b'\x00\x5a\x00\x00\x00\x00\x00\x00'
+            failure = b'\x00\x5b\x00\x00\x00\x00\x00\x00'
+            initial = b''
+        else:
+            head = first + await upstream.read_http_head(reader)
+            host, port, initial, reply = self._parse_http_request(head)
+            if initial:
+                plain_head = head
+            failure = b'HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+
+        conn = self.meter.open(host, port)
+        if self.shaper:
+            try:
+                await self.shaper.acquire(host)
+            except ConnectionError as e:
+                self.meter.close(conn, failed=True)
+                self._log(f"Relay: rejected {host}:{port} ({e})")
+                writer.write(failure)
+                await writer.drain()
+                return
+        try:
+            await self._relay(reader, writer, conn, plain_head, initial, reply, failure)
+        finally:
+            if self.shaper:
+                self.shaper.release()
+
+    async def _relay(self, reader, writer, conn, plain_head, initial, reply, failure):
+        """Open the upstream side for an accepted client and pipe data both ways"""
+        host, port = conn.host, conn.port
+        chain = self.chain
+        proxy_type = chain[-1][2]
+        hop_auth = upstream.hop_auth_for(self.auth, chain[-1])
+        started = time.monotonic()
+        try:
+            if len(chain) > 1 and self.warm.size:
+                # Only the last hop's handshake is paid when a warm partial chain is ready
+                up_reader, up_writer = await self.warm.get(chain)
+            else:
+                up_reader, up_writer = await upstream.open_partial_chain(chain, tuning=self.tuning, auth=self.auth)
+            if plain_head and proxy_type == "HTTP/HTTPS" and not hop_auth:
+                # Plain HTTP requests go to an HTTP upstream unchanged (absolute-form)
+                initial = plain_head
+            elif plain_head and proxy_type == "HTTP/HTTPS" and upstream.request_has_body(plain_head):
+                # The body is still with the client, so the answer cannot be awaited here:
+                # credentials go up front once an earlier request or CONNECT learned the scheme
+                initial = upstream.authorize_request(plain_head, hop_auth)
+            elif plain_head and proxy_type == "HTTP/HTTPS":
+                # A 407 (the first request to this proxy, or a stale Digest nonce) is answered
+                # here and the request sent again, instead of reaching the client
+                for attempt in range(2):
+                    try:
+                        reply = await upstream.send_request(up_reader, up_writer, plain_head, hop_auth,
+                                                            final=attempt == 1)
+                        break
+                    except upstream.AuthRetry:
+                        up_reader, up_writer = await upstream.open_partial_chain(chain, tuning=self.tuning,
+                                                                                 auth=self.auth)
+                initial = b''
+            else:
+                try:
+                    await upstream.extend_tunnel(up_reader, up_writer, proxy_type, host, port, hop_auth=hop_auth)
+                except upstream.AuthRetry:
+                    up_reader, up_writer = await upstream.open_partial_chain(chain, tuning=self.tuning,
+                                                                             auth=self.auth)
+                    await upstream.extend_tunnel(up_reader, up_writer, proxy_type, host, port, hop_auth=hop_auth)
+        except Exception as e:
+            self.meter.close(conn, failed=True)
+            self._log(f"Relay: could not reach {host}:{port} via upstream ({e})")
+            writer.write(failure)
+            await writer.drain()
+            return
+        self.meter.connected(conn, time.monotonic() - started)
+
+        client = Pipe(conn, self.meter.count_up, self.shaper)
+        remote = Pipe(conn, self.meter.count_down, self.shaper)
+        client.peer, remote.peer = remote, client
+        conn.client_transport = writer.transport
+        conn.upstream_transport = up_writer.transport
+        try:
+            if reply:
+                writer.write(reply)
+            if initial:
+                up_writer.write(initial)
+                self.meter.count_up(conn, len(initial))
+            client_leftover, client_eof = await take_over(reader, writer, client)
+            remote_leftover, remote_eof = await take_over(up_reader, up_writer, remote)
+            client.forward(client_leftover)
+            remote.forward(remote_leftover)
+            if client_eof:
+                client.eof_received()
+            if remote_eof:
+                remote.eof_received()
+            # StreamReader may have paused reading while it buffered the handshake
+            client.update_reading()
+            remote.update_reading()
+            await asyncio.gather(client.closed, remote.closed)
+        finally:
+            writer.transport.abort()
+            up_writer.transport.abort()
+            self.meter.close(conn)
+
+    async def _accept_socks5(self, reader, writer):
+        """Server side of the SOCKS5 greeting and CONNECT / UDP ASSOCIATE request"""
+        nmethods = (await reader.readexactly(1))[0]
+        methods = await reader.readexactly(nmethods)
+        if 0 not in methods:
+            writer.write(b'\x05\xff')
+            await writer.drain()
+            raise ConnectionError("SOCKS5 client offered no supported auth method")
+        writer.write(b'\x05\x00')
+        await writer.drain()
+        version, command, _ = await reader.readexactly(3)
+        host, port = await upstream.read_socks5_address(reader)
+        if command not in (1, 3):
+            writer.write(b'\x05\x07\x00\x01\x00\x00\x00\x00\x00\x00')
+            await writer.drain()
+            raise ConnectionError(f"Unsupported SOCKS5 command {command}")
+        return host, port, command
+
+    async def _udp_associate(self, reader, writer):
+        """Relay a SOCKS5 UDP ASSOCIATE through the upstream SOCKS5 proxy's UDP relay"""
+        proxy_ip, proxy_port, proxy_type = self.chain[-1]
+        if len(self.chain) > 1 or proxy_type != "SOCKS5":
+            # Only SOCKS5 upstreams relay UDP, and datagrams cannot follow jump hops
+            writer.write(b'\x05\x07\x00\x01\x00\x00\x00\x00\x00\x00')
+            await writer.drain()
+            raise ConnectionError("UDP ASSOCIATE needs a SOCKS5 upstream without jump hops")
+        conn = self.meter.open("UDP", 0)
+        started = time.monotonic()
+        # Bind where the client reached us, so the reported address is one it can use
+        local_host = writer.get_extra_info('sockname')[0]
+        try:
+            association, (host, port) = await self.udp.open(
+                conn, self.meter, local_host, proxy_ip, proxy_port, self.tuning,
+                upstream.hop_auth_for(self.auth, self.chain[-1]))
+        except Exception as e:
+            self.meter.close(conn, failed=True)
+            self._log(f"Relay: UDP ASSOCIATE via upstream failed ({e})")
+            writer.write(b'\x05\x01\x00\x01\x00\x00\x00\x00\x00\x00')
+            await writer.drain()
+            return
+        self.meter.connected(conn, time.monotonic() - started)
+        control = asyncio.ensure_future(self._wait_eof(reader))
+        try:
+            writer.write(b'\x05\x00\x00' + upstream.socks5_address(host, port))
+            # The association lives until the client closes its TCP connection or goes idle
+            await asyncio.wait([control, association.closed], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            control.cancel()
+            association.close()
+            self.meter.close(conn)
+
+    @staticmethod
+    async def _wait_eof(reader):
+        try:
+            while await reader.read(4096):
+                pass
+        except (ConnectionError, OSError):
+            pass
+
+    async def _accept_socks4(self, reader):
+        """Server side of a SOCKS4/4a CONNECT request"""
+        command, port = struct.unpack('>BH', await reader.readexactly(3))
+        address = await reader.readexactly(4)
+        await reader.readuntil(b'\x00')  # user id
+        if command != 1:
+            raise ConnectionError(f"Unsupported SOCKS4 command {command}")
+        if address[:3] == b'\x00\x00\x00' and address[3] != 0:
+            host = (await reader.readuntil(b'\x00'))[:-1].decode('idna')
+        else:
+            host = str(ipaddress.IPv4Address(address))
+        return host, port
+
+    def _parse_http_request(self, head):
+        """Return (host, port, initial_bytes, reply) for an HTTP client request"""
+        request_line, _, rest = head.partition(b'\r\n')
+        try:
+            method, target, version = request_line.decode('latin-1').split(' ')
+        except ValueError:
+            raise ConnectionError(f"Malformed HTTP request line: {request_line!r}")
+        if method.upper() == 'CONNECT':
+            host, _, port = target.rpartition(':')
+            if not host or not port.isdigit():
+                raise ConnectionError(f"Malformed CONNECT target: {target}")
+            return host.strip('[]'), int(port), b'', b'HTTP/1.1 200 Connection established\r\n\r\n'
+        url = urlsplit(target)
+        if url.scheme != 'http' or not url.hostname:
+            raise ConnectionError(f"Unsupported request target: {target}")
+        # Origin-form request line for SOCKS tunnels; HTTP upstreams get the original head
+        path = url.path or '/'
+        if url.query:
+            path += '?' + url.query
+        origin_head = f"{method} {path} {version}".encode('latin-1') + b'\r\n' + rest
+        return url.hostname, url.port or 80, origin_head, b''
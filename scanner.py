@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Concurrent proxy list scanner for the PHH VPN Client
+Checks thousands of candidate ip:port entries with a bounded number of
+concurrent probes, detects HTTP/SOCKS4/SOCKS5 support and ranks the
+reachable ones by latency.
+"""
+
+import asyncio
+import time
+
+import upstream
+
+# Maximum number of probe sockets open at the same time
+DEFAULT_CONCURRENCY = 200
+
+# Seconds allowed for each connect / handshake
+DEFAULT_TIMEOUT = 5
+
+# Destination used to verify that a proxy actually tunnels traffic (SOCKS tunnels to it,
+# HTTP proxies are asked for http://target/ in absolute form)
+DEFAULT_TARGET = ('httpbin.org', 80)
+
+# Order in which protocols are preferred when filling in the GUI
+PROTOCOL_PREFERENCE = ["HTTP/HTTPS", "SOCKS5", "SOCKS4"]
+
+
+class ScanResult:
+    """Outcome of probing one candidate proxy"""
+    __slots__ = ('host', 'port', 'reachable', 'connect_ms', 'protocols', 'error')
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reachable = False
+        self.connect_ms = None
+        # proxy type -> tunnel setup latency in milliseconds
+        self.protocols = {}
+        self.error = None
+
+    @property
+    def best_type(self):
+        """Preferred supported proxy type, or None"""
+        for proxy_type in PROTOCOL_PREFERENCE:
+            if proxy_type in self.protocols:
+                return proxy_type
+        return None
+
+    @property
+    def latency_ms(self):
+        """Fastest tunnel setup latency across supported protocols"""
+        if not self.protocols:
+            return None
+        return min(self.protocols.values())
+
+    def to_dict(self):
+        return {
+            'host': self.host,
+            'port': self.port,
+            'reachable': self.reachable,
+            'connect_ms': self.connect_ms,
+            'protocols': dict(self.protocols),
+            'best_type': self.best_type,
+            'error': self.error,
+        }
+
+    def __str__(self):
+        if not self.reachable:
+            return f"{self.host}:{self.port}  unreachable ({self.error})"
+        protocols = ", ".join(f"{p} {ms:.0f} ms" for p, ms in self.protocols.items()) or "no protocol"
+        return f"{self.host}:{self.port}  connect {self.connect_ms:.0f} ms  [{protocols}]"
+
+
+def parse_candidate(line):
+    """Parse 'ip:port', '[ipv6]:port' or 'ip port'; returns (host, port) or None"""
+    line = line.split('#', 1)[0].strip()
+    if not line:
+        return None
+    if ' ' in line or '\t' in line:
+        parts = line.split()
+        host, port = parts[-2], parts[-1]
+    elif line.startswith('['):
+        host, _, port = line[1:].partition(']:')
+    else:
+        host, _, port = line.rpartition(':')
+    if not host or not port.isdigit() or not 0 < int(port) < 65536:
+        return None
+    return host, int(port)
+
+
+def load_candidates(path):
+    """Read a candidate list file, skipping comments, junk and duplicates"""
+    seen = set()
+    candidates = []
+    with open(path, 'r') as f:
+        for line in f:
+            candidate = parse_candidate(line)
+            if candidate and candidate not in seen:
+                seen.add(candidate)
+                candidates.append(candidate)
+    return candidates
+
+
+class _NoLimit:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+async def http_get(reader, writer, host, port):
+    """Absolute-form GET for http://host:port/ on an open HTTP proxy connection"""
+    authority = f"[{host}]:{port}" if upstream.is_ip_literal(host) == 6 else f"{host}:{port}"
+    writer.write(f"GET http://{authority}/ HTTP/1.1\r\nHost: {authority}\r\n"
+                 f"Connection: close\r\n\r\n".encode('latin-1'))
+    await writer.drain()
+    status_line, status, _ = upstream.parse_response_head(await upstream.read_http_head(reader))
+    if not 200 <= status < 400:
+        raise ConnectionError(f"HTTP proxy answered {status_line}")
+
+
+async def _open_probe(result, proxy_type, target, timeout):
+    if proxy_type != "HTTP/HTTPS":
+        return await upstream.open_tunnel(result.host, result.port, proxy_type, target[0], target[1], timeout)
+    # Plain HTTP goes out as an absolute-form request, like a browser sends it: many
+    # proxies (Squid's default ACLs among them) refuse CONNECT to anything but port 443
+    reader, writer = await upstream.open_connection(result.host, result.port, timeout)
+    try:
+        await asyncio.wait_for(http_get(reader, writer, target[0], target[1]), timeout)
+    except BaseException:
+        writer.close()
+        raise
+    return reader, writer
+
+
+async def _probe_protocol(result, proxy_type, target, timeout, slots):
+    async with slots:
+        started = time.monotonic()
+        try:
+            reader, writer = await _open_probe(result, proxy_type, target, timeout)
+        except (OSError, ConnectionError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError):
+            return
+        writer.close()
+    result.protocols[proxy_type] = (time.monotonic() - started) * 1000.0
+
+
+async def probe(host, port, target=DEFAULT_TARGET, timeout=DEFAULT_TIMEOUT,
+                protocols=PROTOCOL_PREFERENCE, slots=None):
+    """Check reachability and protocol support of one candidate (slots bounds open sockets)"""
+    slots = slots or _NoLimit()
+    result = ScanResult(host, port)
+    async with slots:
+        started = time.monotonic()
+        try:
+            reader, writer = await upstream.open_connection(host, port, timeout)
+        except asyncio.TimeoutError:
+            result.error = "timed out"
+            return result
+        except OSError as e:
+            result.error = e.strerror or str(e)
+            return result
+        result.connect_ms = (time.monotonic() - started) * 1000.0
+        writer.close()
+    result.reachable = True
+    await asyncio.gather(*(_probe_protocol(result, p, target, timeout, slots) for p in protocols))
+    # Keep a stable, preference-ordered view
+    result.protocols = {p: result.protocols[p] for p in protocols if p in result.protocols}
+    return result
+
+
+async def scan(candidates, concurrency=DEFAULT_CONCURRENCY, target=DEFAULT_TARGET,
+               timeout=DEFAULT_TIMEOUT, progress=None):
+    """Probe all candidates with at most `concurrency` sockets open; returns all results"""
+    slots = asyncio.Semaphore(concurrency)
+    results = []
+    done = 0
+
+    async def run(host, port):
+        nonlocal done
+        result = await probe(host, port, target, timeout, slots=slots)
+        results.append(result)
+        done += 1
+        if progress:
+            progress(done, len(candidates), result)
+
+    await asyncio.gather(*(run(host, port) for host, port in candidates))
+    return results
+
+
+def rank(results, limit=None):
+    """Working proxies ordered by latency (fastest first)"""
+    working = [r for r in results if r.protocols]
+    working.sort(key=lambda r: (r.latency_ms, r.connect_ms))
+    return working[:limit] if limit else working
+
+
+def scan_file(path, concurrency=DEFAULT_CONCURRENCY, target=DEFAULT_TARGET,
+              timeout=DEFAULT_TIMEOUT, progress=None):
+    """Blocking helper: load a candidate list and scan it"""
+    candidates = load_candidates(path)
+    return asyncio.run(scan(candidates, concurrency, target, timeout, progress))
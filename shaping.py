@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Bandwidth shaping and connection limits for the PHH VPN local relay
+Token buckets run on the relay's event loop, so no locking is needed. All
+per-destination state is kept in bounded tables.
+"""
+
+import asyncio
+import os
+import time
+from collections import OrderedDict, deque
+
+# Upper bound on per-destination buckets kept alive at once
+MAX_HOST_BUCKETS = 1024
+
+# Upper bound on connections waiting for a free upstream slot
+MAX_QUEUED_CONNECTIONS = 1024
+
+
+class TokenBucket:
+    """Token bucket allowing short bursts above a sustained byte rate"""
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def delay(self, n, now):
+        """Take n tokens (going into debt if needed) and return seconds to wait"""
+        tokens = self.tokens + (now - self.updated) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+        tokens -= n
+        self.tokens = tokens
+        self.updated = now
+        if tokens >= 0:
+            return 0.0
+        return -tokens / self.rate
+
+
+class ConnectionLimiter:
+    """Cap on concurrent upstream connections with round-robin queueing per destination"""
+
+    def __init__(self, max_active, max_queued=MAX_QUEUED_CONNECTIONS):
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self.active = 0
+        self.queued = 0
+        # destination -> deque of waiting futures, rotated for fairness
+        self._waiters = OrderedDict()
+
+    async def acquire(self, key):
+        """Wait for a free upstream slot; destinations take turns when saturated"""
+        if self.active < self.max_active and not self.queued:
+            self.active += 1
+            return
+        if self.queued >= self.max_queued:
+            raise ConnectionError("Too many connections waiting for an upstream slot")
+        future = asyncio.get_running_loop().create_future()
+        queue = self._waiters.get(key)
+        if queue is None:
+            queue = self._waiters[key] = deque()
+        queue.append(future)
+        self.queued += 1
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Slot was handed over just as we were cancelled; pass it on
+                self.release()
+            else:
+                self._discard(key, future)
+            raise
+
+    def release(self):
+        """Free a slot and hand it to the next destination in turn"""
+        while self._waiters:
+            key, queue = next(iter(self._waiters.items()))
+            future = queue.popleft()
+            self.queued -= 1
+            if queue:
+                self._waiters.move_to_end(key)
+            else:
+                del self._waiters[key]
+            if not future.done():
+                # Slot transfers directly, active count stays the same
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    def _discard(self, key, future):
+        queue = self._waiters.get(key)
+        if queue is None:
+            return
+        try:
+            queue.remove(future)
+            self.queued -= 1
+        except ValueError:
+            return
+        if not queue:
+            del self._waiters[key]
+
+
+class Shaper:
+    """Global and per-destination rate limits plus an upstream connection cap"""
+
+    def __init__(self, global_rate=0, host_rate=0, max_connections=0,
+                 max_host_buckets=MAX_HOST_BUCKETS):
+        self.global_rate = global_rate
+        self.host_rate = host_rate
+        self.max_host_buckets = max_host_buckets
+        self.global_bucket = TokenBucket(global_rate) if global_rate else None
+        self.host_buckets = OrderedDict()
+        self.limiter = ConnectionLimiter(max_connections) if max_connections else None
+        self.throttled_time = 0.0
+
+    @classmethod
+    def from_env(cls):
+        """Build a shaper from RELAY_RATE_LIMIT / RELAY_HOST_RATE_LIMIT (KB/s) and RELAY_MAX_CONNECTIONS"""
+        global_rate = int(os.getenv('RELAY_RATE_LIMIT', '0') or 0) * 1024
+        host_rate = int(os.getenv('RELAY_HOST_RATE_LIMIT', '0') or 0) * 1024
+        max_connections = int(os.getenv('RELAY_MAX_CONNECTIONS', '0') or 0)
+        if not (global_rate or host_rate or max_connections):
+            return None
+        return cls(global_rate, host_rate, max_connections)
+
+    @property
+    def enabled(self):
+        return bool(self.global_bucket or self.host_rate)
+
+    def host_bucket(self, host):
+        """Return the bucket for a destination, evicting the least recently used"""
+        bucket = self.host_buckets.get(host)
+        if bucket is None:
+            if len(self.host_buckets) >= self.max_host_buckets:
+                self.host_buckets.popitem(last=False)
+            bucket = self.host_buckets[host] = TokenBucket(self.host_rate)
+        else:
+            self.host_buckets.move_to_end(host)
+        return bucket
+
+    def reserve(self, host, n):
+        """Account n bytes to/from host; returns seconds the caller should pause"""
+        now = time.monotonic()
+        wait = 0.0
+        if self.global_bucket:
+            wait = self.global_bucket.delay(n, now)
+        if self.host_rate:
+            wait = max(wait, self.host_bucket(host).delay(n, now))
+        if wait > 0:
+            self.throttled_time += wait
+        return wait
+
+    async def acquire(self, host):
+        """Wait for an upstream connection slot"""
+        if self.limiter:
+            await self.limiter.acquire(host)
+
+    def release(self):
+        """Return an upstream connection slot"""
+        if self.limiter:
+            self.limiter.release()
+
+    def snapshot(self):
+        """Plain dict view for status/metrics output"""
+        return {
+            'global_rate': self.global_rate,
+            'host_rate': self.host_rate,
+            'host_buckets': len(self.host_buckets),
+            'max_connections': self.limiter.max_active if self.limiter else 0,
+            'active_connections': self.limiter.active if self.limiter else 0,
+            'queued_connections': self.limiter.queued if self.limiter else 0,
+            'throttled_seconds': self.throttled_time,
+        }
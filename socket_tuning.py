@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Upstream socket tuning for the PHH VPN Client
+One set of TCP options applied to every socket opened towards a proxy
+(health probes, relay tunnels, warm partial chains): TCP_NODELAY, keepalive
+timers that notice dead idle connections, fixed send/receive buffer sizes
+and, on Linux, TCP Fast Open so a reconnect to a known proxy sends its
+handshake request in the SYN.
+"""
+
+import os
+import socket
+import sys
+
+# Keepalive defaults (seconds): an idle connection is probed after
+# KEEPALIVE_IDLE and dropped after KEEPALIVE_COUNT unanswered probes, 30 s in
+# all. That is for long-lived tunnels: warm partial chains use shorter timers
+# while they wait in the pool (relay.WARM_KEEPALIVE_*)
+KEEPALIVE_IDLE = 15
+KEEPALIVE_INTERVAL = 5
+KEEPALIVE_COUNT = 3
+
+# Linux option (not exported by the socket module): connect() succeeds at once
+# when a Fast Open cookie is cached and the first write goes out in the SYN
+TCP_FASTOPEN_CONNECT = 30 if sys.platform.startswith('linux') else None
+
+# tcp_info.tcpi_options bit set when data sent in the SYN was acknowledged
+TCPI_OPT_SYN_DATA = 0x20
+
+
+def set_keepalive(sock, idle, interval, count=KEEPALIVE_COUNT):
+    """Enable keepalive probes with the given timers where the platform allows"""
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+    elif hasattr(socket, 'TCP_KEEPALIVE'):
+        # macOS names the idle timer TCP_KEEPALIVE
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, idle)
+    elif hasattr(socket, 'SIO_KEEPALIVE_VALS'):
+        # Older Windows: idle and interval in ms, the probe count is fixed
+        sock.ioctl(socket.SIO_KEEPALIVE_VALS, (1, idle * 1000, interval * 1000))
+        return
+    if hasattr(socket, 'TCP_KEEPINTVL'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+    if hasattr(socket, 'TCP_KEEPCNT'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
+
+
+def syn_data_acked(sock):
+    """True if the kernel reports that data sent in the SYN was accepted (Linux only)"""
+    if not hasattr(socket, 'TCP_INFO'):
+        return False
+    try:
+        info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 8)
+    except OSError:
+        return False
+    return bool(info[5] & TCPI_OPT_SYN_DATA)
+
+
+class SocketTuning:
+    """TCP options for upstream sockets; 0 means the kernel default"""
+
+    def __init__(self, nodelay=True, keepalive_idle=KEEPALIVE_IDLE, keepalive_interval=KEEPALIVE_INTERVAL,
+                 sndbuf=0, rcvbuf=0, fastopen=False):
+        self.nodelay = nodelay
+        self.keepalive_idle = int(keepalive_idle)
+        self.keepalive_interval = max(1, int(keepalive_interval))
+        self.sndbuf = int(sndbuf)
+        self.rcvbuf = int(rcvbuf)
+        self.fastopen = fastopen
+
+    @classmethod
+    def from_env(cls):
+        """Build from the UPSTREAM_* variables (keepalive timers in s, buffer sizes in KB)"""
+        return cls(nodelay=os.getenv('UPSTREAM_NODELAY', '1') == '1',
+                   keepalive_idle=int(os.getenv('UPSTREAM_KEEPALIVE', str(KEEPALIVE_IDLE)) or 0),
+                   keepalive_interval=int(os.getenv('UPSTREAM_KEEPALIVE_INTERVAL', str(KEEPALIVE_INTERVAL)) or 1),
+                   sndbuf=int(os.getenv('UPSTREAM_SNDBUF', '0') or 0) * 1024,
+                   rcvbuf=int(os.getenv('UPSTREAM_RCVBUF', '0') or 0) * 1024,
+                   fastopen=os.getenv('UPSTREAM_FASTOPEN', '0') == '1')
+
+    def copy(self, **changes):
+        options = dict(nodelay=self.nodelay, keepalive_idle=self.keepalive_idle,
+                       keepalive_interval=self.keepalive_interval, sndbuf=self.sndbuf,
+                       rcvbuf=self.rcvbuf, fastopen=self.fastopen)
+        options.update(changes)
+        return SocketTuning(**options)
+
+    @property
+    def fastopen_supported(self):
+        return TCP_FASTOPEN_CONNECT is not None
+
+    def apply(self, sock):
+        """Set the options on a new TCP socket; call before connect so buffer sizes shape the window"""
+        if self.nodelay:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # Fixed sizes switch off the kernel's buffer autotuning for this socket
+        if self.sndbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+        if self.rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+        if self.keepalive_idle:
+            set_keepalive(sock, self.keepalive_idle, self.keepalive_interval)
+        if self.fastopen and self.fastopen_supported:
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, TCP_FASTOPEN_CONNECT, 1)
+            except OSError:
+                # Kernels before 4.11 lack the option; connect normally
+                pass
+
+    def __str__(self):
+        parts = ["nodelay" if self.nodelay else "no nodelay"]
+        if self.keepalive_idle:
+            parts.append(f"keepalive {self.keepalive_idle}s/{self.keepalive_interval}s")
+        if self.sndbuf or self.rcvbuf:
+            parts.append(f"buffers {self.sndbuf // 1024 or 'auto'}/{self.rcvbuf // 1024 or 'auto'} KB")
+        if self.fastopen:
+            parts.append("fast open" if self.fastopen_supported else "fast open (unsupported here)")
+        return ", ".join(parts)
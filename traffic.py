@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""
+Traffic accounting for the PHH VPN local relay
+Counters are plain __slots__ records updated in place on the relay hot path;
+throughput and latency history live in fixed-size arrays used as ring buffers.
+"""
+
+import threading
+import time
+from array import array
+
+# Number of samples kept for the throughput/latency sparklines
+HISTORY_SIZE = 120
+
+# Upper bound on tracked destination hosts (least recently used are dropped)
+MAX_TRACKED_HOSTS = 256
+
+
+class HostStats:
+    """Aggregated counters for one destination host"""
+    __slots__ = ('host', 'connections', 'active', 'bytes_up', 'bytes_down',
+                 'connect_time_total', 'connect_count', 'last_seen')
+
+    def __init__(self, host):
+        self.host = host
+        self.connections = 0
+        self.active = 0
+        self.bytes_up = 0
+        self.bytes_down = 0
+        self.connect_time_total = 0.0
+        self.connect_count = 0
+        self.last_seen = time.monotonic()
+
+    def avg_connect_ms(self):
+        """Average upstream connect latency in milliseconds"""
+        if not self.connect_count:
+            return 0.0
+        return self.connect_time_total / self.connect_count * 1000.0
+
+
+class ConnStats:
+    """Counters for one relayed connection"""
+    __slots__ = ('conn_id', 'host', 'port', 'opened', 'connect_time',
+                 'bytes_up', 'bytes_down', 'host_stats', 'pauses',
+                 'client_transport', 'upstream_transport', 'buffered_up', 'buffered_down')
+
+    def __init__(self, conn_id, host, port, host_stats):
+        self.conn_id = conn_id
+        self.host = host
+        self.port = port
+        self.opened = time.monotonic()
+        self.connect_time = None
+        self.bytes_up = 0
+        self.bytes_down = 0
+        self.host_stats = host_stats
+        self.pauses = 0
+        self.client_transport = None
+        self.upstream_transport = None
+        self.buffered_up = 0
+        self.buffered_down = 0
+
+    def sample_buffers(self):
+        """Read the write buffer sizes; only the relay loop, which owns the transports, may call this"""
+        self.buffered_up = self.upstream_transport.get_write_buffer_size() if self.upstream_transport else 0
+        self.buffered_down = self.client_transport.get_write_buffer_size() if self.client_transport else 0
+
+    def buffered(self):
+        """Bytes waiting in the (upstream, client) write buffers at the last sample_buffers()"""
+        return self.buffered_up, self.buffered_down
+
+
+class TrafficMeter:
+    """Per-connection and per-host byte/latency counters with rate history"""
+
+    def __init__(self, history_size=HISTORY_SIZE, max_hosts=MAX_TRACKED_HOSTS):
+        self.history_size = history_size
+        self.max_hosts = max_hosts
+        self.total_up = 0
+        self.total_down = 0
+        self.total_connections = 0
+        self.failed_connections = 0
+        self.connections = {}
+        self.hosts = {}
+        self.up_rate = array('d', bytes(8 * history_size))
+        self.down_rate = array('d', bytes(8 * history_size))
+        self.latency_ms = array('d', bytes(8 * history_size))
+        self._pos = 0
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self._last_sample = time.monotonic()
+        self._last_up = 0
+        self._last_down = 0
+        self._interval_connect_time = 0.0
+        self._interval_connect_count = 0
+
+    def open(self, host, port):
+        """Register a new relayed connection and return its counters"""
+        with self._lock:
+            host_stats = self.hosts.pop(host, None)
+            if host_stats is None:
+                host_stats = HostStats(host)
+                if len(self.hosts) >= self.max_hosts:
+                    # Dicts keep insertion order, so the first key is the stalest host;
+                    # prefer an idle one, but stay within the bound even if all are active
+                    stale = next((name for name, stats in self.hosts.items() if not stats.active),
+                                 next(iter(self.hosts)))
+                    # Open connections keep counting into the detached record
+                    del self.hosts[stale]
+            # Re-insert so the most recently used host sits at the end
+            self.hosts[host] = host_stats
+            host_stats.connections += 1
+            host_stats.active += 1
+            host_stats.last_seen = time.monotonic()
+            self._next_id += 1
+            conn = ConnStats(self._next_id, host, port, host_stats)
+            self.connections[conn.conn_id] = conn
+            self.total_connections += 1
+        return conn
+
+    def connected(self, conn, elapsed):
+        """Record how long the upstream tunnel took to establish"""
+        conn.connect_time = elapsed
+        conn.host_stats.connect_time_total += elapsed
+        conn.host_stats.connect_count += 1
+        self._interval_connect_time += elapsed
+        self._interval_connect_count += 1
+
+    def count_up(self, conn, n):
+        """Count bytes sent from the local client towards the upstream"""
+        conn.bytes_up += n
+        conn.host_stats.bytes_up += n
+        self.total_up += n
+
+    def count_down(self, conn, n):
+        """Count bytes sent from the upstream back to the local client"""
+        conn.bytes_down += n
+        conn.host_stats.bytes_down += n
+        self.total_down += n
+
+    def close(self, conn, failed=False):
+        """Unregister a finished connection"""
+        with self._lock:
+            if self.connections.pop(conn.conn_id, None) is None:
+                return
+            conn.host_stats.active -= 1
+            conn.host_stats.last_seen = time.monotonic()
+            if failed:
+                self.failed_connections += 1
+
+    def sample(self, now=None):
+        """Push one throughput/latency sample into the history ring buffers"""
+        if now is None:
+            now = time.monotonic()
+        elapsed = now - self._last_sample
+        if elapsed <= 0:
+            return
+        total_up, total_down = self.total_up, self.total_down
+        pos = self._pos
+        self.up_rate[pos] = (total_up - self._last_up) / elapsed
+        self.down_rate[pos] = (total_down - self._last_down) / elapsed
+        count = self._interval_connect_count
+        if count:
+            self.latency_ms[pos] = self._interval_connect_time / count * 1000.0
+        else:
+            # Carry the last latency forward so the line does not drop to zero when idle
+            self.latency_ms[pos] = self.latency_ms[pos - 1]
+        self._interval_connect_time = 0.0
+        self._interval_connect_count = 0
+        self._pos = (pos + 1) % self.history_size
+        self._last_sample = now
+        self._last_up = total_up
+        self._last_down = total_down
+
+    def history(self, series):
+        """Return a ring buffer in chronological order (oldest first)"""
+        pos = self._pos
+        return series[pos:] + series[:pos]
+
+    def current_rates(self):
+        """Most recent (up, down, latency_ms) sample"""
+        pos = self._pos - 1
+        return self.up_rate[pos], self.down_rate[pos], self.latency_ms[pos]
+
+    def sample_buffers(self):
+        """Snapshot every connection's write buffers (relay loop only); returns the total"""
+        with self._lock:
+            conns = list(self.connections.values())
+        for c in conns:
+            c.sample_buffers()
+        return sum(c.buffered_up + c.buffered_down for c in conns)
+
+    def buffered_bytes(self):
+        """Total bytes waiting in relay write buffers across active connections, as last sampled"""
+        with self._lock:
+            conns = list(self.connections.values())
+        return sum(sum(c.buffered()) for c in conns)
+
+    def top_hosts(self, limit=5):
+        """Destination hosts ordered by total bytes transferred"""
+        with self._lock:
+            hosts = list(self.hosts.values())
+        hosts.sort(key=lambda h: h.bytes_up + h.bytes_down, reverse=True)
+        return hosts[:limit]
+
+    def snapshot(self):
+        """Plain dict view of the counters for status/metrics output"""
+        with self._lock:
+            conns = list(self.connections.values())
+        up, down, latency = self.current_rates()
+        buffered = [c.buffered() for c in conns]
+        return {
+            'total_up': self.total_up,
+            'total_down': self.total_down,
+            'total_connections': self.total_connections,
+            'failed_connections': self.failed_connections,
+            'active_connections': len(conns),
+            'buffered_bytes': sum(u + d for u, d in buffered),
+            'up_rate': up,
+            'down_rate': down,
+            'latency_ms': latency,
+            'connections': [
+                {'id': c.conn_id, 'host': c.host, 'port': c.port,
+                 'bytes_up': c.bytes_up, 'bytes_down': c.bytes_down,
+                 'buffered_up': b[0], 'buffered_down': b[1], 'pauses': c.pauses,
+                 'connect_ms': (c.connect_time or 0.0) * 1000.0}
+                for c, b in zip(conns, buffered)
+            ],
+            'hosts': [
+                {'host': h.host, 'connections': h.connections, 'active': h.active,
+                 'bytes_up': h.bytes_up, 'bytes_down': h.bytes_down,
+                 'avg_connect_ms': h.avg_connect_ms()}
+                for h in self.top_hosts(10)
+            ],
+        }
+
+
+def format_bytes(value, suffix=''):
+    """Human readable byte count"""
+    for unit in ('B', 'KB', 'MB'):
+        if value < 1024:
+            return f"{value:.0f} {unit}{suffix}" if unit == 'B' else f"{value:.1f} {unit}{suffix}"
+        value /= 1024.0
+    return f"{value:.1f} GB{suffix}"
+
+
+def format_rate(value):
+    """Human readable bytes-per-second"""
+    return format_bytes(value, '/s')
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+SOCKS5 UDP ASSOCIATE support for the PHH VPN local relay
+Datagrams carry the same SOCKS5 UDP request header on both legs, so they are
+forwarded unchanged between the local client and the upstream proxy's UDP
+relay. Sockets are read directly from the event loop into one shared receive
+buffer, so no per-datagram buffers or protocol objects are created.
+"""
+
+import asyncio
+import socket
+import time
+
+import upstream
+
+# Largest datagram accepted on either leg
+MAX_DATAGRAM = 65535
+
+# Seconds without traffic after which an association is closed
+UDP_IDLE_TIMEOUT = 60
+
+# Upper bound on live associations (the least recently active one is evicted)
+MAX_UDP_ASSOCIATIONS = 256
+
+# Datagrams handled per readiness callback before yielding to other connections
+BATCH = 64
+
+
+class UdpAssociation:
+    """One client's UDP ASSOCIATE session, mirrored onto the upstream SOCKS5 proxy"""
+
+    def __init__(self, loop, buffer, conn, meter, timeout):
+        self.loop = loop
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+        self.conn = conn
+        self.meter = meter
+        self.timeout = timeout
+        self.client_sock = None
+        self.upstream_sock = None
+        self.control_writer = None
+        self.client_addr = None
+        self.last_active = time.monotonic()
+        self.closed = loop.create_future()
+        self._timer = None
+
+    async def open(self, listen_host, proxy_ip, proxy_port, tuning=None, hop_auth=None):
+        """Ask the upstream for a UDP relay and bind the local side; returns the local address"""
+        reader, writer = await upstream.open_connection(proxy_ip, proxy_port, tuning=tuning)
+        self.control_writer = writer
+        relay_host, relay_port = await asyncio.wait_for(
+            upstream.socks5_request(reader, writer, 3, '0.0.0.0', 0, hop_auth), upstream.CONNECT_TIMEOUT)
+        if relay_host in ('0.0.0.0', '::'):
+            # "Same address as the TCP connection"
+            relay_host = writer.get_extra_info('peername')[0]
+        family, _, _, _, relay_addr = (await self.loop.getaddrinfo(
+            relay_host, relay_port, type=socket.SOCK_DGRAM))[0]
+        self.upstream_sock = socket.socket(family, socket.SOCK_DGRAM)
+        self.upstream_sock.setblocking(False)
+        self.upstream_sock.connect(relay_addr)
+        self.client_sock = socket.socket(socket.AF_INET6 if ':' in listen_host else socket.AF_INET,
+                                         socket.SOCK_DGRAM)
+        self.client_sock.setblocking(False)
+        self.client_sock.bind((listen_host, 0))
+        self.loop.add_reader(self.client_sock.fileno(), self._from_client)
+        self.loop.add_reader(self.upstream_sock.fileno(), self._from_upstream)
+        # The association ends when the upstream drops its control connection
+        self.loop.create_task(self._watch_control(reader))
+        self._timer = self.loop.call_later(self.timeout, self._check_idle)
+        return self.client_sock.getsockname()[:2]
+
+    async def _watch_control(self, reader):
+        try:
+            while await reader.read(4096):
+                pass
+        except (ConnectionError, OSError):
+            pass
+        self.close()
+
+    def _from_client(self):
+        view = self.view
+        for _ in range(BATCH):
+            try:
+                n, addr = self.client_sock.recvfrom_into(self.buffer)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                continue
+            # RSV RSV FRAG ATYP ...; fragments are not supported (RFC 1928 allows dropping them)
+            if n < 4 or view[2] != 0:
+                continue
+            if self.client_addr is None:
+                self.client_addr = addr
+            elif addr != self.client_addr:
+                continue
+            try:
+                self.upstream_sock.send(view[:n])
+            except OSError:
+                # Full send buffer or ICMP error: drop, as UDP would
+                continue
+            self.last_active = time.monotonic()
+            self.meter.count_up(self.conn, n)
+
+    def _from_upstream(self):
+        view = self.view
+        for _ in range(BATCH):
+            try:
+                n = self.upstream_sock.recv_into(self.buffer)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                continue
+            if self.client_addr is None or n < 4:
+                continue
+            try:
+                self.client_sock.sendto(view[:n], self.client_addr)
+            except OSError:
+                continue
+            self.last_active = time.monotonic()
+            self.meter.count_down(self.conn, n)
+
+    def _check_idle(self):
+        idle = time.monotonic() - self.last_active
+        if idle >= self.timeout:
+            self.close()
+        else:
+            self._timer = self.loop.call_later(self.timeout - idle, self._check_idle)
+
+    def close(self):
+        if self.closed.done():
+            return
+        if self._timer:
+            self._timer.cancel()
+        for sock in (self.client_sock, self.upstream_sock):
+            if sock is not None:
+                self.loop.remove_reader(sock.fileno())
+                sock.close()
+        if self.control_writer:
+            self.control_writer.close()
+        self.closed.set_result(None)
+
+
+class UdpAssociations:
+    """Bounded table of live UDP associations sharing one receive buffer"""
+
+    def __init__(self, max_associations=MAX_UDP_ASSOCIATIONS, timeout=UDP_IDLE_TIMEOUT):
+        self.max_associations = max_associations
+        self.timeout = timeout
+        self.active = set()
+        self.evicted = 0
+        # Safe to share: every read is forwarded before the callback returns
+        self.buffer = bytearray(MAX_DATAGRAM)
+
+    async def open(self, conn, meter, listen_host, proxy_ip, proxy_port, tuning=None, hop_auth=None):
+        """Create an association; returns it together with the local address to report"""
+        if len(self.active) >= self.max_associations:
+            # Associations still being set up hold their slot but are not evicted
+            ready = [a for a in self.active if a.client_sock is not None]
+            if not ready:
+                raise ConnectionError("Too many UDP associations are being set up")
+            min(ready, key=lambda a: a.last_active).close()
+            self.evicted += 1
+        association = UdpAssociation(asyncio.get_running_loop(), self.buffer, conn, meter, self.timeout)
+        # Take the slot before the handshake so concurrent opens cannot overshoot the limit
+        self.active.add(association)
+        association.closed.add_done_callback(lambda _: self.active.discard(association))
+        try:
+            address = await association.open(listen_host, proxy_ip, proxy_port, tuning, hop_auth)
+        except BaseException:
+            association.close()
+            raise
+        return association, address
+
+    def close_all(self):
+        for association in list(self.active):
+            association.close()
@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+"""
+Upstream proxy handshakes for the PHH VPN local relay
+Opens a tunnel to a destination host through an HTTP (CONNECT), SOCKS4/4a
+or SOCKS5 proxy using asyncio streams, authenticating with the proxy's
+cached scheme (proxy_auth.py) when it has credentials.
+"""
+
+import asyncio
+import ipaddress
+import struct
+
+import happy_eyeballs
+
+# Seconds allowed for connecting to the upstream and completing the handshake
+CONNECT_TIMEOUT = 10
+
+# Upper bound on an HTTP response head from the upstream proxy
+MAX_HEAD_SIZE = 65536
+
+
+def is_ip_literal(host):
+    """Return 4 or 6 for IP literals, None for hostnames"""
+    try:
+        return ipaddress.ip_address(host).version
+    except ValueError:
+        return None
+
+
+async def read_http_head(reader, limit=MAX_HEAD_SIZE):
+    """Read an HTTP message head (up to and including the blank line)"""
+    try:
+        return await reader.readuntil(b'\r\n\r\n')
+    except asyncio.LimitOverrunError:
+        raise ConnectionError("HTTP head too large")
+    except asyncio.IncompleteReadError as e:
+        if len(e.partial) > limit:
+            raise ConnectionError("HTTP head too large")
+        raise ConnectionError("Connection closed while reading HTTP head")
+
+
+class AuthRetry(ConnectionError):
+    """The proxy sent an authentication challenge and closed the connection; reconnect and retry"""
+
+
+def parse_response_head(head):
+    """(status line, status code, [(lower-case header name, value)]) of an HTTP response head"""
+    lines = head.decode('latin-1').split('\r\n')
+    parts = lines[0].split(' ', 2)
+    if len(parts) < 2 or not parts[1].isdigit():
+        raise ConnectionError(f"Malformed proxy response: {lines[0]!r}")
+    headers = []
+    for line in lines[1:]:
+        name, sep, value = line.partition(':')
+        if sep:
+            headers.append((name.strip().lower(), value.strip()))
+    return lines[0], int(parts[1]), headers
+
+
+async def discard_body(reader, status_line, headers):
+    """Skip a response body; True if the connection can carry another request"""
+    values = {name: value.lower() for name, value in headers}
+    keep_alive = 'keep-alive' in (values.get('proxy-connection') or values.get('connection', ''))
+    if 'close' in values.get('proxy-connection', '') + values.get('connection', ''):
+        return False
+    if status_line.startswith('HTTP/1.0') and not keep_alive:
+        return False
+    length = values.get('content-length', '')
+    if not length.isdigit() or int(length) > MAX_HEAD_SIZE:
+        # Chunked or delimited by close: not worth parsing for a retry
+        return False
+    await reader.readexactly(int(length))
+    return True
+
+
+async def http_connect(reader, writer, host, port, hop_auth=None):
+    """Issue an HTTP CONNECT on an open upstream connection"""
+    authority = f"[{host}]:{port}" if is_ip_literal(host) == 6 else f"{host}:{port}"
+    for attempt in range(2):
+        request = f"CONNECT {authority} HTTP/1.1\r\nHost: {authority}\r\n"
+        credentials = hop_auth.header('CONNECT', authority) if hop_auth else None
+        if credentials:
+            # Sent up front once the proxy's scheme is known: no 407 round trip
+            request += f"Proxy-Authorization: {credentials}\r\n"
+        writer.write((request + "\r\n").encode('latin-1'))
+        await writer.drain()
+        status_line, status, headers = parse_response_head(await read_http_head(reader))
+        if status == 200:
+            return
+        if status != 407:
+            raise ConnectionError(f"Upstream refused CONNECT to {authority}: {status_line}")
+        if not hop_auth:
+            raise ConnectionError("Upstream requires proxy authentication; no credentials are set for it")
+        challenges = [value for name, value in headers if name == 'proxy-authenticate']
+        # A second 407 for fresh credentials (not just a stale nonce) means they are wrong
+        if attempt or not hop_auth.challenge(challenges):
+            raise ConnectionError(f"Upstream rejected the proxy credentials: {status_line}")
+        if not await discard_body(reader, status_line, headers):
+            raise AuthRetry("Upstream closed the connection after its authentication challenge")
+
+
+def authorize_request(head, hop_auth):
+    """Plain (absolute-form) proxy request head with Proxy-Authorization added up front
+
+    The client connection is limited to this one request, since later requests
+    on it would reach the proxy without credentials.
+    """
+    request_line, _, rest = head.partition(b'\r\n')
+    method, target = request_line.decode('latin-1').split(' ')[:2]
+    credentials = hop_auth.header(method, target)
+    skip = (b'proxy-authorization:', b'proxy-connection:', b'connection:')
+    lines = [line for line in rest.split(b'\r\n') if line and not line.lower().startswith(skip)]
+    lines.append(b'Connection: close')
+    if credentials:
+        lines.append(f"Proxy-Authorization: {credentials}".encode('latin-1'))
+    return b'\r\n'.join([request_line] + lines) + b'\r\n\r\n'
+
+
+def request_has_body(head):
+    """True if a request head announces a body (Content-Length above 0 or Transfer-Encoding)"""
+    for line in head.split(b'\r\n')[1:]:
+        name, _, value = line.partition(b':')
+        name = name.strip().lower()
+        if name == b'transfer-encoding' or (name == b'content-length' and value.strip() not in (b'', b'0')):
+            return True
+    return False
+
+
+async def send_request(reader, writer, head, hop_auth, final=False):
+    """Send a plain request through an HTTP proxy with credentials; returns the response head
+
+    A 407 the challenge lets us answer raises AuthRetry (the request asked the proxy
+    to close the connection, so the retry needs a new one); on the final attempt
+    the 407 is returned like any other response.
+    """
+    try:
+        writer.write(authorize_request(head, hop_auth))
+        await writer.drain()
+        response = await read_http_head(reader)
+        status_line, status, headers = parse_response_head(response)
+        if status == 407 and not final:
+            challenges = [value for name, value in headers if name == 'proxy-authenticate']
+            if hop_auth.challenge(challenges):
+                raise AuthRetry(f"Upstream asked for authentication: {status_line}")
+    except BaseException:
+        writer.close()
+        raise
+    return response
+
+
+async def socks4_connect(reader, writer, host, port, hop_auth=None):
+    """Issue a SOCKS4 (or SOCKS4a for hostnames) CONNECT"""
+    if is_ip_literal(host) == 4:
+        request = struct.pack('>BBH', 4, 1, port) + ipaddress.IPv4Address(host).packed + b'\x00'
+    elif is_ip_literal(host) == 6:
+        raise ConnectionError("SOCKS4 does not support IPv6 destinations")
+    else:
+        # SOCKS4a: invalid IP 0.0.0.1 followed by the hostname
+        request = struct.pack('>BBH', 4, 1, port) + b'\x00\x00\x00\x01\x00' + host.encode('idna') + b'\x00'
+    writer.write(request)
+    await writer.drain()
+    reply = await reader.readexactly(8)
+    if reply[1] != 0x5A:
+        raise ConnectionError(f"SOCKS4 request rejected (code {reply[1]:#x})")
+
+
+SOCKS5_ERRORS = {
+    1: "general SOCKS server failure",
+    2: "connection not allowed by ruleset",
+    3: "network unreachable",
+    4: "host unreachable",
+    5: "connection refused",
+    6: "TTL expired",
+    7: "command not supported",
+    8: "address type not supported",
+}
+
+
+def socks5_address(host, port):
+    """Encode ATYP/DST.ADDR/DST.PORT for a SOCKS5 request"""
+    version = is_ip_literal(host)
+    if version == 4:
+        addr = b'\x01' + ipaddress.IPv4Address(host).packed
+    elif version == 6:
+        addr = b'\x04' + ipaddress.IPv6Address(host).packed
+    else:
+        name = host.encode('idna')
+        addr = b'\x03' + bytes([len(name)]) + name
+    return addr + struct.pack('>H', port)
+
+
+async def read_socks5_address(reader):
+    """Read ATYP/BND.ADDR/BND.PORT and return (host, port)"""
+    atyp = (await reader.readexactly(1))[0]
+    if atyp == 1:
+        host = str(ipaddress.IPv4Address(await reader.readexactly(4)))
+    elif atyp == 4:
+        host = str(ipaddress.IPv6Address(await reader.readexactly(16)))
+    elif atyp == 3:
+        length = (await reader.readexactly(1))[0]
+        host = (await reader.readexactly(length)).decode('idna')
+    else:
+        raise ConnectionError(f"Unknown SOCKS5 address type {atyp}")
+    port = struct.unpack('>H', await reader.readexactly(2))[0]
+    return host, port
+
+
+async def socks5_login(reader, writer, hop_auth):
+    """RFC 1929 username/password subnegotiation"""
+    username = hop_auth.username.encode('utf-8')
+    password = hop_auth.password.encode('utf-8')
+    if len(username) > 255 or len(password) > 255:
+        raise ConnectionError("SOCKS5 usernames and passwords are limited to 255 bytes")
+    writer.write(b'\x01' + bytes([len(username)]) + username + bytes([len(password)]) + password)
+    await writer.drain()
+    _, status = await reader.readexactly(2)
+    if status != 0:
+        raise ConnectionError("SOCKS5 upstream rejected the username/password")
+
+
+async def socks5_request(reader, writer, command, host, port, hop_auth=None):
+    """Negotiate a SOCKS5 session and issue a command; returns the bound address"""
+    # Username/password is only offered when there are credentials for this proxy
+    writer.write(b'\x05\x02\x00\x02' if hop_auth else b'\x05\x01\x00')
+    await writer.drain()
+    version, method = await reader.readexactly(2)
+    if version != 5:
+        raise ConnectionError("Upstream is not a SOCKS5 proxy")
+    if method == 2 and hop_auth:
+        await socks5_login(reader, writer, hop_auth)
+    elif method == 0xFF and hop_auth:
+        raise ConnectionError("SOCKS5 upstream rejected the offered credentials")
+    elif method == 0xFF:
+        raise ConnectionError("SOCKS5 upstream requires authentication; no credentials are set for it")
+    elif method != 0:
+        raise ConnectionError("SOCKS5 upstream requires an unsupported authentication method")
+    writer.write(b'\x05' + bytes([command]) + b'\x00' + socks5_address(host, port))
+    await writer.drain()
+    version, reply, _ = await reader.readexactly(3)
+    if reply != 0:
+        raise ConnectionError(f"SOCKS5 request failed: {SOCKS5_ERRORS.get(reply, reply)}")
+    return await read_socks5_address(reader)
+
+
+async def socks5_connect(reader, writer, host, port, hop_auth=None):
+    """Issue a SOCKS5 CONNECT"""
+    await socks5_request(reader, writer, 1, host, port, hop_auth)
+
+
+HANDSHAKES = {
+    "HTTP/HTTPS": http_connect,
+    "SOCKS4": socks4_connect,
+    "SOCKS5": socks5_connect,
+}
+
+
+class HandoffReader(asyncio.StreamReader):
+    """StreamReader that remembers EOF, so its connection can be handed to a protocol later"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.eof_seen = False
+
+    def feed_eof(self):
+        self.eof_seen = True
+        super().feed_eof()
+
+
+def stream_protocol(client_connected_cb=None):
+    """Stream protocol over a HandoffReader, for loop.create_server/create_connection"""
+    return asyncio.StreamReaderProtocol(HandoffReader(), client_connected_cb)
+
+
+async def open_stream(sock):
+    """asyncio.open_connection(sock=sock), but reading through a HandoffReader"""
+    loop = asyncio.get_running_loop()
+    reader = HandoffReader()
+    transport, protocol = await loop.create_connection(lambda: asyncio.StreamReaderProtocol(reader), sock=sock)
+    return reader, asyncio.StreamWriter(transport, protocol, reader, loop)
+
+
+async def _open_dual_stack(host, port, tuning=None):
+    sock = await happy_eyeballs.connect(host, port, tuning=tuning)
+    try:
+        return await open_stream(sock)
+    except BaseException:
+        sock.close()
+        raise
+
+
+async def open_connection(proxy_ip, proxy_port, timeout=CONNECT_TIMEOUT, tuning=None):
+    """Open a plain TCP connection to the upstream proxy (all A/AAAA records raced)"""
+    return await asyncio.wait_for(_open_dual_stack(proxy_ip, int(proxy_port), tuning), timeout)
+
+
+def _handshake(proxy_type):
+    handshake = HANDSHAKES.get(proxy_type)
+    if handshake is None:
+        raise ValueError(f"Unsupported proxy type: {proxy_type}")
+    return handshake
+
+
+def hop_auth_for(auth, hop):
+    """HopAuth for a hop from a ProxyAuth (which may be None)"""
+    return auth.for_hop(hop) if auth else None
+
+
+async def extend_tunnel(reader, writer, proxy_type, host, port, timeout=CONNECT_TIMEOUT, hop_auth=None):
+    """Ask the proxy at the far end of an open connection for a tunnel to host:port"""
+    try:
+        await asyncio.wait_for(_handshake(proxy_type)(reader, writer, host, int(port), hop_auth), timeout)
+    except BaseException:
+        writer.close()
+        raise
+    return reader, writer
+
+
+async def open_partial_chain(hops, timeout=CONNECT_TIMEOUT, tuning=None, auth=None):
+    """Connect through every hop but the last; returns a stream to the last hop itself"""
+    for hop in hops:
+        _handshake(hop[2])
+    for attempt in range(2):
+        reader, writer = await open_connection(hops[0][0], hops[0][1], timeout, tuning)
+        try:
+            for hop, next_hop in zip(hops, hops[1:]):
+                await extend_tunnel(reader, writer, hop[2], next_hop[0], next_hop[1], timeout,
+                                    hop_auth_for(auth, hop))
+            return reader, writer
+        except AuthRetry:
+            # The challenge is cached now, so the second attempt authenticates up front
+            if attempt:
+                raise
+
+
+async def open_chain(hops, host, port, timeout=CONNECT_TIMEOUT, tuning=None, auth=None):
+    """Open a tunnel to host:port through an ordered chain of (ip, port, type) hops"""
+    for attempt in range(2):
+        reader, writer = await open_partial_chain(hops, timeout, tuning, auth)
+        try:
+            return await extend_tunnel(reader, writer, hops[-1][2], host, port, timeout,
+                                       hop_auth_for(auth, hops[-1]))
+        except AuthRetry:
+            if attempt:
+                raise
+
+
+async def open_tunnel(proxy_ip, proxy_port, proxy_type, host, port, timeout=CONNECT_TIMEOUT, tuning=None,
+                      auth=None):
+    """Open a tunnel to host:port through the upstream proxy"""
+    return await open_chain([(proxy_ip, proxy_port, proxy_type)], host, port, timeout, tuning, auth)
@@ -6,15 +6,35 @@ Supports Linux, Windows, and macOS
 
 import os
 import sys
+import argparse
+import asyncio
+import contextlib
+import getpass
+import json
 import platform
+import shutil
 import subprocess
 import tkinter as tk
-from tkinter import ttk, messagebox, scrolledtext
+from tkinter import ttk, messagebox, scrolledtext, filedialog, simpledialog
 import threading
 import time
 import socket
-import urllib.request
-import urllib.error
+import struct
+
+import control
+import proxychains
+from health import (ProbeCache, CHAIN_TEST_TARGET, HTTP_TEST_URL, chain_name, chain_probe, format_age,
+                    http_probe, probe_key, tcp_probe)
+import scanner
+from memory import MemoryMonitor
+from netwatch import NetworkWatcher
+from proxy_auth import CredentialStore, ProxyAuth, keyring
+from profiling import OperationProfiler, PROFILERS, default_output
+from profiles import Profile, ProfileStore, DEFAULT_BYPASS, PROXY_TYPES, parse_bypass
+from relay import LocalRelay, RELAY_HOST, RELAY_PORT
+from shaping import Shaper
+from socket_tuning import SocketTuning
+from traffic import format_bytes, format_rate
 
 # Try to load .env file if python-dotenv is available
 try:
@@ -24,17 +44,113 @@ except ImportError:
     # python-dotenv not installed, skip .env loading
     pass
 
+# Milliseconds between traffic samples / sparkline redraws
+TRAFFIC_REFRESH_MS = 1000
+
+# Activity log lines kept in the window (oldest are dropped)
+MAX_LOG_LINES = 2000
+
+PROXY_ENV_VARS = ['HTTP_PROXY', 'HTTPS_PROXY', 'http_proxy', 'https_proxy', 'ALL_PROXY', 'all_proxy']
+
+def proxy_url(ip, port, proxy_type):
+    """Proxy URL as understood by curl, wget, git, pip, etc."""
+    scheme = {"SOCKS4": "socks4", "SOCKS5": "socks5"}.get(proxy_type, "http")
+    host = f"[{ip}]" if ':' in ip else ip
+    return f"{scheme}://{host}:{port}"
+
+def proxy_environment(ip, port, proxy_type, bypass=None):
+    """Environment variables that point applications at the proxy"""
+    url = proxy_url(ip, port, proxy_type)
+    env = {name: url for name in PROXY_ENV_VARS}
+    if bypass:
+        env['NO_PROXY'] = env['no_proxy'] = ",".join(bypass)
+    return env
+
+# NetworkManager proxy properties and their defaults
+NM_PROXY_PROPERTIES = ['proxy.method', 'proxy.pac-url', 'proxy.pac-script']
+NM_PROXY_DEFAULTS = {'proxy.method': 'none', 'proxy.pac-url': '', 'proxy.pac-script': ''}
+
+# Active connection types that never carry user traffic
+NM_SKIP_TYPES = {'loopback', 'bridge', 'tun', 'veth', 'dummy'}
+
+def pac_script(ip, port, proxy_type, bypass=()):
+    """Single-line PAC script sending everything except the bypass hosts to the proxy"""
+    host = f"[{ip}]" if ':' in ip else ip
+    route = {"SOCKS4": f"SOCKS {host}:{port}", 
+             "SOCKS5": f"SOCKS5 {host}:{port}; SOCKS {host}:{port}"}.get(proxy_type, f"PROXY {host}:{port}")
+    rules = []
+    for entry in bypass:
+        network, _, prefix = entry.partition('/')
+        if prefix.isdigit() and network.count('.') == 3:
+            mask = socket.inet_ntoa(struct.pack('>I', (0xffffffff << (32 - int(prefix))) & 0xffffffff))
+            rules.append(f"isInNet(host, '{network}', '{mask}')")
+        elif ':' not in entry:
+            pattern = '*' + entry if entry.startswith('.') else entry
+            rules.append(f"shExpMatch(host, '{pattern}')")
+    direct = f"if ({' || '.join(rules)}) return 'DIRECT'; " if rules else ""
+    return f"function FindProxyForURL(url, host) {{ {direct}return '{route}'; }}"
+
+def parse_nm_properties(output):
+    """Parse `nmcli -t -f ... connection show` output into {property: value}"""
+    properties = {}
+    for line in output.splitlines():
+        name, sep, value = line.partition(':')
+        if sep:
+            # Terse mode escapes ':' and '\\' inside values
+            properties[name] = value.replace('\\:', ':').replace('\\\\', '\\')
+    return properties
+
+def run_commands(commands, timeout=10):
+    """Run commands in parallel; returns (returncode, stdout, stderr) for each, in order"""
+    processes = []
+    for command in commands:
+        try:
+            processes.append(subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True))
+        except OSError as e:
+            processes.append(e)
+    results = []
+    for process in processes:
+        if isinstance(process, OSError):
+            results.append((-1, '', str(process)))
+            continue
+        try:
+            stdout, stderr = process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            stdout, stderr = process.communicate()
+            stderr = stderr or "timed out"
+        results.append((process.returncode, stdout, stderr))
+    return results
+
+def gsettings_proxy_schemas(proxy_type):
+    """GNOME proxy schemas that carry the host/port for a proxy type"""
+    if proxy_type == "HTTP/HTTPS":
+        return ['org.gnome.system.proxy.http', 'org.gnome.system.proxy.https', 'org.gnome.system.proxy.ftp']
+    return ['org.gnome.system.proxy.socks', 'org.gnome.system.proxy.http', 'org.gnome.system.proxy.https']
+
 class VPNApp:
     def __init__(self, root):
         self.root = root
         self.root.title("PHH VPN Client")
-        self.root.geometry("550x650")
+        self.root.geometry("550x1010")
         self.root.resizable(False, False)
         
         # Connection state
-        self.is_connected = False
-        self.os_type = platform.system()
-        self.original_proxy_settings = {}
+        self.init_state()
+        # Control socket of the daemon, when one owns the connection state
+        self.daemon = None
+        # Profiling of GUI operations (--profile or the hidden Ctrl+Alt+P toggle)
+        self.profiling = False
+        self.profiler_kind = 'cprofile'
+        self.profile_output = None
+        
+        # Saved profiles (shared with the CLI)
+        self.profiles = ProfileStore(autoload=False)
+        profile_error = None
+        try:
+            self.profiles.load()
+        except (OSError, ValueError) as e:
+            profile_error = e
         
         # Get proxy settings from environment (with defaults)
         self.proxy_ip = os.getenv('PROXY_IP', '172.33.157.252')
@@ -42,10 +158,46 @@ class VPNApp:
         
         # Create GUI
         self.create_gui()
+        self.root.bind_all('<Control-Alt-p>', self.toggle_profiling)
         
         # Load environment variables
         self.load_env_vars()
         
+        # The active saved profile (if any) wins over the environment
+        if profile_error:
+            self.log(f"Warning: Could not load profiles: {profile_error}")
+        elif self.profiles.active_profile():
+            self.profile_var.set(self.profiles.active)
+            self.fill_profile_fields(self.profiles.active_profile())
+        self.show_last_known_health()
+        self.attach_daemon()
+        self.sample_memory(start=True)
+        
+    def init_state(self):
+        """Connection state shared by the GUI and the daemon"""
+        self.is_connected = False
+        self.os_type = platform.system()
+        self.original_proxy_settings = {}
+        self.relay = None
+        self.scan_results = []
+        self.applied_profile = None
+        # Endpoint the system proxy points at (the relay or the upstream) and what it was applied to
+        self.system_proxy = None
+        self.nm_connections = {}
+        self.nm_originals = {}
+        self.macos_service = None
+        self.network_watcher = None
+        # Probe results shared with the CLI and earlier runs
+        self.health = ProbeCache()
+        # TCP options for every socket opened towards a proxy
+        self.tuning = SocketTuning.from_env()
+        # RSS / allocation samples and the memory budget for long-running use
+        self.memory = MemoryMonitor.from_env()
+        # Proxy credentials and the scheme each proxy asked for, shared by the relay and probes
+        self.credentials = CredentialStore()
+        self.auth = ProxyAuth(self.credentials)
+        self.bypass_hosts = parse_bypass(os.getenv('NO_PROXY', '')) or list(DEFAULT_BYPASS)
+        
     def create_gui(self):
         # Main frame
         main_frame = ttk.Frame(self.root, padding="20")
@@ -95,26 +247,82 @@ class VPNApp:
                                         state="readonly", width=27)
         proxy_type_combo.grid(row=2, column=1, padx=10, pady=5)
         
+        # Bypass rules
+        ttk.Label(config_frame, text="Bypass Hosts:").grid(row=3, column=0, sticky=tk.W, pady=5)
+        self.bypass_entry = ttk.Entry(config_frame, width=30)
+        self.bypass_entry.grid(row=3, column=1, padx=10, pady=5)
+        self.bypass_entry.insert(0, ", ".join(self.bypass_hosts))
+        
+        # Jump hops in front of the proxy (needs the local relay)
+        ttk.Label(config_frame, text="Via (jump hops):").grid(row=4, column=0, sticky=tk.W, pady=5)
+        self.via_entry = ttk.Entry(config_frame, width=30)
+        self.via_entry.grid(row=4, column=1, padx=10, pady=5)
+        self.via_entry.insert(0, os.getenv('PROXY_VIA', ''))
+        
+        # Proxy credentials (an authenticated proxy is reached through the local relay)
+        ttk.Label(config_frame, text="Login (optional):").grid(row=5, column=0, sticky=tk.W, pady=5)
+        login_frame = ttk.Frame(config_frame)
+        login_frame.grid(row=5, column=1, padx=10, pady=5, sticky=tk.W)
+        self.username_entry = ttk.Entry(login_frame, width=14)
+        self.username_entry.pack(side=tk.LEFT)
+        self.password_entry = ttk.Entry(login_frame, width=14, show="*")
+        self.password_entry.pack(side=tk.LEFT, padx=(5, 0))
+        self.remember_var = tk.BooleanVar(value=False)
+        remember_check = ttk.Checkbutton(config_frame, text="Remember password in the system keyring", 
+                                         variable=self.remember_var)
+        remember_check.grid(row=6, column=0, columnspan=2, sticky=tk.W, pady=5)
+        if keyring is None:
+            remember_check.state(['disabled'])
+        
+        # Local relay (enables traffic accounting)
+        self.relay_port = os.getenv('RELAY_PORT', str(RELAY_PORT))
+        self.use_relay_var = tk.BooleanVar(value=os.getenv('USE_RELAY', '0') == '1')
+        relay_check = ttk.Checkbutton(config_frame, 
+                                      text=f"Route through local relay ({RELAY_HOST}:{self.relay_port})", 
+                                      variable=self.use_relay_var)
+        relay_check.grid(row=7, column=0, columnspan=2, sticky=tk.W, pady=5)
+        
         # Load from env button
         load_env_btn = ttk.Button(config_frame, text="Load from Environment", 
                                  command=self.load_env_vars)
-        load_env_btn.grid(row=3, column=0, columnspan=2, pady=10)
+        load_env_btn.grid(row=8, column=0, pady=10)
+        
+        # Scan a list of candidate proxies and pick the fastest
+        self.scan_btn = ttk.Button(config_frame, text="Scan Proxy List...", 
+                                   command=self.scan_proxy_list)
+        self.scan_btn.grid(row=8, column=1, pady=10)
+        
+        # Saved profiles: selecting one while connected switches in place
+        ttk.Label(config_frame, text="Profile:").grid(row=9, column=0, sticky=tk.W, pady=5)
+        profile_frame = ttk.Frame(config_frame)
+        profile_frame.grid(row=9, column=1, padx=10, pady=5, sticky=tk.W)
+        self.profile_var = tk.StringVar()
+        self.profile_combo = ttk.Combobox(profile_frame, textvariable=self.profile_var, 
+                                          values=self.profiles.names(), state="readonly", width=14)
+        self.profile_combo.pack(side=tk.LEFT)
+        self.profile_combo.bind("<<ComboboxSelected>>", lambda event: self.select_profile())
+        ttk.Button(profile_frame, text="Save", width=6, 
+                   command=self.save_profile).pack(side=tk.LEFT, padx=(5, 0))
+        ttk.Button(profile_frame, text="Delete", width=6, 
+                   command=self.delete_profile).pack(side=tk.LEFT, padx=(5, 0))
         
         # Control buttons frame
         button_frame = ttk.Frame(main_frame)
         button_frame.pack(fill=tk.X, pady=(0, 20))
         
         self.connect_btn = ttk.Button(button_frame, text="Connect", 
-                                      command=self.connect_vpn, width=20)
+                                      command=lambda: self.run_profiled('connect', self.connect_vpn), 
+                                      width=20)
         self.connect_btn.pack(side=tk.LEFT, padx=5)
         
         self.disconnect_btn = ttk.Button(button_frame, text="Disconnect", 
-                                         command=self.disconnect_vpn, 
+                                         command=lambda: self.run_profiled('disconnect', self.disconnect_vpn), 
                                          state=tk.DISABLED, width=20)
         self.disconnect_btn.pack(side=tk.LEFT, padx=5)
         
         self.test_btn = ttk.Button(button_frame, text="Test Connection", 
-                                  command=self.test_connection, width=20)
+                                  command=lambda: self.run_profiled('test', self.test_connection), 
+                                  width=20)
         self.test_btn.pack(side=tk.LEFT, padx=5)
         
         # Setup system-wide proxy button (Linux only)
@@ -123,6 +331,18 @@ class VPNApp:
                                               command=self.setup_system_vpn, width=20)
             self.setup_system_btn.pack(side=tk.LEFT, padx=5)
         
+        # Traffic frame (live throughput/latency of the local relay)
+        traffic_frame = ttk.LabelFrame(main_frame, text="Traffic", padding="10")
+        traffic_frame.pack(fill=tk.X, pady=(0, 20))
+        
+        self.traffic_label = ttk.Label(traffic_frame, text="Local relay not running", 
+                                       font=("Arial", 9))
+        self.traffic_label.pack(anchor=tk.W)
+        
+        self.traffic_canvas = tk.Canvas(traffic_frame, height=60, background="white", 
+                                        highlightthickness=1, highlightbackground="gray")
+        self.traffic_canvas.pack(fill=tk.X, pady=(5, 0))
+        
         # Log frame
         log_frame = ttk.LabelFrame(main_frame, text="Activity Log", padding="10")
         log_frame.pack(fill=tk.BOTH, expand=True)
@@ -132,10 +352,9 @@ class VPNApp:
         self.log_text.pack(fill=tk.BOTH, expand=True)
         
         # System info
-        info_label = ttk.Label(main_frame, 
-                              text=f"OS: {self.os_type} | Python: {sys.version.split()[0]}",
-                              font=("Arial", 8))
-        info_label.pack(pady=(10, 0))
+        self.info_text = f"OS: {self.os_type} | Python: {sys.version.split()[0]}"
+        self.info_label = ttk.Label(main_frame, text=self.info_text, font=("Arial", 8))
+        self.info_label.pack(pady=(10, 0))
         
         self.log("Application started")
         self.log(f"Detected OS: {self.os_type}")
@@ -145,13 +364,200 @@ class VPNApp:
         self.status_indicator.delete("all")
         self.status_indicator.create_oval(2, 2, 18, 18, fill=color, outline="gray")
         
+    def draw_sparkline(self, series, color, peak):
+        """Draw one history series scaled to the traffic canvas"""
+        width = self.traffic_canvas.winfo_width()
+        height = self.traffic_canvas.winfo_height()
+        if width <= 1 or peak <= 0:
+            return
+        step = width / max(len(series) - 1, 1)
+        points = []
+        for i, value in enumerate(series):
+            points.append(i * step)
+            points.append(height - 2 - (value / peak) * (height - 4))
+        self.traffic_canvas.create_line(*points, fill=color)
+        
+    def update_traffic(self):
+        """Sample relay counters and redraw the throughput/latency sparklines"""
+        if not self.relay or not self.relay.running:
+            return
+        meter = self.relay.meter
+        meter.sample()
+        up, down, latency = meter.current_rates()
+        active = len(meter.connections)
+        self.traffic_label.config(
+            text=f"↑ {format_rate(up)}  ↓ {format_rate(down)}  |  "
+                 f"connect {latency:.0f} ms  |  {active} active / {meter.total_connections} total  |  "
+                 f"{format_bytes(meter.buffered_bytes())} buffered")
+        
+        # Skip drawing while the window is minimized
+        if self.root.state() != 'iconic':
+            up_hist = meter.history(meter.up_rate)
+            down_hist = meter.history(meter.down_rate)
+            latency_hist = meter.history(meter.latency_ms)
+            self.traffic_canvas.delete("all")
+            rate_peak = max(max(up_hist), max(down_hist))
+            self.draw_sparkline(down_hist, "green", rate_peak)
+            self.draw_sparkline(up_hist, "blue", rate_peak)
+            self.draw_sparkline(latency_hist, "orange", max(latency_hist))
+        
+        self.root.after(TRAFFIC_REFRESH_MS, self.update_traffic)
+        
     def log(self, message):
         """Add message to log"""
         timestamp = time.strftime("%H:%M:%S")
         self.log_text.insert(tk.END, f"[{timestamp}] {message}\n")
+        # A window left open for weeks must not keep every line ever logged
+        lines = int(self.log_text.index('end-1c').split('.')[0]) - 1
+        if lines > MAX_LOG_LINES:
+            self.log_text.delete('1.0', f"{lines - MAX_LOG_LINES + 1}.0")
         self.log_text.see(tk.END)
         self.root.update_idletasks()
         
+    def sample_memory(self, start=False):
+        """Sample memory use on a worker thread; tracemalloc snapshots of a large heap take a while"""
+        def worker():
+            if start:
+                self.memory.start()
+            warning = self.memory.sample()
+            self.call_soon(self.show_memory, warning, self.memory.snapshot()['rss'])
+        threading.Thread(target=worker, daemon=True).start()
+        
+    def show_memory(self, warning, rss):
+        """Warn once over the budget, show RSS in the info line and schedule the next sample"""
+        if warning:
+            self.log(f"Warning: {warning}")
+        if rss is not None:
+            budget = f" of {format_bytes(self.memory.budget)}" if self.memory.budget else ""
+            self.info_label.config(text=f"{self.info_text} | Memory: {format_bytes(rss)}{budget}")
+        self.root.after(int(self.memory.interval * 1000), self.sample_memory)
+        
+    def log_threadsafe(self, message):
+        """Add message to log from a background thread"""
+        self.call_soon(self.log, message)
+        
+    def call_soon(self, func, *args):
+        """Run func on the thread that owns the connection state (the Tk main loop)"""
+        self.root.after(0, func, *args)
+        
+    def toggle_profiling(self, event=None):
+        """Hidden switch: profile Connect, Disconnect and Test Connection until switched off"""
+        self.profiling = not self.profiling
+        if self.profiling:
+            self.log(f"Profiling on ({self.profiler_kind}): profiles are written to "
+                     f"{os.path.dirname(default_output('connect', self.profiler_kind))}")
+        else:
+            self.log("Profiling off")
+        
+    @contextlib.contextmanager
+    def quiet_dialogs(self):
+        """Log information dialogs instead of waiting for a click"""
+        dialogs = {name: getattr(messagebox, name) for name in ('showinfo', 'showwarning', 'showerror')}
+        for name in dialogs:
+            setattr(messagebox, name, lambda title, message, **options: self.log(f"[{title}] {message}"))
+        try:
+            yield
+        finally:
+            for name, dialog in dialogs.items():
+                setattr(messagebox, name, dialog)
+        
+    def run_profiled(self, operation, func):
+        """Run a GUI operation, under the profiler while profiling is on"""
+        if not self.profiling:
+            return func()
+        profiler = OperationProfiler(operation, self.profiler_kind)
+        # Time spent looking at a dialog would otherwise end up in the profile
+        with self.quiet_dialogs(), profiler:
+            func()
+        try:
+            path = profiler.write(self.profile_output or default_output(operation, self.profiler_kind))
+        except OSError as e:
+            self.log(f"Could not write profile: {e}")
+            return
+        self.profile_output = None
+        for line in profiler.summary():
+            self.log(line)
+        self.log(f"Profile written to {path}")
+        
+    def profile_operation(self, operation):
+        """Profile one operation requested with --profile, then switch profiling off"""
+        operations = {'connect': self.connect_vpn, 'disconnect': self.disconnect_vpn,
+                      'test': self.test_connection}
+        if operation == 'disconnect' and not self.is_connected:
+            with self.quiet_dialogs():
+                self.connect_vpn()
+        self.profiling = True
+        self.run_profiled(operation, operations[operation])
+        self.profiling = False
+        
+    def start_relay(self, ip, port, proxy_type, via=()):
+        """Start the local relay and return the address to configure as system proxy"""
+        self.relay = LocalRelay(ip, port, proxy_type, RELAY_HOST, self.relay_port, 
+                                log=self.log_threadsafe, shaper=Shaper.from_env(), via=via, 
+                                tuning=self.tuning, auth=self.auth)
+        self.relay.start()
+        if self.relay.shaper:
+            limits = self.relay.shaper.snapshot()
+            self.log(f"Relay limits: {limits['global_rate'] // 1024} KB/s total, "
+                     f"{limits['host_rate'] // 1024} KB/s per host, "
+                     f"{limits['max_connections']} upstream connections (0 = unlimited)")
+        self.traffic_canvas.delete("all")
+        self.root.after(TRAFFIC_REFRESH_MS, self.update_traffic)
+        return RELAY_HOST, str(self.relay.listen_port)
+        
+    def stop_relay(self):
+        """Stop the local relay if it is running"""
+        if self.relay:
+            self.relay.stop()
+            self.relay = None
+            self.traffic_label.config(text="Local relay not running")
+        
+    def start_network_watcher(self):
+        """Re-apply per-connection proxy state when the network changes (Wi-Fi, dock, resume)"""
+        self.network_watcher = NetworkWatcher(
+            lambda changes: self.call_soon(self.on_network_change, changes), log=self.log_threadsafe)
+        sources = self.network_watcher.start()
+        if sources:
+            self.log(f"Watching for network changes ({', '.join(sources)})")
+        else:
+            self.log("Network change notifications not available on this system")
+        
+    def ignore_own_nm_changes(self):
+        """Our own nmcli writes show up on `nmcli monitor`; keep them from looking like a network change"""
+        if self.network_watcher:
+            self.network_watcher.ignore('connection')
+        
+    def stop_network_watcher(self):
+        if self.network_watcher:
+            self.network_watcher.stop()
+            self.network_watcher = None
+        
+    def on_network_change(self, changes):
+        """Re-apply only the backend state tied to the network connection"""
+        if not self.is_connected or not self.system_proxy:
+            return
+        self.log(f"Network change detected ({', '.join(sorted(changes))})")
+        try:
+            if self.os_type == "Linux":
+                # gsettings, environment, shell and proxychains settings are global;
+                # only NetworkManager connection profiles are per-connection
+                if shutil.which('nmcli'):
+                    active = self.active_nm_connections()
+                    new = {uuid: name for uuid, name in active.items() if uuid not in self.nm_connections}
+                    if new:
+                        self.configure_networkmanager(*self.system_proxy, connections=new)
+            elif self.os_type == "Darwin":
+                # networksetup proxies belong to a network service
+                service = self.find_macos_service()
+                if service and service != self.macos_service:
+                    self.log(f"Active network service changed to {service}")
+                    self.set_proxy_macos(*self.system_proxy)
+            elif self.os_type == "Windows":
+                # WinINet settings are per user, not per adapter; just have applications reload them
+                self.notify_windows_proxy_change()
+        except (subprocess.SubprocessError, OSError) as e:
+            self.log(f"Warning: Could not re-apply proxy after network change: {e}")
+        
     def load_env_vars(self):
         """Load proxy settings from environment variables"""
         self.proxy_ip = os.getenv('PROXY_IP', '172.33.157.252')
@@ -165,6 +571,153 @@ class VPNApp:
         self.port_entry.insert(0, self.proxy_port)
             
         self.log(f"Loaded proxy settings: {self.proxy_ip}:{self.proxy_port}")
+        
+    def fill_profile_fields(self, profile):
+        """Show a profile's settings in the configuration fields"""
+        self.ip_entry.delete(0, tk.END)
+        self.ip_entry.insert(0, profile.proxy_ip)
+        self.port_entry.delete(0, tk.END)
+        self.port_entry.insert(0, profile.proxy_port)
+        self.proxy_type_var.set(profile.proxy_type)
+        self.bypass_entry.delete(0, tk.END)
+        self.bypass_entry.insert(0, ", ".join(profile.bypass))
+        self.via_entry.delete(0, tk.END)
+        self.via_entry.insert(0, ", ".join(profile.via))
+        self.fill_credential_fields(profile.proxy_ip, profile.proxy_port)
+        
+    def fill_credential_fields(self, ip, port):
+        """Show the known login for a proxy (session, keyring or environment)"""
+        credentials = self.credentials.get(ip, port) or ("", "")
+        self.username_entry.delete(0, tk.END)
+        self.username_entry.insert(0, credentials[0])
+        self.password_entry.delete(0, tk.END)
+        self.password_entry.insert(0, credentials[1])
+        
+    def store_credentials(self, ip, port):
+        """Use the login typed into the fields for this proxy; returns it or None"""
+        username = self.username_entry.get().strip()
+        if not username:
+            return None
+        password = self.password_entry.get()
+        try:
+            self.credentials.set(ip, port, username, password, remember=self.remember_var.get())
+        except Exception as e:
+            # Still usable for this session
+            self.log(f"Could not save the password in the keyring: {e}")
+        return {'username': username, 'password': password}
+        
+    def needs_auth(self, profile):
+        return any(self.auth.needs_auth(hop) for hop in profile.chain())
+        
+    def current_profile(self, name=None):
+        """Build a profile from the configuration fields"""
+        ip, port = self.get_proxy_settings()
+        return Profile(name or self.profile_var.get() or "manual", ip, port, 
+                       self.proxy_type_var.get(), self.bypass_entry.get(), self.via_entry.get())
+        
+    def refresh_profiles(self):
+        """Reload the profile list into the combobox"""
+        self.profile_combo.config(values=self.profiles.names())
+        
+    def save_profile(self):
+        """Save the current fields as a named profile"""
+        name = simpledialog.askstring("Save Profile", "Profile name:", 
+                                      initialvalue=self.profile_var.get(), parent=self.root)
+        if not name:
+            return
+        try:
+            profile = self.current_profile(name.strip())
+            self.profiles.put(profile)
+        except (ValueError, OSError) as e:
+            messagebox.showerror("Save Profile", str(e))
+            return
+        self.refresh_profiles()
+        self.profile_var.set(profile.name)
+        self.log(f"Saved profile {profile}")
+        
+    def delete_profile(self):
+        """Delete the selected profile"""
+        name = self.profile_var.get()
+        if not name or name not in self.profiles.profiles:
+            return
+        if not messagebox.askyesno("Delete Profile", f"Delete profile '{name}'?"):
+            return
+        try:
+            self.profiles.delete(name)
+        except OSError as e:
+            messagebox.showerror("Delete Profile", str(e))
+            return
+        self.profile_var.set("")
+        self.refresh_profiles()
+        self.log(f"Deleted profile {name}")
+        
+    def select_profile(self):
+        """Load the chosen profile, switching in place when connected"""
+        name = self.profile_var.get()
+        try:
+            profile = self.profiles.get(name)
+            self.profiles.set_active(name)
+        except (KeyError, OSError) as e:
+            self.log(f"Profile error: {e}")
+            return
+        if self.is_connected:
+            self.switch_profile(profile)
+        else:
+            self.fill_profile_fields(profile)
+            self.log(f"Loaded profile {profile}")
+        
+    def switch_profile(self, profile):
+        """Switch the connected system to another profile"""
+        self.fill_profile_fields(profile)
+        try:
+            if self.daemon:
+                credentials = self.store_credentials(profile.proxy_ip, profile.proxy_port)
+                status = self.daemon_request('switch', profile=profile_message(profile), 
+                                             credentials=credentials)
+            else:
+                self.switch_system_proxy(profile)
+                status = self.status()
+        except Exception as e:
+            self.log(f"Profile switch error: {e}")
+            messagebox.showerror("Error", f"Failed to switch profile: {e}")
+            return
+        self.show_connection(status)
+        
+    def switch_system_proxy(self, profile):
+        """Apply only what differs between the connected profile and the new one"""
+        old = self.applied_profile
+        changes = profile.diff(old)
+        if not changes:
+            self.log(f"Profile {profile.name} is already applied")
+            self.applied_profile = profile
+            return changes
+        
+        started = time.monotonic()
+        self.log(f"Switching to profile {profile} (changed: {', '.join(sorted(changes))})")
+        endpoint_changed = bool(changes & {'proxy_ip', 'proxy_port', 'proxy_type', 'via'})
+        if self.relay and self.relay.running:
+            # The system keeps pointing at the relay; only the relay's upstream moves
+            if endpoint_changed:
+                self.relay.set_upstream(profile.proxy_ip, profile.proxy_port, profile.proxy_type, 
+                                        profile.chain()[:-1])
+        elif profile.via or self.needs_auth(profile):
+            raise ValueError("Profiles with jump hops or a login need the local relay; disconnect and "
+                             "connect again to apply this profile")
+        elif endpoint_changed:
+            self.system_proxy = (profile.proxy_ip, profile.proxy_port, profile.proxy_type)
+            if self.os_type == "Linux":
+                self.switch_proxy_linux(old, profile, changes)
+            elif self.os_type == "Windows":
+                self.switch_proxy_windows(profile)
+            elif self.os_type == "Darwin":
+                self.switch_proxy_macos(old, profile)
+        if 'bypass' in changes:
+            self.apply_bypass(profile.bypass)
+        
+        self.applied_profile = profile
+        self.bypass_hosts = profile.bypass
+        self.log(f"Switched to profile {profile.name} in {(time.monotonic() - started) * 1000:.0f} ms")
+        return changes
             
     def get_proxy_settings(self):
         """Get proxy settings from GUI"""
@@ -289,9 +842,9 @@ class VPNApp:
                                  check=True, timeout=5)
                     self.log(f"GNOME SOCKS{socks_version} proxy settings configured")
                 
-                # Set ignore hosts (don't proxy localhost)
+                # Set ignore hosts (don't proxy localhost or the configured bypass hosts)
                 subprocess.run(['gsettings', 'set', 'org.gnome.system.proxy', 'ignore-hosts', 
-                              "['localhost', '127.0.0.0/8', '::1']"], check=True, timeout=5)
+                              str(self.bypass_hosts)], check=True, timeout=5)
             except (subprocess.CalledProcessError, FileNotFoundError):
                 self.log("gsettings not available, trying KDE...")
                 try:
@@ -422,52 +975,35 @@ export all_proxy="{proxy_url}"
                     config_file = user_proxychains_conf
             
             if config_file:
-                # Determine proxy type for proxychains
-                if proxy_type == "HTTP/HTTPS":
-                    proxy_line = f"http {ip} {port}"
-                elif proxy_type == "SOCKS4":
-                    proxy_line = f"socks4 {ip} {port}"
-                elif proxy_type == "SOCKS5":
-                    proxy_line = f"socks5 {ip} {port}"
-                else:
-                    proxy_line = f"http {ip} {port}"
+                # The proxy first, then any extra nodes to spread terminal workloads over
+                upstreams = [(ip, int(port), proxy_type)]
+                relayed = (self.relay is not None and self.relay.running 
+                           and (ip, int(port)) == self.relay.address)
+                # Behind the relay, pool nodes would bypass its login and jump hops
+                pool = [] if relayed else proxychains.parse_pool(os.getenv('PROXYCHAINS_POOL', ''))
+                for hop in pool:
+                    if hop not in upstreams:
+                        upstreams.append(hop)
+                # Timeouts follow the connect latency measured by Test Connection / scans
+                latencies = []
+                for host, hop_port, _ in upstreams:
+                    result = self.health.get(probe_key(f"{host}:{hop_port}", 'tcp'))
+                    if result and result.ok and result.latency_ms is not None:
+                        latencies.append(result.latency_ms)
                 
-                # Read existing config
+                # Read existing config (a missing one gets the usual preamble)
+                lines = []
                 if os.path.exists(config_file):
                     with open(config_file, 'r') as f:
                         lines = f.readlines()
-                else:
-                    # Create default config
-                    lines = [
-                        "strict_chain\n",
-                        "proxy_dns\n",
-                        "remote_dns_subnet 224\n",
-                        "tcp_read_time_out 15000\n",
-                        "tcp_connect_time_out 8000\n",
-                        "[ProxyList]\n"
-                    ]
-                
-                # Remove old PHH VPN entries and add new one
-                new_lines = []
-                skip_old = False
-                for line in lines:
-                    if "# PHH VPN" in line:
-                        skip_old = True
-                        continue
-                    elif skip_old and line.strip().startswith(proxy_line.split()[0]):
-                        continue
-                    elif skip_old and line.strip() == "":
-                        skip_old = False
-                    elif not skip_old:
-                        new_lines.append(line)
-                
-                # Add new proxy entry
-                new_lines.append(f"# PHH VPN Proxy\n")
-                new_lines.append(f"{proxy_line}\n")
+                mode = proxychains.chain_mode(os.getenv('PROXYCHAINS_MODE') or None, len(upstreams))
+                lines = proxychains.render(lines, upstreams, mode, 
+                                           int(os.getenv('PROXYCHAINS_CHAIN_LEN', '1')), latencies)
                 
                 with open(config_file, 'w') as f:
-                    f.writelines(new_lines)
+                    f.writelines(lines)
                 
+                self.log(f"Proxychains: {len(upstreams)} upstream(s), {mode}")
                 self.log(f"Proxychains configured: {config_file}")
                 self.log(f"Use 'proxychains <command>' to run apps through proxy")
             else:
@@ -475,34 +1011,83 @@ export all_proxy="{proxy_url}"
         except Exception as e:
             self.log(f"Warning: Could not configure proxychains: {e}")
     
-    def configure_networkmanager(self, ip, port, proxy_type):
-        """Configure NetworkManager proxy settings"""
+    def active_nm_connections(self):
+        """Active NetworkManager connections that carry traffic: {uuid: name}"""
+        result = subprocess.run(['nmcli', '-t', '-f', 'UUID,TYPE,DEVICE,NAME', 'connection', 'show', '--active'], 
+                              capture_output=True, text=True, timeout=5)
+        connections = {}
+        if result.returncode != 0:
+            return connections
+        for line in result.stdout.splitlines():
+            fields = line.split(':', 3)
+            if len(fields) == 4 and fields[1] not in NM_SKIP_TYPES:
+                connections[fields[0]] = fields[3].replace('\\:', ':')
+        return connections
+        
+    def configure_networkmanager(self, ip, port, proxy_type, connections=None):
+        """Point active NetworkManager connections at the proxy (one nmcli call each, in parallel)"""
         try:
-            # Try to configure NetworkManager via nmcli
-            result = subprocess.run(['which', 'nmcli'], capture_output=True, timeout=2)
-            if result.returncode != 0:
+            if not shutil.which('nmcli'):
                 self.log("NetworkManager (nmcli) not available")
                 return
+            if connections is None:
+                connections = self.active_nm_connections()
+            if not connections:
+                return
             
-            # Get active connection
-            result = subprocess.run(['nmcli', '-t', '-f', 'NAME,DEVICE', 'connection', 'show', '--active'], 
-                                  capture_output=True, text=True, timeout=5)
-            if result.returncode == 0 and result.stdout.strip():
-                connection_name = result.stdout.split('\n')[0].split(':')[0]
-                
-                if proxy_type == "HTTP/HTTPS":
-                    # Set proxy method
-                    subprocess.run(['nmcli', 'connection', 'modify', connection_name, 
-                                  'proxy.method', 'manual'], check=False, timeout=5)
-                    subprocess.run(['nmcli', 'connection', 'modify', connection_name, 
-                                  'proxy.http-proxy', f'{ip}:{port}'], check=False, timeout=5)
-                    subprocess.run(['nmcli', 'connection', 'modify', connection_name, 
-                                  'proxy.https-proxy', f'{ip}:{port}'], check=False, timeout=5)
-                    self.log(f"NetworkManager proxy configured for {connection_name}")
+            # Remember the original proxy settings of connections not touched yet
+            fresh = [uuid for uuid in connections if uuid not in self.nm_originals]
+            reads = run_commands([['nmcli', '-t', '-f', ','.join(NM_PROXY_PROPERTIES), 'connection', 'show', uuid] 
+                                  for uuid in fresh])
+            for uuid, (returncode, stdout, _) in zip(fresh, reads):
+                if returncode == 0:
+                    self.nm_originals[uuid] = parse_nm_properties(stdout)
+            
+            # NetworkManager only knows PAC based proxies, which also covers SOCKS
+            script = pac_script(ip, port, proxy_type, self.bypass_hosts)
+            uuids = list(connections)
+            self.ignore_own_nm_changes()
+            results = run_commands([['nmcli', 'connection', 'modify', uuid, 
+                                     'proxy.method', 'auto', 'proxy.pac-url', '', 'proxy.pac-script', script] 
+                                    for uuid in uuids])
+            self.ignore_own_nm_changes()
+            for uuid, (returncode, _, stderr) in zip(uuids, results):
+                if returncode == 0:
+                    self.nm_connections[uuid] = connections[uuid]
+                    self.log(f"NetworkManager proxy configured for {connections[uuid]}")
                 else:
-                    self.log("NetworkManager SOCKS proxy configuration not fully supported")
+                    self.log(f"Warning: Could not configure NetworkManager connection {connections[uuid]}: "
+                             f"{stderr.strip()}")
         except Exception as e:
             self.log(f"Warning: Could not configure NetworkManager: {e}")
+        
+    def revert_networkmanager(self):
+        """Restore the proxy settings of every NetworkManager connection we changed"""
+        if not self.nm_connections:
+            return
+        try:
+            uuids = list(self.nm_connections)
+            commands = []
+            for uuid in uuids:
+                original = self.nm_originals.get(uuid, NM_PROXY_DEFAULTS)
+                command = ['nmcli', 'connection', 'modify', uuid]
+                for prop in NM_PROXY_PROPERTIES:
+                    command += [prop, original.get(prop, NM_PROXY_DEFAULTS[prop])]
+                commands.append(command)
+            self.ignore_own_nm_changes()
+            results = run_commands(commands)
+            self.ignore_own_nm_changes()
+            for uuid, (returncode, _, stderr) in zip(uuids, results):
+                if returncode == 0:
+                    self.log(f"NetworkManager proxy restored for {self.nm_connections[uuid]}")
+                else:
+                    # Connection may have been deleted meanwhile
+                    self.log(f"Warning: Could not restore NetworkManager connection "
+                             f"{self.nm_connections[uuid]}: {stderr.strip()}")
+        except Exception as e:
+            self.log(f"Warning: Could not restore NetworkManager settings: {e}")
+        self.nm_connections = {}
+        self.nm_originals = {}
     
     def setup_system_vpn(self):
         """Setup system-wide VPN (export env vars and configure tools)"""
@@ -511,8 +1096,9 @@ export all_proxy="{proxy_url}"
             return
         
         try:
-            ip, port = self.get_proxy_settings()
-            proxy_type = self.proxy_type_var.get()
+            # What the system proxy points at: the local relay for chained or authenticated
+            # profiles, which the upstream in the fields cannot be used without
+            ip, port, proxy_type = self.system_proxy
             
             self.log("Setting up system-wide VPN...")
             
@@ -581,21 +1167,14 @@ export all_proxy="{proxy_url}"
                 # Windows uses format: socks=ip:port for SOCKS
                 winreg.SetValueEx(key, 'ProxyServer', 0, winreg.REG_SZ, f'socks={ip}:{port}')
             
-            # Disable proxy override for local addresses if needed
-            winreg.SetValueEx(key, 'ProxyOverride', 0, winreg.REG_SZ, '<local>')
+            # Disable proxy override for local addresses and bypass hosts
+            winreg.SetValueEx(key, 'ProxyOverride', 0, winreg.REG_SZ, 
+                              ';'.join(self.bypass_hosts + ['<local>']))
             
             winreg.CloseKey(key)
             
             # Notify system of changes
-            try:
-                import ctypes
-                INTERNET_OPTION_REFRESH = 37
-                INTERNET_OPTION_SETTINGS_CHANGED = 39
-                internet_set_option = ctypes.windll.wininet.InternetSetOptionW
-                internet_set_option(0, INTERNET_OPTION_REFRESH, 0, 0)
-                internet_set_option(0, INTERNET_OPTION_SETTINGS_CHANGED, 0, 0)
-            except Exception as e:
-                self.log(f"Warning: Could not notify system of proxy changes: {e}")
+            self.notify_windows_proxy_change()
             
             self.log(f"Windows proxy settings configured ({proxy_type})")
             return True
@@ -606,6 +1185,49 @@ export all_proxy="{proxy_url}"
             self.log(f"Error configuring Windows proxy: {e}")
             return False
             
+    def find_macos_service(self):
+        """Find the active macOS network service (Wi-Fi/Ethernet preferred)"""
+        # Get network services and find the active one
+        result = subprocess.run(['networksetup', '-listallnetworkservices'], 
+                              capture_output=True, text=True, timeout=5, check=True)
+        all_services = [line.strip() for line in result.stdout.split('\n') 
+                       if line.strip() and not line.strip().startswith('An asterisk')]
+        
+        # Get network service order to find active service
+        order_result = subprocess.run(['networksetup', '-listnetworkserviceorder'], 
+                                    capture_output=True, text=True, timeout=5, check=False)
+        
+        # Prefer Wi-Fi or Ethernet (active services)
+        service = None
+        preferred_services = ['Wi-Fi', 'Ethernet', 'AirPort', 'en0', 'en1']
+        
+        if order_result.returncode == 0:
+            # Parse service order to find active service
+            for line in order_result.stdout.split('\n'):
+                for preferred in preferred_services:
+                    if preferred in line and '(' in line:
+                        # Extract service name from line like "(3) Wi-Fi"
+                        service_name = line.split(')')[1].split('(')[0].strip()
+                        if service_name in all_services:
+                            service = service_name
+                            break
+                if service:
+                    break
+        
+        # Fallback: use first available service that's not a VPN or proxy
+        if not service:
+            for svc in all_services:
+                # Skip VPN services and proxy services
+                if svc.lower() not in ['proxy', 'vpn', 'xvpn', 'vpnify', 'speedtop']:
+                    service = svc
+                    break
+        
+        # Last resort: use first service
+        if not service and all_services:
+            service = all_services[0]
+        
+        return service
+    
     def set_proxy_macos(self, ip, port, proxy_type="HTTP/HTTPS"):
         """Configure proxy for macOS"""
         try:
@@ -634,49 +1256,14 @@ export all_proxy="{proxy_url}"
             self.log("Environment variables set for macOS")
             
             # Get network services and find the active one
-            result = subprocess.run(['networksetup', '-listallnetworkservices'], 
-                                  capture_output=True, text=True, timeout=5, check=True)
-            all_services = [line.strip() for line in result.stdout.split('\n') 
-                           if line.strip() and not line.strip().startswith('An asterisk')]
-            
-            # Get network service order to find active service
-            order_result = subprocess.run(['networksetup', '-listnetworkserviceorder'], 
-                                        capture_output=True, text=True, timeout=5, check=False)
-            
-            # Prefer Wi-Fi or Ethernet (active services)
-            service = None
-            preferred_services = ['Wi-Fi', 'Ethernet', 'AirPort', 'en0', 'en1']
-            
-            if order_result.returncode == 0:
-                # Parse service order to find active service
-                for line in order_result.stdout.split('\n'):
-                    for preferred in preferred_services:
-                        if preferred in line and '(' in line:
-                            # Extract service name from line like "(3) Wi-Fi"
-                            service_name = line.split(')')[1].split('(')[0].strip()
-                            if service_name in all_services:
-                                service = service_name
-                                break
-                    if service:
-                        break
-            
-            # Fallback: use first available service that's not a VPN or proxy
-            if not service:
-                for svc in all_services:
-                    # Skip VPN services and proxy services
-                    if svc.lower() not in ['proxy', 'vpn', 'xvpn', 'vpnify', 'speedtop']:
-                        service = svc
-                        break
-            
-            # Last resort: use first service
-            if not service and all_services:
-                service = all_services[0]
+            service = self.find_macos_service()
             
             if not service:
                 self.log("Warning: No network services found, using environment variables only")
                 return True
             
             self.log(f"Using network service: {service}")
+            self.macos_service = service
             
             # Configure proxy with better error handling
             try:
@@ -750,11 +1337,13 @@ export all_proxy="{proxy_url}"
         """Remove proxy configuration for Linux"""
         # Remove environment variables
         env_vars = ['HTTP_PROXY', 'HTTPS_PROXY', 'http_proxy', 'https_proxy', 
-                   'ALL_PROXY', 'all_proxy', 'SOCKS_PROXY', 'socks_proxy']
+                   'ALL_PROXY', 'all_proxy', 'SOCKS_PROXY', 'socks_proxy', 'NO_PROXY', 'no_proxy']
         for var in env_vars:
             os.environ.pop(var, None)
         self.log("Environment proxy variables removed")
         
+        self.revert_networkmanager()
+        
         # Remove from shell config files
         try:
             home = os.path.expanduser("~")
@@ -816,7 +1405,7 @@ export all_proxy="{proxy_url}"
         """Remove proxy configuration for Windows"""
         # Remove environment variables
         env_vars = ['HTTP_PROXY', 'HTTPS_PROXY', 'http_proxy', 'https_proxy', 
-                   'ALL_PROXY', 'all_proxy', 'SOCKS_PROXY', 'socks_proxy']
+                   'ALL_PROXY', 'all_proxy', 'SOCKS_PROXY', 'socks_proxy', 'NO_PROXY', 'no_proxy']
         for var in env_vars:
             os.environ.pop(var, None)
         self.log("Environment proxy variables removed")
@@ -832,15 +1421,7 @@ export all_proxy="{proxy_url}"
             winreg.CloseKey(key)
             
             # Notify system
-            try:
-                import ctypes
-                INTERNET_OPTION_REFRESH = 37
-                INTERNET_OPTION_SETTINGS_CHANGED = 39
-                internet_set_option = ctypes.windll.wininet.InternetSetOptionW
-                internet_set_option(0, INTERNET_OPTION_REFRESH, 0, 0)
-                internet_set_option(0, INTERNET_OPTION_SETTINGS_CHANGED, 0, 0)
-            except Exception as e:
-                self.log(f"Warning: Could not notify system of proxy changes: {e}")
+            self.notify_windows_proxy_change()
             
             self.log("Windows proxy disabled")
             return True
@@ -855,47 +1436,13 @@ export all_proxy="{proxy_url}"
         """Remove proxy configuration for macOS"""
         # Remove environment variables
         env_vars = ['HTTP_PROXY', 'HTTPS_PROXY', 'http_proxy', 'https_proxy', 
-                   'ALL_PROXY', 'all_proxy', 'SOCKS_PROXY', 'socks_proxy']
+                   'ALL_PROXY', 'all_proxy', 'SOCKS_PROXY', 'socks_proxy', 'NO_PROXY', 'no_proxy']
         for var in env_vars:
             os.environ.pop(var, None)
         self.log("Environment proxy variables removed")
         
         try:
-            # Get network services
-            result = subprocess.run(['networksetup', '-listallnetworkservices'], 
-                                  capture_output=True, text=True, timeout=5, check=True)
-            all_services = [line.strip() for line in result.stdout.split('\n') 
-                           if line.strip() and not line.strip().startswith('An asterisk')]
-            
-            # Get network service order to find active service
-            order_result = subprocess.run(['networksetup', '-listnetworkserviceorder'], 
-                                        capture_output=True, text=True, timeout=5, check=False)
-            
-            # Prefer Wi-Fi or Ethernet (active services)
-            service = None
-            preferred_services = ['Wi-Fi', 'Ethernet', 'AirPort', 'en0', 'en1']
-            
-            if order_result.returncode == 0:
-                for line in order_result.stdout.split('\n'):
-                    for preferred in preferred_services:
-                        if preferred in line and '(' in line:
-                            service_name = line.split(')')[1].split('(')[0].strip()
-                            if service_name in all_services:
-                                service = service_name
-                                break
-                    if service:
-                        break
-            
-            # Fallback: use first available service that's not a VPN or proxy
-            if not service:
-                for svc in all_services:
-                    if svc.lower() not in ['proxy', 'vpn', 'xvpn', 'vpnify', 'speedtop']:
-                        service = svc
-                        break
-            
-            # Last resort: use first service
-            if not service and all_services:
-                service = all_services[0]
+            service = self.find_macos_service()
             
             if not service:
                 self.log("No network services found, environment variables cleared")
@@ -929,51 +1476,271 @@ export all_proxy="{proxy_url}"
             self.log("Environment variables cleared")
             return True  # Still return True as env vars are cleared
             
+    def apply_bypass(self, bypass):
+        """Update only the bypass (no-proxy) rules of the active configuration"""
+        self.bypass_hosts = list(bypass)
+        os.environ['NO_PROXY'] = os.environ['no_proxy'] = ",".join(bypass)
+        if self.os_type == "Linux":
+            try:
+                subprocess.run(['gsettings', 'set', 'org.gnome.system.proxy', 'ignore-hosts', 
+                              str(self.bypass_hosts)], check=True, timeout=5)
+            except (subprocess.CalledProcessError, FileNotFoundError):
+                pass
+        elif self.os_type == "Windows":
+            import winreg
+            key_path = r'Software\Microsoft\Windows\CurrentVersion\Internet Settings'
+            key = winreg.OpenKey(winreg.HKEY_CURRENT_USER, key_path, 0, winreg.KEY_WRITE)
+            winreg.SetValueEx(key, 'ProxyOverride', 0, winreg.REG_SZ, 
+                              ';'.join(self.bypass_hosts + ['<local>']))
+            winreg.CloseKey(key)
+            self.notify_windows_proxy_change()
+        elif self.os_type == "Darwin":
+            service = self.find_macos_service()
+            if service:
+                subprocess.run(['networksetup', '-setproxybypassdomains', service] + self.bypass_hosts, 
+                             capture_output=True, text=True, timeout=5, check=False)
+        self.log(f"Bypass hosts set: {', '.join(bypass) or '(none)'}")
+        
+    def switch_proxy_linux(self, old, new, changes):
+        """Move an applied Linux configuration to a new upstream without tearing it down"""
+        ip, port, proxy_type = new.proxy_ip, new.proxy_port, new.proxy_type
+        os.environ.update(proxy_environment(ip, port, proxy_type, new.bypass))
+        
+        # GNOME: rewrite only the keys whose values changed
+        try:
+            schemas = gsettings_proxy_schemas(proxy_type)
+            values = {'host': ip, 'port': str(port)}
+            if 'proxy_type' not in changes:
+                if 'proxy_ip' not in changes:
+                    del values['host']
+                if 'proxy_port' not in changes:
+                    del values['port']
+            for schema in schemas:
+                for key, value in values.items():
+                    subprocess.run(['gsettings', 'set', schema, key, value], check=True, timeout=5)
+            if 'proxy_type' in changes:
+                # Clear schemas the old type used but the new one does not
+                for schema in set(gsettings_proxy_schemas(old.proxy_type)) - set(schemas):
+                    subprocess.run(['gsettings', 'reset', schema, 'host'], check=True, timeout=5)
+            self.log("GNOME proxy settings updated")
+        except (subprocess.CalledProcessError, FileNotFoundError):
+            try:
+                if proxy_type == "HTTP/HTTPS":
+                    subprocess.run(['kwriteconfig5', '--file', 'kioslaverc', '--group', 'Proxy Settings', 
+                                  '--key', 'httpProxy', f'{ip}:{port}'], check=True, timeout=5)
+                else:
+                    subprocess.run(['kwriteconfig5', '--file', 'kioslaverc', '--group', 'Proxy Settings', 
+                                  '--key', 'socksProxy', f'socks://{ip}:{port}'], check=True, timeout=5)
+                subprocess.run(['dbus-send', '--type=signal', '/KIO/Scheduler', 
+                              'org.kde.KIO.Scheduler.reparseSlaveConfiguration', 'string:""'], 
+                             check=True, timeout=5)
+                self.log("KDE proxy settings updated")
+            except (subprocess.CalledProcessError, FileNotFoundError):
+                pass
+        
+        # Backends that embed the endpoint are rewritten in place (no removal pass)
+        self.export_env_to_shell(ip, port, proxy_type)
+        self.configure_proxychains(ip, port, proxy_type)
+        self.configure_networkmanager(ip, port, proxy_type)
+        
+    def switch_proxy_windows(self, new):
+        """Point the Windows proxy at a new upstream (proxy stays enabled)"""
+        ip, port, proxy_type = new.proxy_ip, new.proxy_port, new.proxy_type
+        os.environ.update(proxy_environment(ip, port, proxy_type, new.bypass))
+        import winreg
+        key_path = r'Software\Microsoft\Windows\CurrentVersion\Internet Settings'
+        key = winreg.OpenKey(winreg.HKEY_CURRENT_USER, key_path, 0, winreg.KEY_WRITE)
+        server = f'{ip}:{port}' if proxy_type == "HTTP/HTTPS" else f'socks={ip}:{port}'
+        winreg.SetValueEx(key, 'ProxyServer', 0, winreg.REG_SZ, server)
+        winreg.CloseKey(key)
+        self.notify_windows_proxy_change()
+        self.log(f"Windows proxy server updated ({proxy_type})")
+        
+    def switch_proxy_macos(self, old, new):
+        """Point the macOS network service at a new upstream"""
+        ip, port, proxy_type = new.proxy_ip, new.proxy_port, new.proxy_type
+        os.environ.update(proxy_environment(ip, port, proxy_type, new.bypass))
+        service = self.find_macos_service()
+        if not service:
+            self.log("Warning: No network services found, environment variables updated only")
+            return
+        if proxy_type == "HTTP/HTTPS":
+            commands = [['-setwebproxy', service, ip, str(port)], 
+                        ['-setsecurewebproxy', service, ip, str(port)]]
+        else:
+            commands = [['-setsocksfirewallproxy', service, ip, str(port)]]
+        if old.proxy_type != proxy_type:
+            # Turn the new kind of proxy on and the old kind off
+            if proxy_type == "HTTP/HTTPS":
+                commands += [['-setwebproxystate', service, 'on'], ['-setsecurewebproxystate', service, 'on'], 
+                             ['-setsocksfirewallproxystate', service, 'off']]
+            elif old.proxy_type == "HTTP/HTTPS":
+                commands += [['-setsocksfirewallproxystate', service, 'on'], 
+                             ['-setwebproxystate', service, 'off'], ['-setsecurewebproxystate', service, 'off']]
+        for command in commands:
+            subprocess.run(['networksetup'] + command, capture_output=True, text=True, timeout=5, check=True)
+        self.log(f"macOS proxy updated for service: {service} ({proxy_type})")
+        
+    def notify_windows_proxy_change(self):
+        """Tell WinINet-based applications that proxy settings changed"""
+        try:
+            import ctypes
+            INTERNET_OPTION_REFRESH = 37
+            INTERNET_OPTION_SETTINGS_CHANGED = 39
+            internet_set_option = ctypes.windll.wininet.InternetSetOptionW
+            internet_set_option(0, INTERNET_OPTION_REFRESH, 0, 0)
+            internet_set_option(0, INTERNET_OPTION_SETTINGS_CHANGED, 0, 0)
+        except Exception as e:
+            self.log(f"Warning: Could not notify system of proxy changes: {e}")
+        
+    def scan_proxy_list(self):
+        """Scan a file of candidate ip:port entries in the background"""
+        path = filedialog.askopenfilename(title="Select proxy list",
+                                          filetypes=[("Text files", "*.txt"), ("All files", "*")])
+        if not path:
+            return
+        try:
+            candidates = scanner.load_candidates(path)
+        except OSError as e:
+            messagebox.showerror("Scan Error", f"Could not read {path}: {e}")
+            return
+        if not candidates:
+            messagebox.showwarning("Scan", "No ip:port entries found in the selected file")
+            return
+        
+        self.scan_btn.config(state=tk.DISABLED)
+        self.log(f"Scanning {len(candidates)} candidate proxies...")
+        step = max(len(candidates) // 10, 1)
+        
+        def progress(done, total, result):
+            if done % step == 0 or done == total:
+                self.log_threadsafe(f"Scan progress: {done}/{total}")
+        
+        def worker():
+            try:
+                results = asyncio.run(scanner.scan(candidates, progress=progress))
+                self.health.record_scan(results, scanner.DEFAULT_TARGET)
+            except Exception as e:
+                self.log_threadsafe(f"Scan error: {e}")
+                results = []
+            self.root.after(0, self.show_scan_results, results)
+        
+        threading.Thread(target=worker, daemon=True).start()
+        
+    def show_scan_results(self, results):
+        """Show ranked scan results and let the user pick one"""
+        self.scan_btn.config(state=tk.NORMAL)
+        ranked = scanner.rank(results, limit=50)
+        reachable = sum(1 for r in results if r.reachable)
+        self.log(f"Scan finished: {reachable}/{len(results)} reachable, {len(ranked)} working")
+        self.scan_results = ranked
+        if not ranked:
+            messagebox.showinfo("Scan Results", "No working proxies found")
+            return
+        
+        window = tk.Toplevel(self.root)
+        window.title("Scan Results")
+        listbox = tk.Listbox(window, width=80, height=min(len(ranked), 20), font=("Consolas", 9))
+        listbox.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        for result in ranked:
+            listbox.insert(tk.END, str(result))
+        listbox.selection_set(0)
+        
+        def use_selected(event=None):
+            selection = listbox.curselection()
+            if not selection:
+                return
+            result = ranked[selection[0]]
+            self.ip_entry.delete(0, tk.END)
+            self.ip_entry.insert(0, result.host)
+            self.port_entry.delete(0, tk.END)
+            self.port_entry.insert(0, str(result.port))
+            self.proxy_type_var.set(result.best_type)
+            self.log(f"Selected {result.host}:{result.port} ({result.best_type}) from scan results")
+            window.destroy()
+        
+        def save_selected():
+            selection = listbox.curselection()
+            if not selection:
+                return
+            profile = scan_profile(ranked[selection[0]])
+            try:
+                self.profiles.put(profile)
+            except OSError as e:
+                messagebox.showerror("Save Profile", str(e), parent=window)
+                return
+            self.refresh_profiles()
+            self.log(f"Saved profile {profile}")
+        
+        listbox.bind("<Double-Button-1>", use_selected)
+        buttons = ttk.Frame(window)
+        buttons.pack(pady=(0, 10))
+        ttk.Button(buttons, text="Use Selected", command=use_selected).pack(side=tk.LEFT, padx=5)
+        ttk.Button(buttons, text="Save as Profile", command=save_selected).pack(side=tk.LEFT, padx=5)
+        
+    def show_last_known_health(self):
+        """Log the persisted probe result for the configured proxy without probing"""
+        try:
+            ip, port = self.get_proxy_settings()
+        except ValueError:
+            return
+        result = self.health.get(probe_key(f"{ip}:{port}", 'tcp'))
+        if result:
+            self.log(f"Last known health of {ip}:{port}: {result}, checked {format_age(result.age())}")
+        
     def test_connection(self):
         """Test proxy connection"""
         try:
             ip, port = self.get_proxy_settings()
             proxy_type = self.proxy_type_var.get()
+            self.store_credentials(ip, port)
+            
+            profile = self.current_profile()
+            chain = profile.chain()
             
             self.log(f"Testing connection to {ip}:{port} ({proxy_type})...")
             
-            # Test 1: Socket connection test
-            try:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.settimeout(5)
-                result = sock.connect_ex((ip, int(port)))
-                sock.close()
-                
-                if result == 0:
-                    self.log("✓ Socket connection test: PASSED")
-                else:
-                    self.log(f"✗ Socket connection test: FAILED (Error code: {result})")
-                    messagebox.showerror("Connection Test Failed", 
-                                       f"Could not connect to {ip}:{port}\n"
-                                       "Please verify the proxy server is running and accessible.")
-                    return
-            except Exception as e:
-                self.log(f"✗ Socket connection test: FAILED ({e})")
+            # Test 1: Socket connection test (all IPv4/IPv6 addresses raced) to the
+            # first hop, the only one reached directly; a test the user asked for
+            # always probes (max_age=0) and refreshes the shared cache
+            first_ip, first_port = chain[0][0], chain[0][1]
+            upstream_name = f"{first_ip}:{first_port}"
+            tcp = self.health.lookup(probe_key(upstream_name, 'tcp'), 
+                                     lambda: tcp_probe(first_ip, first_port, tuning=self.tuning), 
+                                     max_age=0)
+            if not tcp.ok:
+                self.log(f"✗ Socket connection test: {tcp}")
                 messagebox.showerror("Connection Test Failed", 
-                                   f"Could not connect to {ip}:{port}\n{str(e)}")
+                                   f"Could not connect to {first_ip}:{first_port}\n"
+                                   "Please verify the proxy server is running and accessible.")
                 return
-            
-            # Test 2: HTTP request test (if HTTP/HTTPS proxy)
-            if proxy_type == "HTTP/HTTPS":
-                try:
-                    proxy_handler = urllib.request.ProxyHandler({
-                        'http': f'http://{ip}:{port}',
-                        'https': f'http://{ip}:{port}'
-                    })
-                    opener = urllib.request.build_opener(proxy_handler)
-                    
-                    # Try to fetch a simple page
-                    response = opener.open('http://httpbin.org/ip', timeout=10)
-                    data = response.read().decode('utf-8')
+            # Scanner results record no peer address
+            address = f"{tcp.detail}, " if tcp.detail else ""
+            self.log(f"✓ Socket connection test: PASSED ({address}{tcp.latency_ms:.0f} ms)")
+            
+            # Test 2: a tunnel through every jump hop, or an HTTP request test (if HTTP/HTTPS proxy)
+            if profile.via:
+                target = f"{CHAIN_TEST_TARGET[0]}:{CHAIN_TEST_TARGET[1]}"
+                tunnel = self.health.lookup(probe_key(chain_name(chain), 'chain', target), 
+                                            lambda: chain_probe(chain, tuning=self.tuning, auth=self.auth), 
+                                            max_age=0)
+                if not tunnel.ok:
+                    self.log(f"✗ Chain test: {tunnel}")
+                    messagebox.showerror("Connection Test Failed", 
+                                       f"Could not open a tunnel through {chain_name(chain)}\n"
+                                       "Please verify every hop of the chain is running and accessible.")
+                    return
+                self.log(f"✓ Chain test: PASSED ({target}, {tunnel.latency_ms:.0f} ms)")
+            elif proxy_type == "HTTP/HTTPS":
+                hop_auth = self.auth.for_hop((ip, int(port), proxy_type))
+                http = self.health.lookup(probe_key(upstream_name, proxy_type, HTTP_TEST_URL), 
+                                          lambda: http_probe(ip, port, hop_auth=hop_auth, tuning=self.tuning), 
+                                          max_age=0)
+                if http.ok:
                     self.log("✓ HTTP proxy test: PASSED")
-                    self.log(f"  Response: {data[:100]}")
-                except Exception as e:
-                    self.log(f"✗ HTTP proxy test: FAILED ({e})")
+                    self.log(f"  Response: {http.detail}")
+                else:
+                    self.log(f"✗ HTTP proxy test: {http}")
                     self.log("  Note: Proxy may still work, but HTTP test failed")
             
             messagebox.showinfo("Connection Test", 
@@ -989,6 +1756,145 @@ export all_proxy="{proxy_url}"
             messagebox.showerror("Test Error", f"Test failed: {str(e)}")
             self.log(f"Test error: {e}")
     
+    def apply_profile(self, profile, use_relay=False):
+        """Point the system proxy at profile (through the local relay if asked); True on success"""
+        ip, port, proxy_type = profile.proxy_ip, profile.proxy_port, profile.proxy_type
+        self.bypass_hosts = profile.bypass
+        os.environ['NO_PROXY'] = os.environ['no_proxy'] = ",".join(profile.bypass)
+        self.log(f"Connecting to proxy: {ip}:{port} (Type: {proxy_type})")
+        
+        # Save original settings
+        self.save_original_proxy_settings()
+        # Credentials may have been saved from the CLI since the last connection
+        self.credentials.reload()
+        
+        try:
+            # Point the system at the local relay instead of the upstream if requested;
+            # the system proxy settings hold a single hop and no password, so chains and
+            # authenticated proxies always use the relay
+            system_ip, system_port = ip, port
+            if use_relay or profile.via or self.needs_auth(profile):
+                system_ip, system_port = self.start_relay(ip, port, proxy_type, profile.chain()[:-1])
+            
+            # Configure proxy based on OS
+            if self.os_type == "Linux":
+                success = self.set_proxy_linux(system_ip, system_port, proxy_type)
+            elif self.os_type == "Windows":
+                success = self.set_proxy_windows(system_ip, system_port, proxy_type)
+            elif self.os_type == "Darwin":  # macOS
+                success = self.set_proxy_macos(system_ip, system_port, proxy_type)
+            else:
+                raise RuntimeError(f"Unsupported operating system: {self.os_type}")
+        except BaseException:
+            self.stop_relay()
+            raise
+        if not success:
+            self.stop_relay()
+            return False
+        
+        self.is_connected = True
+        self.applied_profile = profile
+        self.system_proxy = (system_ip, system_port, proxy_type)
+        self.start_network_watcher()
+        return True
+        
+    def release_profile(self):
+        """Remove the system proxy configuration; True on success"""
+        self.log("Disconnecting from proxy...")
+        
+        # Remove proxy configuration based on OS
+        success = False
+        if self.os_type == "Linux":
+            success = self.remove_proxy_linux()
+        elif self.os_type == "Windows":
+            success = self.remove_proxy_windows()
+        elif self.os_type == "Darwin":  # macOS
+            success = self.remove_proxy_macos()
+        if not success:
+            return False
+        
+        self.stop_network_watcher()
+        self.stop_relay()
+        self.is_connected = False
+        self.applied_profile = None
+        self.system_proxy = None
+        self.macos_service = None
+        return True
+        
+    def status(self):
+        """Plain dict view of the connection state (what the daemon reports)"""
+        relay = None
+        if self.relay and self.relay.running:
+            relay = {'host': self.relay.listen_host, 'port': self.relay.listen_port, 
+                     'chain': self.relay.describe_chain()}
+        return {
+            'connected': self.is_connected,
+            'profile': profile_message(self.applied_profile) if self.applied_profile else None,
+            'system_proxy': list(self.system_proxy) if self.system_proxy else None,
+            'relay': relay,
+            'os': self.os_type,
+        }
+        
+    def show_connection(self, status):
+        """Reflect a status() dict in the status line and buttons"""
+        if status['connected']:
+            profile = status['profile']
+            text = f"Connected to {profile['proxy_ip']}:{profile['proxy_port']}"
+            if status['relay']:
+                text += f" (via relay {status['relay']['host']}:{status['relay']['port']})"
+            self.status_label.config(text=text)
+            self.draw_status_indicator("green")
+            self.connect_btn.config(state=tk.DISABLED)
+            self.disconnect_btn.config(state=tk.NORMAL)
+        else:
+            self.status_label.config(text="Disconnected")
+            self.draw_status_indicator("red")
+            self.connect_btn.config(state=tk.NORMAL)
+            self.disconnect_btn.config(state=tk.DISABLED)
+        
+    def attach_daemon(self):
+        """Leave the connection state to a running daemon, so front-ends never race each other"""
+        if not control.daemon_running():
+            return
+        try:
+            status = control.request('status')
+        except (OSError, ValueError, control.DaemonError) as e:
+            self.log(f"Daemon not usable: {e}")
+            return
+        self.daemon = control.socket_path()
+        self.log(f"Connection managed by the daemon ({self.daemon})")
+        self.apply_daemon_status(status)
+        threading.Thread(target=self.watch_daemon, daemon=True).start()
+        
+    def daemon_request(self, command, **params):
+        return control.request(command, path=self.daemon, **params)
+        
+    def watch_daemon(self):
+        """Follow daemon events (changes made by other front-ends) from a background thread"""
+        try:
+            with control.ControlClient(self.daemon) as client:
+                for event in client.subscribe():
+                    self.call_soon(self.on_daemon_event, event)
+        except (OSError, ValueError, control.DaemonError):
+            pass
+        self.call_soon(self.detach_daemon)
+        
+    def detach_daemon(self):
+        self.daemon = None
+        self.log("Lost the daemon; this window manages the connection again")
+        
+    def on_daemon_event(self, event):
+        if event['event'] == 'state':
+            self.apply_daemon_status(event['status'])
+        elif event['event'] == 'log':
+            self.log(f"daemon: {event['message']}")
+        
+    def apply_daemon_status(self, status):
+        self.is_connected = status['connected']
+        if status['connected']:
+            self.fill_profile_fields(Profile.from_dict(status['profile']['name'], status['profile']))
+        self.show_connection(status)
+        
     def connect_vpn(self):
         """Connect to VPN/Proxy"""
         if self.is_connected:
@@ -997,31 +1903,27 @@ export all_proxy="{proxy_url}"
             
         try:
             ip, port = self.get_proxy_settings()
-            proxy_type = self.proxy_type_var.get()
-            self.log(f"Connecting to proxy: {ip}:{port} (Type: {proxy_type})")
-            
-            # Save original settings
-            self.save_original_proxy_settings()
-            
-            # Configure proxy based on OS
-            success = False
-            if self.os_type == "Linux":
-                success = self.set_proxy_linux(ip, port, proxy_type)
-            elif self.os_type == "Windows":
-                success = self.set_proxy_windows(ip, port, proxy_type)
-            elif self.os_type == "Darwin":  # macOS
-                success = self.set_proxy_macos(ip, port, proxy_type)
+            profile = self.current_profile()
+            credentials = self.store_credentials(ip, port)
+            if profile.via and not self.use_relay_var.get():
+                # The system proxy settings hold a single hop; chains are built by the relay
+                self.log("Jump hops configured: routing through the local relay")
+                self.use_relay_var.set(True)
+            elif credentials and not self.use_relay_var.get():
+                # ...and no password: the relay answers the proxy's challenges instead
+                self.log("Proxy login configured: routing through the local relay")
+                self.use_relay_var.set(True)
+            
+            if self.daemon:
+                status = self.daemon_request('connect', profile=profile_message(profile), 
+                                             relay=self.use_relay_var.get(), credentials=credentials)
+                success = self.is_connected = status['connected']
             else:
-                self.log(f"Unsupported OS: {self.os_type}")
-                messagebox.showerror("Error", f"Unsupported operating system: {self.os_type}")
-                return
+                success = self.apply_profile(profile, self.use_relay_var.get())
+                status = self.status()
                 
             if success:
-                self.is_connected = True
-                self.status_label.config(text=f"Connected to {ip}:{port}")
-                self.draw_status_indicator("green")
-                self.connect_btn.config(state=tk.DISABLED)
-                self.disconnect_btn.config(state=tk.NORMAL)
+                self.show_connection(status)
                 self.log("Successfully connected to proxy")
                 
                 # Platform-specific success message
@@ -1055,6 +1957,7 @@ export all_proxy="{proxy_url}"
             messagebox.showerror("Invalid Input", str(e))
             self.log(f"Connection error: {e}")
         except Exception as e:
+            self.stop_relay()
             messagebox.showerror("Error", f"Failed to connect: {str(e)}")
             self.log(f"Connection error: {e}")
             
@@ -1065,23 +1968,16 @@ export all_proxy="{proxy_url}"
             return
             
         try:
-            self.log("Disconnecting from proxy...")
-            
-            # Remove proxy configuration based on OS
-            success = False
-            if self.os_type == "Linux":
-                success = self.remove_proxy_linux()
-            elif self.os_type == "Windows":
-                success = self.remove_proxy_windows()
-            elif self.os_type == "Darwin":  # macOS
-                success = self.remove_proxy_macos()
+            if self.daemon:
+                status = self.daemon_request('disconnect')
+                self.is_connected = status['connected']
+                success = not self.is_connected
+            else:
+                success = self.release_profile()
+                status = self.status()
                 
             if success:
-                self.is_connected = False
-                self.status_label.config(text="Disconnected")
-                self.draw_status_indicator("red")
-                self.connect_btn.config(state=tk.NORMAL)
-                self.disconnect_btn.config(state=tk.DISABLED)
+                self.show_connection(status)
                 self.log("Successfully disconnected from proxy")
                 messagebox.showinfo("Success", "Disconnected from proxy")
             else:
@@ -1091,13 +1987,387 @@ export all_proxy="{proxy_url}"
             messagebox.showerror("Error", f"Failed to disconnect: {str(e)}")
             self.log(f"Disconnection error: {e}")
 
-def main():
+def profile_message(profile):
+    """Profile as sent over the daemon control socket"""
+    return dict(profile.to_dict(), name=profile.name)
+
+def run_scan(args):
+    """CLI: scan a candidate list and print the fastest working proxies"""
+    target_host, _, target_port = args.target.rpartition(':')
+    candidates = scanner.load_candidates(args.file)
+    print(f"Scanning {len(candidates)} candidates (concurrency {args.concurrency})...", file=sys.stderr)
+    started = time.monotonic()
+    
+    def progress(done, total, result):
+        if done % 100 == 0 or done == total:
+            print(f"  {done}/{total}", file=sys.stderr)
+    
+    results = asyncio.run(scanner.scan(candidates, args.concurrency, (target_host, int(target_port)),
+                                       args.timeout, progress))
+    ranked = scanner.rank(results, args.top)
+    print(f"Scanned in {time.monotonic() - started:.1f}s: "
+          f"{sum(1 for r in results if r.reachable)} reachable, {len(ranked)} shown", file=sys.stderr)
+    for result in ranked:
+        print(result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump([r.to_dict() for r in ranked], f, indent=2)
+    try:
+        ProbeCache(autoload=False).record_scan(results, (target_host, int(target_port)))
+    except OSError as e:
+        print(f"Warning: could not update the probe cache: {e}", file=sys.stderr)
+    if args.save_profiles and ranked:
+        store = ProfileStore()
+        for result in ranked[:args.save_profiles]:
+            profile = scan_profile(result)
+            store.profiles[profile.name] = profile
+        store.save()
+        print(f"Saved {min(args.save_profiles, len(ranked))} profiles to {store.path}", file=sys.stderr)
+    return 0 if ranked else 1
+
+def scan_profile(result):
+    """Profile for a working scan result"""
+    return Profile(f"scan-{result.host}-{result.port}", result.host, result.port, result.best_type)
+
+def run_profile(args):
+    """Manage saved profiles from the command line"""
+    store = ProfileStore()
+    try:
+        if args.action == 'list':
+            for name in store.names():
+                marker = '*' if name == store.active else ' '
+                print(f"{marker} {store.get(name)}")
+        elif args.action == 'show':
+            print(json.dumps({args.name: store.get(args.name).to_dict()}, indent=2))
+        elif args.action == 'save':
+            store.put(Profile(args.name, args.ip, args.port, args.type, args.bypass, args.via))
+            print(f"Saved profile {store.get(args.name)}")
+        elif args.action == 'delete':
+            store.delete(args.name)
+            print(f"Deleted profile {args.name}")
+        elif args.action == 'use':
+            store.set_active(args.name)
+            print(f"Active profile: {store.get(args.name)}")
+    except KeyError as e:
+        print(e.args[0], file=sys.stderr)
+        return 1
+    except ValueError as e:
+        print(f"Invalid profile: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+def launch_profile(name=None):
+    """Profile for proxy-run: the named one, the active one, or PROXY_IP/PROXY_PORT"""
+    store = ProfileStore()
+    if name:
+        return store.get(name)
+    profile = store.active_profile()
+    if profile:
+        return profile
+    return Profile("environment", os.getenv('PROXY_IP', '172.33.157.252'), os.getenv('PROXY_PORT', '8118'),
+                   os.getenv('PROXY_TYPE', "HTTP/HTTPS"), parse_bypass(os.getenv('NO_PROXY', '')) or None,
+                   os.getenv('PROXY_VIA'))
+
+def relay_listening(host, port):
+    """True if something accepts connections on the local relay port"""
+    try:
+        socket.create_connection((host, port), timeout=0.5).close()
+        return True
+    except OSError:
+        return False
+
+def run_proxy(args):
+    """CLI: run one command with the proxy set in its environment only"""
+    command = args.command_line[1:] if args.command_line[:1] == ['--'] else args.command_line
+    if not command:
+        print("proxy-run: no command given", file=sys.stderr)
+        return 2
+    try:
+        profile = launch_profile(args.profile)
+    except (KeyError, ValueError, OSError) as e:
+        print(f"proxy-run: {e.args[0] if isinstance(e, KeyError) else e}", file=sys.stderr)
+        return 1
+    
+    relay = None
+    ip, port, proxy_type = profile.proxy_ip, profile.proxy_port, profile.proxy_type
+    auth = ProxyAuth()
+    # Proxy URLs in the environment would expose the password to every child process
+    private = profile.via or any(auth.needs_auth(hop) for hop in profile.chain())
+    if args.relay or private:
+        relay_port = int(os.getenv('RELAY_PORT', str(RELAY_PORT)))
+        # The shared relay follows the active profile, so a named one gets its own relay too
+        if private or args.profile or not relay_listening(RELAY_HOST, relay_port):
+            # No shared relay running (or a profile, chain or login it may not follow): use a private one
+            relay = LocalRelay(ip, port, proxy_type, RELAY_HOST, 0, shaper=Shaper.from_env(),
+                               via=profile.chain()[:-1], tuning=SocketTuning.from_env(), auth=auth)
+            relay.start()
+            relay_port = relay.listen_port
+        # The relay accepts HTTP and SOCKS clients on the same port
+        ip, port, proxy_type = RELAY_HOST, relay_port, "HTTP/HTTPS"
+    
+    env = dict(os.environ)
+    env.update(proxy_environment(ip, port, proxy_type, profile.bypass))
+    if relay is None and os.name == 'posix':
+        # Replace this process: no wrapper left behind, signals and exit status go straight to the command
+        try:
+            os.execvpe(command[0], command, env)
+        except OSError as e:
+            print(f"proxy-run: {command[0]}: {e.strerror}", file=sys.stderr)
+            return 127
+    try:
+        return subprocess.call(command, env=env)
+    except OSError as e:
+        print(f"proxy-run: {command[0]}: {e.strerror}", file=sys.stderr)
+        return 127
+    finally:
+        if relay:
+            relay.stop()
+
+def run_check(args):
+    """CLI: report proxy health, probing only when the cached result is too old"""
+    try:
+        profile = launch_profile(args.profile)
+    except (KeyError, ValueError, OSError) as e:
+        print(f"check: {e.args[0] if isinstance(e, KeyError) else e}", file=sys.stderr)
+        return 1
+    ip, port, proxy_type = profile.proxy_ip, profile.proxy_port, profile.proxy_type
+    cache = ProbeCache()
+    tuning = SocketTuning.from_env()
+    auth = ProxyAuth()
+    chain = profile.chain()
+    # Only the first hop is reached directly; the rest are checked by tunnelling through the chain
+    first_ip, first_port = chain[0][0], chain[0][1]
+    checks = [('tcp', probe_key(f"{first_ip}:{first_port}", 'tcp'), 
+               lambda: tcp_probe(first_ip, first_port, tuning=tuning))]
+    if profile.via:
+        target = f"{CHAIN_TEST_TARGET[0]}:{CHAIN_TEST_TARGET[1]}"
+        checks.append(('chain', probe_key(chain_name(chain), 'chain', target), 
+                       lambda: chain_probe(chain, tuning=tuning, auth=auth)))
+    elif proxy_type == "HTTP/HTTPS":
+        hop_auth = auth.for_hop((ip, int(port), proxy_type))
+        checks.append((proxy_type, probe_key(f"{ip}:{port}", proxy_type, HTTP_TEST_URL), 
+                       lambda: http_probe(ip, port, hop_auth=hop_auth, tuning=tuning)))
+    report = {}
+    for name, key, probe in checks:
+        result = cache.lookup(key, probe, max_age=args.max_age)
+        report[name] = dict(result.to_dict(), age=result.age())
+        if not args.json:
+            print(f"{key.split('|', 1)[0]} {name:10s} {result}  (checked {format_age(result.age())})")
+    if args.json:
+        print(json.dumps(report, indent=2))
+    return 0 if all(r['ok'] for r in report.values()) else 1
+
+def run_relay_profile(args):
+    """CLI: run the local relay for a while under the profiler"""
+    try:
+        profile = launch_profile()
+    except (KeyError, ValueError, OSError) as e:
+        print(f"profile: {e.args[0] if isinstance(e, KeyError) else e}", file=sys.stderr)
+        return 1
+    relay = LocalRelay(profile.proxy_ip, profile.proxy_port, profile.proxy_type, RELAY_HOST,
+                       int(os.getenv('RELAY_PORT', str(RELAY_PORT))), log=print,
+                       shaper=Shaper.from_env(), via=profile.chain()[:-1], tuning=SocketTuning.from_env(),
+                       auth=ProxyAuth())
+    try:
+        relay.start()
+    except OSError as e:
+        print(f"profile: could not start the relay: {e}", file=sys.stderr)
+        return 1
+    profiler = OperationProfiler('relay', args.profiler)
+    # cProfile follows a single thread, so start it in the relay's event loop thread
+    relay.call_in_loop(profiler.start)
+    print(f"Profiling for {args.profile_seconds:.0f} s; point applications at "
+          f"{RELAY_HOST}:{relay.listen_port} (Ctrl+C stops early)")
+    try:
+        time.sleep(args.profile_seconds)
+    except KeyboardInterrupt:
+        pass
+    relay.call_in_loop(profiler.stop)
+    relay.stop()
+    path = profiler.write(args.profile_output or default_output('relay', args.profiler))
+    print("\n".join(profiler.summary()))
+    print(f"Relayed {relay.meter.total_connections} connections, "
+          f"{format_bytes(relay.meter.total_up)} up, {format_bytes(relay.meter.total_down)} down")
+    print(f"Profile written to {path}")
+    return 0
+
+def run_auth(args):
+    """CLI: save, show or delete a proxy login in the system keyring"""
+    host, _, port = args.proxy.rpartition(':')
+    host = host.strip('[]')
+    if not host or not port.isdigit():
+        print(f"auth: expected HOST:PORT, got {args.proxy!r}", file=sys.stderr)
+        return 2
+    store = CredentialStore()
+    if not store.use_keyring and args.action != 'show':
+        print("auth: saving logins needs the keyring package (pip install keyring)", file=sys.stderr)
+        return 1
+    try:
+        if args.action == 'set':
+            password = sys.stdin.readline().rstrip('\n') if args.password_stdin else getpass.getpass()
+            store.set(host, port, args.username, password, remember=True)
+            print(f"Saved login {args.username} for {args.proxy}")
+        elif args.action == 'show':
+            credentials = store.get(host, port)
+            print(f"{args.proxy}: {credentials[0] if credentials else 'no login saved'}")
+        elif args.action == 'delete':
+            store.forget(host, port)
+            print(f"Deleted login for {args.proxy}")
+    except Exception as e:
+        print(f"auth: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+def run_daemon(args):
+    """CLI: run the resident daemon that owns the connection state"""
+    # Imported here: the daemon module builds on VPNApp from this one
+    from daemon import ProxyDaemon
+    try:
+        ProxyDaemon(args.socket).run()
+    except (RuntimeError, OSError) as e:
+        print(f"daemon: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+def run_ctl(args):
+    """CLI: send one command to the daemon and print the JSON result"""
+    params = {}
+    if args.action in ('connect', 'switch'):
+        params['profile'] = args.profile
+    if args.action == 'connect' and args.relay:
+        params['relay'] = True
+    command = {'stop': 'shutdown', 'events': 'subscribe'}.get(args.action, args.action)
+    try:
+        if command == 'subscribe':
+            with control.ControlClient(args.socket) as client:
+                try:
+                    for event in client.subscribe():
+                        print(json.dumps(event), flush=True)
+                except ConnectionError:
+                    # The daemon stopped
+                    pass
+            return 0
+        result = control.request(command, path=args.socket, **params)
+    except control.DaemonError as e:
+        print(f"ctl: {e}", file=sys.stderr)
+        return 1
+    except OSError as e:
+        print(f"ctl: cannot reach the daemon at {args.socket or control.socket_path()}: {e}", file=sys.stderr)
+        return 1
+    except KeyboardInterrupt:
+        return 0
+    print(json.dumps(result, indent=2))
+    return 0
+
+def build_parser():
+    # No prefix matching: --profile on a subcommand must not be taken for the --profile-* options here
+    parser = argparse.ArgumentParser(description="PHH VPN Client (starts the GUI when no command is given)",
+                                     allow_abbrev=False)
+    # Not --profile: subcommands use that for a saved connection profile
+    parser.add_argument('--profile-op', dest='profile_operation', choices=['connect', 'disconnect', 'test', 'relay'],
+                        help="Run one operation under the profiler and write the result for a bug report "
+                             "(relay runs without the GUI)")
+    parser.add_argument('--profiler', choices=PROFILERS, default='cprofile',
+                        help="cprofile writes a pstats file, sample writes folded stacks for flame graphs")
+    parser.add_argument('--profile-output', metavar='FILE',
+                        help="Where to write the profile (default: a timestamped file in the config directory)")
+    parser.add_argument('--profile-seconds', type=float, default=30, metavar='SECONDS',
+                        help="How long to profile the relay")
+    sub = parser.add_subparsers(dest='command')
+    
+    scan = sub.add_parser('scan', help="Scan a list of candidate proxies and rank them by latency")
+    scan.add_argument('file', help="File with one ip:port per line")
+    scan.add_argument('--concurrency', type=int, default=scanner.DEFAULT_CONCURRENCY,
+                      help="Maximum probe sockets open at once")
+    scan.add_argument('--timeout', type=float, default=scanner.DEFAULT_TIMEOUT,
+                      help="Seconds per connect/handshake")
+    scan.add_argument('--target', default=':'.join(map(str, scanner.DEFAULT_TARGET)),
+                      help="host:port each proxy must be able to reach")
+    scan.add_argument('--top', type=int, default=20, help="Number of results to print")
+    scan.add_argument('--json', help="Write ranked results to this JSON file")
+    scan.add_argument('--save-profiles', type=int, default=0, metavar='N',
+                      help="Save the N fastest proxies as profiles")
+    scan.set_defaults(func=run_scan)
+    
+    profile = sub.add_parser('profile', help="List, save, delete or activate saved proxy profiles")
+    actions = profile.add_subparsers(dest='action', required=True)
+    actions.add_parser('list', help="List saved profiles (* marks the active one)")
+    for action, text in (('show', "Print a profile"), ('delete', "Delete a profile"),
+                         ('use', "Make a profile active for the next GUI start")):
+        actions.add_parser(action, help=text).add_argument('name')
+    save = actions.add_parser('save', help="Create or replace a profile")
+    save.add_argument('name')
+    save.add_argument('--ip', required=True, help="Proxy IP or hostname")
+    save.add_argument('--port', required=True, help="Proxy port")
+    save.add_argument('--type', default="HTTP/HTTPS", choices=PROXY_TYPES, help="Proxy type")
+    save.add_argument('--bypass', help="Comma separated hosts that skip the proxy")
+    save.add_argument('--via', help="Comma separated jump hops in order, e.g. socks5://jump:1080")
+    profile.set_defaults(func=run_profile)
+    
+    launcher = sub.add_parser('proxy-run', help="Run a command with the proxy set in its environment only",
+                              usage="%(prog)s [--profile NAME] [--relay] [--] command [args ...]")
+    launcher.add_argument('--profile', help="Profile to use (default: the active profile, then PROXY_IP/PROXY_PORT)")
+    launcher.add_argument('--relay', action='store_true',
+                          help="Go through the local relay (started for this command if not already running)")
+    launcher.add_argument('command_line', nargs=argparse.REMAINDER, metavar='command')
+    launcher.set_defaults(func=run_proxy)
+    
+    check = sub.add_parser('check', help="Report proxy health from the shared probe cache, probing if needed")
+    check.add_argument('--profile', help="Profile to check (default: the active profile, then PROXY_IP/PROXY_PORT)")
+    check.add_argument('--max-age', type=float, default=None, metavar='SECONDS',
+                       help="Probe again if the cached result is older than this (0 forces a probe)")
+    check.add_argument('--json', action='store_true', help="Print the results as JSON")
+    check.set_defaults(func=run_check)
+    
+    auth = sub.add_parser('auth', help="Save, show or delete a proxy login in the system keyring")
+    auth_actions = auth.add_subparsers(dest='action', required=True)
+    auth_set = auth_actions.add_parser('set', help="Save a login (the password is prompted for)")
+    auth_set.add_argument('proxy', metavar='HOST:PORT')
+    auth_set.add_argument('--username', required=True)
+    auth_set.add_argument('--password-stdin', action='store_true', help="Read the password from standard input")
+    for action, text in (('show', "Print the saved username"), ('delete', "Delete a saved login")):
+        auth_actions.add_parser(action, help=text).add_argument('proxy', metavar='HOST:PORT')
+    auth.set_defaults(func=run_auth)
+    
+    daemon = sub.add_parser('daemon', help="Run the resident daemon that owns the connection (POSIX only)")
+    daemon.add_argument('--socket', help="Control socket path (default: PHH_VPN_SOCKET, then the runtime dir)")
+    daemon.set_defaults(func=run_daemon)
+    
+    ctl = sub.add_parser('ctl', help="Drive the daemon: connect, disconnect, switch, status, stats, memory, events, stop")
+    ctl.add_argument('--socket', help="Control socket path (default: PHH_VPN_SOCKET, then the runtime dir)")
+    ctl_actions = ctl.add_subparsers(dest='action', required=True)
+    ctl_connect = ctl_actions.add_parser('connect', help="Connect with a saved profile (default: the active one)")
+    ctl_connect.add_argument('--profile', help="Saved profile name")
+    ctl_connect.add_argument('--relay', action='store_true', help="Route through the local relay")
+    ctl_switch = ctl_actions.add_parser('switch', help="Switch the connection to another saved profile")
+    ctl_switch.add_argument('--profile', required=True, help="Saved profile name")
+    ctl_actions.add_parser('disconnect', help="Disconnect and restore the proxy settings")
+    ctl_actions.add_parser('status', help="Print the connection state")
+    ctl_actions.add_parser('stats', help="Print relay traffic counters and memory use")
+    ctl_actions.add_parser('memory', help="Print memory use, its trend and the top allocation sites")
+    ctl_actions.add_parser('events', help="Print state and log events as they happen (one JSON object per line)")
+    ctl_actions.add_parser('stop', help="Disconnect and stop the daemon")
+    ctl.set_defaults(func=run_ctl)
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.command:
+        return args.func(args)
+    if args.profile_operation == 'relay':
+        return run_relay_profile(args)
+    
     root = tk.Tk()
     app = VPNApp(root)
+    if args.profile_operation:
+        app.profiler_kind = args.profiler
+        app.profile_output = args.profile_output
+        root.after(500, app.profile_operation, args.profile_operation)
     
     # Handle window closing
     def on_closing():
-        if app.is_connected:
+        # A daemon keeps the connection after the window goes away
+        if app.is_connected and not app.daemon:
             if messagebox.askokcancel("Quit", "You are connected to a proxy. Disconnect before quitting?"):
                 app.disconnect_vpn()
                 root.destroy()
@@ -1108,4 +2378,4 @@ def main():
     root.mainloop()
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())